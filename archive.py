@@ -0,0 +1,209 @@
+# archive.py
+# Append-only archive of the raw pages behind every scrape, so that extraction fixes can be applied to the
+# saved notices again without the portal (`python scraper.py reparse`). The pages of one scrape form one
+# record, compressed on its own (zstd when the zstandard package is installed, gzip otherwise) and appended
+# to the current segment file of the writing process; an SQLite index maps (notice id, fetch time) to the
+# record's segment, offset and length. Off unless ARCHIVE_DIR is set, on Cloud Run that should be a mounted
+# volume since the instance's own disk lives in its memory.
+
+import os
+import gzip
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR")
+# A new segment is started once the current one is this big
+ARCHIVE_SEGMENT_MB = int(os.environ.get("ARCHIVE_SEGMENT_MB", 256))
+# zstd level, gzip uses 6
+ARCHIVE_LEVEL = int(os.environ.get("ARCHIVE_LEVEL", 3))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    notice_id TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    pages INTEGER NOT NULL,
+    PRIMARY KEY (notice_id, fetched_at)
+);
+CREATE INDEX IF NOT EXISTS records_fetched ON records (fetched_at);
+"""
+
+
+class Recording:
+    """Raw pages loaded by a fetcher for one notice, in the order they arrived."""
+
+    def __init__(self):
+        self.pages = []
+        self.lock = threading.Lock()
+
+    # kind is notice, contact, item_list or item (see fetcher.PAGE_KINDS)
+    def add(self, kind, url, content_type, body):
+        with self.lock:
+            self.pages.append((kind, url, content_type, body))
+
+    # Forgets the pages of a failed attempt
+    def clear(self):
+        with self.lock:
+            self.pages = []
+
+
+def zstd_available():
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+
+def compress(extension, data):
+    if extension == "zst":
+        import zstandard
+        return zstandard.ZstdCompressor(level=ARCHIVE_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(extension, frame):
+    if extension == "zst":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(frame)
+    return gzip.decompress(frame)
+
+
+# One record: a JSON header line describing the pages, then their bodies back to back
+def pack(notice_id, fetched_at, published, item_ids, pages):
+    header = dict(notice_id=notice_id, fetched_at=fetched_at, published=published, items=item_ids,
+                  pages=[dict(kind=kind, url=url, content_type=content_type, length=len(body))
+                         for kind, url, content_type, body in pages])
+    return b"".join([json.dumps(header).encode("utf-8"), b"\n"] + [body for _, _, _, body in pages])
+
+
+# Returns (header, [(page description, body)])
+def unpack(data):
+    end = data.index(b"\n")
+    header = json.loads(data[:end].decode("utf-8"))
+    pages = []
+    position = end + 1
+    for page in header["pages"]:
+        pages.append((page, data[position:position + page["length"]]))
+        position += page["length"]
+    return header, pages
+
+
+def open_index(directory):
+    connection = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False,
+                                 isolation_level=None, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class Archive:
+    """Segment files and their index in directory, appended to by this process."""
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index = open_index(directory)
+        self.extension = "zst" if zstd_available() else "gz"
+        self.segment = None
+        self.file = None
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    # The segment to append to, a new one per process and whenever the current one is full
+    def _segment(self):
+        if self.file is not None and self.file.tell() < ARCHIVE_SEGMENT_MB * 1024 * 1024:
+            return self.file
+        if self.file is not None:
+            self.file.close()
+        self.sequence += 1
+        self.segment = "{}-{}-{}-{:05d}.{}".format(time.strftime("%Y%m%dT%H%M%S"), socket.gethostname(), os.getpid(),
+                                                   self.sequence, self.extension)
+        self.file = open(os.path.join(self.directory, self.segment), "ab")
+        return self.file
+
+    # Appends the pages recorded for a scrape of notice_id (published is its unix timestamp or None,
+    # item_ids the items in list order) and indexes them
+    def append(self, notice_id, published, item_ids, recording):
+        fetched_at = time.time()
+        with recording.lock:
+            pages = list(recording.pages)
+        frame = compress(self.extension, pack(notice_id, fetched_at, published, item_ids, pages))
+        with self.lock:
+            segment_file = self._segment()
+            offset = segment_file.tell()
+            segment_file.write(frame)
+            segment_file.flush()
+            self.index.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                               (notice_id, fetched_at, self.segment, offset, len(frame), len(pages)))
+        return fetched_at
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.index.close()
+
+
+# The newest record of every notice (fetched since the unix time `since`), as dicts of the index columns.
+# Empty while nothing was archived in directory.
+def latest(directory=ARCHIVE_DIR, since=None):
+    if not directory:
+        raise ValueError("Archiving is off, set ARCHIVE_DIR to the archive's directory")
+    if not os.path.exists(os.path.join(directory, "index.db")):
+        return []
+    index = open_index(directory)
+    try:
+        # SQLite takes the bare columns from the row holding the max
+        rows = index.execute("SELECT notice_id, max(fetched_at), segment, offset, length FROM records "
+                             "WHERE fetched_at >= ? GROUP BY notice_id ORDER BY notice_id",
+                             (since or 0,)).fetchall()
+    finally:
+        index.close()
+    return [dict(notice_id=row[0], fetched_at=row[1], segment=row[2], offset=row[3], length=row[4]) for row in rows]
+
+
+# (header, [(page description, body)]) of an entry returned by latest
+def read(entry, directory=ARCHIVE_DIR):
+    with open(os.path.join(directory, entry["segment"]), "rb") as fh:
+        fh.seek(entry["offset"])
+        frame = fh.read(entry["length"])
+    return unpack(decompress(entry["segment"].rsplit(".", 1)[1], frame))
+
+
+archive = None
+archive_lock = threading.Lock()
+
+
+# The process's archive, None when archiving is off
+def get_archive():
+    global archive
+    if not ARCHIVE_DIR:
+        return None
+    with archive_lock:
+        if archive is None:
+            archive = Archive(ARCHIVE_DIR)
+            logging.info("Archiving pages to {} ({})".format(ARCHIVE_DIR, archive.extension))
+        return archive
+
+
+# A Recording to pass to the fetchers, None when archiving is off
+def start_recording():
+    return Recording() if ARCHIVE_DIR else None
+
+
+# Archives a finished recording, a scrape doesn't fail when its pages can't be archived
+def save(notice_id, published, item_ids, recording):
+    if recording is None:
+        return
+    try:
+        get_archive().append(notice_id, published, item_ids, recording)
+    except Exception as e:
+        logging.warning("Pages of #{} not archived - {}".format(notice_id, str(e)))
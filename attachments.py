@@ -0,0 +1,228 @@
+# attachments.py
+# Streams notice attachments from the portal straight into the Cloud Storage bucket, several at a time,
+# without touching the local disk. Memory per attachment stays around UPLOAD_CHUNK_SIZE.
+# Files are stored once under objects/<sha256>; tenders.attachments maps (notice id, filename) to them.
+
+import io
+import os
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Table, Column, String, Text, BigInteger, MetaData, select
+
+# Downloads count against the portal's request limits
+from governor import governed
+# Session ids the portal puts into links
+from changes import SESSION_ID
+import metrics
+
+BUCKET_NAME = "tenders-attachments"
+# Directory used instead of the bucket when set, for local runs and benchmarks
+LOCAL_BUCKET = os.environ.get("LOCAL_BUCKET")
+# Attachments downloaded and uploaded at the same time
+ATTACHMENT_CONCURRENCY = int(os.environ.get("ATTACHMENT_CONCURRENCY", 4))
+# Resumable upload chunk, a multiple of 256 KB
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+DOWNLOAD_TIMEOUT = 60
+
+# Index of stored attachments
+index_metadata = MetaData(schema="tenders")
+attachments_table = Table('attachments', index_metadata,
+                          Column('notice_id', String, primary_key=True),
+                          Column('filename', String, primary_key=True),
+                          Column('sha256', String(64), nullable=False, index=True),
+                          Column('size', BigInteger),
+                          Column('source_url', Text, index=True))
+index_ready = set()
+index_lock = threading.Lock()
+
+
+def ensure_index(engine):
+    # Workers start together, only one of them creates the table
+    with index_lock:
+        if engine not in index_ready:
+            index_metadata.create_all(engine, checkfirst=True)
+            index_ready.add(engine)
+
+
+# url as it is indexed, without the portal session's id so it is the same in every session
+def source_url(url):
+    return SESSION_ID.sub("", url)
+
+
+# {source url: (sha256, size)} for the urls already stored by earlier notices, keyed by source_url(url)
+def known_sources(connection, urls):
+    if not urls:
+        return {}
+    query = select([attachments_table.c.source_url, attachments_table.c.sha256, attachments_table.c.size]) \
+        .where(attachments_table.c.source_url.in_(sorted(set(source_url(url) for url in urls))))
+    return dict((row[0], (row[1], row[2])) for row in connection.execute(query))
+
+
+def object_name(sha256):
+    return "objects/" + sha256
+
+
+class HashingReader:
+    """Hashes and counts what is read through it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+    def tell(self):
+        return self.size
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, *name.split("/"))
+        self.chunk_size = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def upload_from_file(self, file_obj, content_type=None, size=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as fh:
+            shutil.copyfileobj(file_obj, fh, self.chunk_size or UPLOAD_CHUNK_SIZE)
+
+    def download_as_bytes(self):
+        with open(self.path, "rb") as fh:
+            return fh.read()
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class LocalBucket:
+    """Filesystem stand-in for a storage bucket, objects are files under root."""
+
+    def __init__(self, root):
+        self.root = root
+        self.name = root
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        copy = destination_bucket.blob(new_name)
+        with open(blob.path, "rb") as fh:
+            copy.upload_from_file(fh)
+        return copy
+
+
+bucket = None
+bucket_lock = threading.Lock()
+
+
+# One storage client and bucket per process
+def get_bucket():
+    global bucket
+    with bucket_lock:
+        if bucket is None:
+            if LOCAL_BUCKET:
+                bucket = LocalBucket(LOCAL_BUCKET)
+            else:
+                # Google cloud storage library
+                from google.cloud import storage
+                bucket = storage.Client().bucket(BUCKET_NAME)
+        return bucket
+
+
+# GET of url through the governor, its raw stream undoing gzip/deflate transfer encoding
+def download(session, url):
+    response = governed(url, lambda: session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT))
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    response.raw.decode_content = True
+    return response
+
+
+# Stores the response body of url under its content hash and returns (sha256, size).
+# Bodies that fit in one chunk are hashed in memory and only uploaded when the object is missing. Larger
+# ones are hashed as they stream by first, so a file stored before costs one download and no upload; a new
+# one is downloaded again, streamed to a staging object and copied inside the bucket.
+def stream_to_bucket(bucket, session, url):
+    with download(session, url) as response:
+        size = response.headers.get("Content-Length")
+        if response.headers.get("Content-Encoding"):
+            size = None
+        content_type = response.headers.get("Content-Type")
+
+        if size is not None and int(size) <= UPLOAD_CHUNK_SIZE:
+            body = response.raw.read()
+            sha256 = hashlib.sha256(body).hexdigest()
+            blob = bucket.blob(object_name(sha256))
+            if not blob.exists():
+                blob.upload_from_file(io.BytesIO(body), content_type=content_type, size=len(body))
+            return sha256, len(body)
+
+        reader = HashingReader(response.raw)
+        while reader.read(UPLOAD_CHUNK_SIZE):
+            pass
+    sha256 = reader.hash.hexdigest()
+    if bucket.blob(object_name(sha256)).exists():
+        return sha256, reader.size
+
+    with download(session, url) as response:
+        reader = HashingReader(response.raw)
+        staging = bucket.blob("staging/" + str(uuid.uuid4()))
+        staging.chunk_size = UPLOAD_CHUNK_SIZE
+        staging.upload_from_file(reader, content_type=content_type, size=int(size) if size else None)
+    metrics.count("bytes_downloaded", reader.size, kind="attachment")
+
+    # The file may have changed between both downloads, it is stored under the hash of what was uploaded
+    sha256 = reader.hash.hexdigest()
+    try:
+        if not bucket.blob(object_name(sha256)).exists():
+            bucket.copy_blob(staging, bucket, object_name(sha256))
+    finally:
+        staging.delete()
+    return sha256, reader.size
+
+
+# attachments is a list of (name, url). Urls found in known (see known_sources) aren't downloaded again.
+# Returns (name, source url, sha256, size) of the stored ones, in order.
+def store_attachments(bucket, session, attachments, known=None, concurrency=ATTACHMENT_CONCURRENCY):
+    known = known or {}
+
+    @metrics.propagate
+    def store(attachment):
+        name, url = attachment
+        source = source_url(url)
+        if source in known:
+            logging.info('Attachment "{}" already stored as {}'.format(name, known[source][0]))
+            metrics.count("attachments", result="known")
+            return (name, source) + tuple(known[source])
+        try:
+            sha256, size = stream_to_bucket(bucket, session, url)
+        except Exception as e:
+            logging.warning('Attachment "{}" failed to upload - {}'.format(name, str(e)))
+            metrics.count("attachments", result="failed")
+            return None
+        metrics.count("attachments", result="stored")
+        metrics.count("bytes_downloaded", size, kind="attachment")
+        logging.info('Attachment "{}" stored as "{}".'.format(name, object_name(sha256)))
+        return name, source, sha256, size
+
+    if not attachments:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        return [stored for stored in executor.map(store, attachments) if stored is not None]
@@ -0,0 +1,292 @@
+# backfill.py
+# Captures the notices that already left the portal's list. A range of iRfxRound ids is split into shards,
+# every shards-th id each so that sparse old and dense new ids spread evenly, run by processes forked from
+# the startup.py fork server. scraper.build_notice probes each id with one plain HTTP request and scrapes the
+# existing notices on from that page; they are saved BACKFILL_BATCH ids at a time. A shard's position is saved
+# in the same transaction as its rows, an interrupted run resumes where it stopped. The processes split
+# governor.py's per-host limits between them. The notice pages carry no publication date, backfilled notices
+# are saved without one and search.py lists them after the dated ones.
+#
+#   python backfill.py <first id> <last id> [--shards 8] [--processes 2] [--run name] [--retry-failed]
+
+import os
+import sys
+import time
+import logging
+import argparse
+import datetime
+import threading
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sqlalchemy import Table, Column, String, Text, Integer, BigInteger, DateTime, MetaData, select, and_, func
+
+import scraper
+import startup
+import metrics
+import governor
+from runtime import get_engine, get_tables
+from database import save_notices, insert_ignore
+from attachments import ensure_index
+from changes import ensure_fingerprints
+from scanner import known_ids
+from fetcher import PORTAL_URL
+from workers import Worker
+
+# Shard processes, 0 runs the shards one after another in this process
+BACKFILL_PROCESSES = int(os.environ.get("BACKFILL_PROCESSES", 2))
+BACKFILL_SHARDS = int(os.environ.get("BACKFILL_SHARDS", 8))
+# Ids probed between two writes, and so between two checkpoints
+BACKFILL_BATCH = int(os.environ.get("BACKFILL_BATCH", 25))
+
+OUTCOMES = ("saved", "known", "missing", "failed")
+
+# Progress of the backfill runs
+state_metadata = MetaData(schema="tenders")
+shards_table = Table('backfill_shards', state_metadata,
+                     Column('run', String, primary_key=True),
+                     Column('shard', Integer, primary_key=True),
+                     Column('first_id', BigInteger, nullable=False),
+                     Column('last_id', BigInteger, nullable=False),
+                     Column('step', Integer, nullable=False),
+                     # Next id to probe, beyond last_id once the shard is done
+                     Column('next_id', BigInteger, nullable=False),
+                     Column('saved', Integer, nullable=False, default=0),
+                     Column('known', Integer, nullable=False, default=0),
+                     Column('missing', Integer, nullable=False, default=0),
+                     Column('failed', Integer, nullable=False, default=0),
+                     Column('updated_at', DateTime))
+failures_table = Table('backfill_failures', state_metadata,
+                       Column('run', String, primary_key=True),
+                       Column('notice_id', String, primary_key=True),
+                       Column('error', Text))
+state_ready = set()
+state_lock = threading.Lock()
+
+
+def ensure_state(engine):
+    with state_lock:
+        if engine not in state_ready:
+            state_metadata.create_all(engine, checkfirst=True)
+            state_ready.add(engine)
+
+
+# Creates the shards of run, or checks that the saved ones cover the same range. Returns the unfinished ones.
+def plan(engine, run, first, last, shards):
+    ensure_state(engine)
+    with engine.begin() as connection:
+        rows = connection.execute(select([shards_table]).where(shards_table.c.run == run)
+                                  .order_by(shards_table.c.shard)).fetchall()
+        if not rows:
+            rows = [dict(run=run, shard=shard, first_id=first + shard, last_id=last, step=shards,
+                         next_id=first + shard, saved=0, known=0, missing=0, failed=0)
+                    for shard in range(shards) if first + shard <= last]
+            connection.execute(shards_table.insert(), rows)
+            logging.info("Backfill {} planned: ids {} to {} in {} shards".format(run, first, last, len(rows)))
+        elif (rows[0]["first_id"], rows[0]["last_id"], rows[0]["step"]) != (first, last, shards):
+            raise ValueError("Backfill {} covers ids {} to {} in {} shards, use another run name".format(
+                run, rows[0]["first_id"], rows[0]["last_id"], rows[0]["step"]))
+        else:
+            logging.info("Resuming backfill {}".format(run))
+    return [row["shard"] for row in rows if row["next_id"] <= row["last_id"]]
+
+
+# {outcome: ids} summed over the shards of run
+def progress(engine, run):
+    with engine.connect() as connection:
+        row = connection.execute(select([func.sum(shards_table.c[outcome]) for outcome in OUTCOMES])
+                                 .where(shards_table.c.run == run)).first()
+    return dict((outcome, int(value or 0)) for outcome, value in zip(OUTCOMES, row))
+
+
+class Backfiller:
+    """Probes, scrapes and saves the ids of one run's shards, one shard at a time."""
+
+    def __init__(self, run, engine=None):
+        self.run = run
+        # Without an engine of its own the process-wide one from runtime.py is used
+        self.engine = engine if engine is not None else get_engine()
+        self.tables = get_tables(self.engine)
+        self.worker = Worker(self.engine)
+        ensure_state(self.engine)
+        ensure_index(self.engine)
+        ensure_fingerprints(self.engine)
+        self.worker.warm(self.engine)
+
+    # What build_notice returns for _id, None when the portal has no such notice. The notice page is loaded
+    # once, the scrape continues from the probe's page.
+    @metrics.recorded("backfill", lambda self, _id: dict(notice_id=_id))
+    def probe(self, _id):
+        return scraper.build_notice(_id, None, self.engine, self.worker.session, self.worker.fallback_browser,
+                                    probe=True)
+
+    # Probes ids, returns ({outcome: count}, records to save, [(id, error)])
+    def process(self, ids):
+        with self.engine.connect() as connection:
+            known = known_ids(connection, self.tables[0], ids)
+        counts = dict((outcome, 0) for outcome in OUTCOMES)
+        counts["known"] = len(known)
+        records = []
+        failures = []
+        for _id in ids:
+            if _id in known:
+                continue
+            try:
+                record = self.probe(_id)
+            except Exception as e:
+                logging.error("Backfill of #{} failed - {}".format(_id, str(e)))
+                failures.append((_id, str(e)))
+                counts["failed"] += 1
+                continue
+            finally:
+                self.worker.recycle_browser()
+                self.worker.reset_browser()
+            if record is None:
+                counts["missing"] += 1
+            else:
+                records.append(record)
+                counts["saved"] += 1
+        for outcome, count in counts.items():
+            metrics.count("backfill_ids", count, outcome=outcome)
+        return counts, records, failures
+
+    # Saves records and failures of a batch and runs checkpoint(connection) in the same transaction
+    def save(self, records, failures, checkpoint):
+        def write(connection):
+            if failures:
+                connection.execute(insert_ignore(connection, failures_table),
+                                   [dict(run=self.run, notice_id=_id, error=error) for _id, error in failures])
+            checkpoint(connection)
+
+        with self.engine.connect() as connection:
+            save_notices(connection, self.tables, records, write)
+
+    # Runs shard to its end, returns {outcome: count} of the ids it probed now
+    def run_shard(self, shard):
+        where = and_(shards_table.c.run == self.run, shards_table.c.shard == shard)
+        with self.engine.connect() as connection:
+            row = connection.execute(select([shards_table]).where(where)).first()
+        next_id, last_id, step = row["next_id"], row["last_id"], row["step"]
+
+        totals = dict((outcome, 0) for outcome in OUTCOMES)
+        started = time.time()
+        while next_id <= last_id:
+            ids = [str(_id) for _id in range(next_id, min(last_id, next_id + step * (BACKFILL_BATCH - 1)) + 1, step)]
+            counts, records, failures = self.process(ids)
+            next_id = int(ids[-1]) + step
+
+            def checkpoint(connection, next_id=next_id, counts=counts):
+                values = dict((outcome, shards_table.c[outcome] + counts[outcome]) for outcome in OUTCOMES)
+                connection.execute(shards_table.update().where(where).values(
+                    next_id=next_id, updated_at=datetime.datetime.utcnow(), **values))
+            self.save(records, failures, checkpoint)
+
+            for outcome in OUTCOMES:
+                totals[outcome] += counts[outcome]
+            elapsed = time.time() - started
+            logging.info("Backfill {} shard {}: {} ids left, {:.1f} ids/s, {}".format(
+                self.run, shard, len(range(next_id, last_id + 1, step)), sum(totals.values()) / elapsed, counts))
+        return totals
+
+    # Probes the failed ids of the run again, the ones that work out are forgotten
+    def retry_failed(self):
+        with self.engine.connect() as connection:
+            ids = [row[0] for row in connection.execute(
+                select([failures_table.c.notice_id]).where(failures_table.c.run == self.run))]
+        totals = dict((outcome, 0) for outcome in OUTCOMES)
+        for start in range(0, len(ids), BACKFILL_BATCH):
+            batch = ids[start:start + BACKFILL_BATCH]
+            counts, records, failures = self.process(batch)
+            still_failing = set(_id for _id, _ in failures)
+
+            def checkpoint(connection, done=[_id for _id in batch if _id not in still_failing]):
+                if done:
+                    connection.execute(failures_table.delete().where(
+                        and_(failures_table.c.run == self.run, failures_table.c.notice_id.in_(done))))
+            self.save(records, [], checkpoint)
+            for outcome in OUTCOMES:
+                totals[outcome] += counts[outcome]
+        return totals
+
+    def close(self):
+        self.worker.close()
+
+
+# The backfiller of a shard process
+process_backfiller = None
+
+
+def init_process(run, processes):
+    global process_backfiller
+    scraper.setup_logging()
+    # The processes together keep to the limits a single process has
+    governor.share(PORTAL_URL, processes)
+    process_backfiller = Backfiller(run)
+    multiprocessing.util.Finalize(process_backfiller, process_backfiller.close, exitpriority=10)
+
+
+def run_in_process(shard):
+    return process_backfiller.run_shard(shard)
+
+
+# Backfills ids first to last as run (named after the range by default). engine can only be given with
+# processes=0. Returns {outcome: count} of the ids probed now.
+def backfill(first, last, shards=BACKFILL_SHARDS, processes=BACKFILL_PROCESSES, run=None, engine=None):
+    if processes and engine is not None:
+        raise ValueError("Backfill processes open their own engine, none can be passed")
+    run = run or "{}-{}".format(first, last)
+    pending = plan(engine if engine is not None else get_engine(), run, first, last, shards)
+
+    totals = dict((outcome, 0) for outcome in OUTCOMES)
+    started = time.time()
+    if processes:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=startup.fork_server(),
+                                 initializer=init_process, initargs=(run, processes)) as executor:
+            futures = dict((executor.submit(run_in_process, shard), shard) for shard in pending)
+            for future in as_completed(futures):
+                counts = future.result()
+                logging.info("Backfill {} shard {} done: {}".format(run, futures[future], counts))
+                for outcome in OUTCOMES:
+                    totals[outcome] += counts[outcome]
+    else:
+        backfiller = Backfiller(run, engine)
+        try:
+            for shard in pending:
+                counts = backfiller.run_shard(shard)
+                for outcome in OUTCOMES:
+                    totals[outcome] += counts[outcome]
+        finally:
+            backfiller.close()
+
+    elapsed = time.time() - started
+    logging.info("Backfill {} probed {} ids in {:.0f} s ({:.1f} ids/s, {:.1f} notices/min): {}".format(
+        run, sum(totals.values()), elapsed, sum(totals.values()) / elapsed if elapsed else 0,
+        totals["saved"] / elapsed * 60 if elapsed else 0, totals))
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape the notices with ids first to last")
+    parser.add_argument("first", type=int)
+    parser.add_argument("last", type=int)
+    parser.add_argument("--shards", type=int, default=BACKFILL_SHARDS)
+    parser.add_argument("--processes", type=int, default=BACKFILL_PROCESSES)
+    parser.add_argument("--run", help="name of the run to start or resume, first-last by default")
+    parser.add_argument("--retry-failed", action="store_true", help="probe the failed ids of the run again")
+    args = parser.parse_args()
+
+    scraper.setup_logging()
+    try:
+        if args.retry_failed:
+            backfiller = Backfiller(args.run or "{}-{}".format(args.first, args.last))
+            try:
+                logging.info("Retried failed ids: {}".format(backfiller.retry_failed()))
+            finally:
+                backfiller.close()
+        else:
+            backfill(args.first, args.last, args.shards, args.processes, args.run)
+            logging.info("Backfill totals: {}".format(progress(get_engine(), args.run or "{}-{}".format(
+                args.first, args.last))))
+    except Exception as e:
+        logging.fatal(str(e))
+        sys.exit(1)
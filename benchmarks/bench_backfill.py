@@ -0,0 +1,76 @@
+# bench_backfill.py
+# Runs backfill.py over an id range of the local fixture portal, where only some ids are notices, with rows
+# going to SQLite (or --database-url). The run is repeated to show that a finished run resumes as done.
+#
+#   python benchmarks/bench_backfill.py --notices 50 --missing 50 --shards 4 [--latency 0.05]
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+import portal
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notices", type=int, default=50)
+    parser.add_argument("--missing", type=int, default=50, help="ids after the last notice, without a notice")
+    parser.add_argument("--items", type=int, default=5)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every portal response")
+    parser.add_argument("--database-url", help="local Postgres instead of SQLite")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="tenders-backfill-")
+    site = portal.Portal(args.notices, args.items, 16 * 1024, args.latency)
+    server, base_url = portal.serve(site)
+
+    # The pipeline modules read these when imported
+    os.environ["PORTAL_URL"] = base_url
+    os.environ["LOCAL_BUCKET"] = os.path.join(workdir, "bucket")
+    os.environ.setdefault("PORTAL_RATE", "0")
+    os.environ["BACKFILL_BATCH"] = str(args.batch)
+
+    import backfill
+    import standins
+    from sqlalchemy import select, func
+    from runtime import get_tables
+
+    if args.database_url:
+        engine = standins.postgres_engine(args.database_url)
+    else:
+        engine = standins.sqlite_engine(workdir)
+
+    first, last = portal.FIRST_ID + 1, portal.FIRST_ID + args.notices + args.missing
+    started = time.perf_counter()
+    totals = backfill.backfill(first, last, shards=args.shards, processes=0, engine=engine)
+    elapsed = time.perf_counter() - started
+    resumed = backfill.backfill(first, last, shards=args.shards, processes=0, engine=engine)
+    with engine.connect() as connection:
+        saved = connection.execute(select([func.count()]).select_from(get_tables(engine)[0])).scalar()
+    server.shutdown()
+
+    print("ids probed:         {}".format(sum(totals.values())))
+    print("outcomes:           {}".format(totals))
+    print("notices in db:      {}".format(saved))
+    print("portal requests:    {}".format(site.requests))
+    print("wall time:          {:.2f} s".format(elapsed))
+    print("ids/second:         {:.1f}".format(sum(totals.values()) / elapsed if elapsed else 0))
+    print("notices/minute:     {:.1f}".format(totals["saved"] / elapsed * 60 if elapsed else 0))
+    print("second run probed:  {}".format(sum(resumed.values())))
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# bench_export.py
+# Fills the tenders tables in SQLite (or --database-url) with generated notices, items and operators and times
+# export.py writing them as gzipped JSON lines and as Parquet. The peak of Python allocations is reported for
+# each, it should stay about the same whatever --notices is.
+#
+#   python benchmarks/bench_export.py --notices 20000 --items 10 [--format jsonl parquet]
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import datetime
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+
+def fill(engine, notices, items, operators=50, batch=1000):
+    from runtime import get_tables
+
+    notices_table, operators_table, items_table = get_tables(engine)
+    published = datetime.datetime(2026, 1, 1)
+    date = (lambda value: value) if engine.dialect.name == "postgresql" else (lambda value: value.isoformat(" "))
+    with engine.begin() as connection:
+        connection.execute(operators_table.insert(), [
+            dict(email="operator{}@example.com".format(n), first_name="Anna", last_name="Kowalska",
+                 city="Polkowice", phone="+48 76 000 00 00") for n in range(operators)])
+        for start in range(0, notices, batch):
+            ids = range(start, min(notices, start + batch))
+            connection.execute(notices_table.insert(), [
+                dict(id=str(n), date_published=date(published + datetime.timedelta(minutes=n)),
+                     deadline=date(published + datetime.timedelta(days=30)), tender_name="Dostawa czesci {}".format(n),
+                     category="Dostawy", base_currency="PLN", items_count=items,
+                     operator_email="operator{}@example.com".format(n % operators),
+                     tender_description="Opis postepowania " * 20, attachments=["SIWZ.pdf"],
+                     attachments_urls=["https://example.com/{}.pdf".format(n)], currencies=["PLN"]) for n in ids])
+            connection.execute(items_table.insert(), [
+                dict(id="{}-{}".format(n, i), notice_id=str(n), name="Pozycja {}".format(i), quantity="10",
+                     description="Opis pozycji " * 10, units="szt.") for n in ids for i in range(items)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notices", type=int, default=20000)
+    parser.add_argument("--items", type=int, default=10)
+    parser.add_argument("--format", nargs="+", default=["jsonl", "parquet"])
+    parser.add_argument("--database-url", help="local Postgres instead of SQLite")
+    args = parser.parse_args()
+
+    import export
+    import standins
+
+    workdir = tempfile.mkdtemp(prefix="tenders-export-")
+    if args.database_url:
+        engine = standins.postgres_engine(args.database_url)
+    else:
+        engine = standins.sqlite_engine(workdir)
+    fill(engine, args.notices, args.items)
+
+    print("notices:            {}".format(args.notices))
+    print("item rows:          {}".format(args.notices * args.items))
+    for format in args.format:
+        path = os.path.join(workdir, "notices." + ("parquet" if format == "parquet" else "jsonl.gz"))
+        tracemalloc.start()
+        started = time.perf_counter()
+        exported = export.export(engine, path, format)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("{:8} notices:   {}".format(format, exported))
+        print("{:8} time:      {:.2f} s ({:.0f} notices/s)".format(format, elapsed, exported / elapsed if elapsed else 0))
+        print("{:8} file:      {:.1f} MB".format(format, os.path.getsize(path) / 1024 / 1024))
+        print("{:8} peak:      {:.1f} MB".format(format, peak / 1024 / 1024))
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# bench_extract.py
+# Compares the single-pass extractor with one XPath per field (the way scraper.py used to read pages)
+# over the synthetic pages in benchmarks/fixtures (see benchmarks/portal.py).
+#
+#   python benchmarks/bench_extract.py [--rounds 2000]
+
+import os
+import sys
+import time
+import argparse
+
+from lxml import html
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+PAGES = [
+    ("notice.html", [extract.NOTICE_FIELDS]),
+    ("contact.html", [extract.CONTACT_FIELDS, extract.OPERATOR_FIELDS]),
+    ("item.html", [extract.ITEM_FIELDS]),
+]
+
+
+# The expression scraper.py evaluated for a field
+def legacy_xpath(tag, label, kind):
+    value = "/../*[2]" if kind == extract.SECOND else "/../td"
+    return 'normalize-space(string(//{}[contains(normalize-space(text()), "{}")]{}))'.format(tag, label, value)
+
+
+def legacy(tree, specs):
+    values = {}
+    for fields in specs:
+        for field, spec in fields.items():
+            values[field] = tree.xpath(legacy_xpath(*spec))
+    return values
+
+
+def single_pass(tree, specs):
+    index = extract.LabelIndex(tree)
+    values = {}
+    for fields in specs:
+        values.update(index.extract(fields))
+    return values
+
+
+def run(method, trees, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for tree, specs in trees:
+            method(tree, specs)
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=2000, help="times every page is read by each method")
+    rounds = parser.parse_args().rounds
+
+    trees = []
+    for name, specs in PAGES:
+        with open(os.path.join(FIXTURES, name), "rb") as fh:
+            trees.append((html.fromstring(fh.read()), specs))
+
+    # Both approaches have to read the same values
+    for tree, specs in trees:
+        expected, actual = legacy(tree, specs), single_pass(tree, specs)
+        for field in expected:
+            if expected[field] != actual[field]:
+                sys.exit("Mismatch on {}: {!r} != {!r}".format(field, expected[field], actual[field]))
+
+    legacy_ms = run(legacy, trees, rounds)
+    single_ms = run(single_pass, trees, rounds)
+    print("pages per round:      {}".format(len(trees)))
+    print("one XPath per field:  {:.3f} ms/round".format(legacy_ms))
+    print("single pass:          {:.3f} ms/round".format(single_ms))
+    print("speedup:              {:.1f}x".format(legacy_ms / single_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# bench_pipeline.py
+# Runs scanner.py and scraper.py end to end without GCP or the live portal: pages come from the local
+# fixture server, rows go to SQLite (or --database-url), tasks to a fake client, attachments to a directory.
+#
+#   python benchmarks/bench_pipeline.py --notices 100 --items 20 --workers 4 [--latency 0.05]
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import resource
+import threading
+import json
+from urllib.parse import urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+import portal
+
+
+class Timings:
+    """Latency samples per stage, collected from any thread."""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    # Replaces module.name with a wrapper timing every call as stage
+    def wrap(self, module, name, stage):
+        function = getattr(module, name)
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        setattr(module, name, timed)
+
+    def report(self):
+        lines = ["{:<22}{:>7}{:>10}{:>10}{:>10}{:>10}".format("stage", "calls", "p50 ms", "p90 ms", "p99 ms", "max ms")]
+        for stage, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            lines.append("{:<22}{:>7}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                stage, len(samples), percentile(samples, 50) * 1000, percentile(samples, 90) * 1000,
+                percentile(samples, 99) * 1000, samples[-1] * 1000))
+        return "\n".join(lines)
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+# (id, published) of every notice in the recorded tasks, GET and batched POST tasks alike
+def tasks_to_jobs(tasks):
+    jobs = []
+    for task in tasks:
+        request = task["http_request"]
+        if request["http_method"] == "POST":
+            jobs.extend((notice["id"], notice["published"]) for notice in json.loads(request["body"])["notices"])
+        else:
+            id_, published = urlparse(request["url"]).path.rstrip("/").split("/")[-2:]
+            jobs.append((id_, published))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notices", type=int, default=50)
+    parser.add_argument("--items", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every portal response")
+    parser.add_argument("--attachment-kb", type=int, default=200)
+    parser.add_argument("--database-url", help="local Postgres instead of SQLite")
+    parser.add_argument("--queue", choices=("tasks", "local"), default="tasks",
+                        help="fake Cloud Tasks client, or the SQLite job queue run by the worker pool")
+    parser.add_argument("--reparse", action="store_true",
+                        help="archive the fetched pages and re-parse them afterwards, without the portal")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="tenders-bench-")
+    site = portal.Portal(args.notices, args.items, args.attachment_kb * 1024, args.latency)
+    server, base_url = portal.serve(site)
+
+    # The pipeline modules read these when imported
+    os.environ["PORTAL_URL"] = base_url
+    os.environ["LOCAL_BUCKET"] = os.path.join(workdir, "bucket")
+    os.environ["BASEURL"] = "http://localhost/scrape/"
+    # Unlimited unless PORTAL_RATE is given, to measure the pipeline rather than the politeness limit
+    os.environ.setdefault("PORTAL_RATE", "0")
+    if args.queue == "local":
+        os.environ["QUEUE_BACKEND"] = "local"
+        os.environ["LOCAL_QUEUE_PATH"] = os.path.join(workdir, "jobs.db")
+    if args.reparse:
+        os.environ["ARCHIVE_DIR"] = os.path.join(workdir, "archive")
+
+    started = time.perf_counter()
+    import scanner
+    import scraper
+    import workers
+    import standins
+    import jobqueue
+    import metrics
+    from operators import operator_cache
+    timings = Timings()
+    timings.add("import", time.perf_counter() - started)
+
+    timings.wrap(scanner, "fetch_with_fallback", "scan: list pages")
+    timings.wrap(scanner, "known_ids", "scan: dedupe query")
+    timings.wrap(scraper, "fetch_with_fallback", "scrape: pages")
+    timings.wrap(scraper, "store_attachments", "scrape: attachments")
+    timings.wrap(scraper, "save_notice", "scrape: db write")
+
+    if args.database_url:
+        engine = standins.postgres_engine(args.database_url)
+    else:
+        engine = standins.sqlite_engine(workdir)
+    metrics.instrument_engine(engine)
+    scanner.engine = engine
+
+    tasks_client = standins.LocalTasksClient() if args.queue == "tasks" else None
+    started = time.perf_counter()
+    notices = scanner.scan(tasks_client)
+    timings.add("scan", time.perf_counter() - started)
+
+    if args.queue == "local":
+        pool = workers.ScraperPool(workers=args.workers, queue=args.workers, engine=engine)
+        started = time.perf_counter()
+        runner = jobqueue.start_runner(lambda: pool)
+        # Failed jobs wait for their retry, they count as failures here
+        while runner.queue.due() or runner.queue.stats().get(jobqueue.LEASED):
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        runner.stop()
+        jobs = notices
+        failures = len(notices) - runner.queue.stats().get(jobqueue.DONE, 0)
+    else:
+        jobs = tasks_to_jobs(tasks_client.tasks)
+        pool = workers.ScraperPool(workers=args.workers, queue=len(jobs), engine=engine)
+        failures = 0
+        started = time.perf_counter()
+        futures = [pool.submit(id_, published) for id_, published in jobs]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                logging.error(str(e))
+        elapsed = time.perf_counter() - started
+    pool.shutdown()
+    server.shutdown()
+
+    if args.reparse:
+        requests_before = site.requests
+        started = time.perf_counter()
+        reparsed, _, reparse_failures = scraper.reparse(processes=0, engine=engine)
+        reparse_elapsed = time.perf_counter() - started
+
+    print("notices scheduled:  {}".format(len(jobs)))
+    print("notices failed:     {}".format(failures))
+    print("portal requests:    {}".format(site.requests))
+    print("scrape wall time:   {:.2f} s".format(elapsed))
+    print("notices/minute:     {:.1f}".format((len(jobs) - failures) / elapsed * 60 if elapsed else 0))
+    # ru_maxrss is in kilobytes on Linux
+    print("peak RSS:           {:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    print("operator cache:     {}".format(operator_cache.stats()))
+    if args.reparse:
+        print("re-parsed:          {} ({} failed, {} portal requests)".format(
+            reparsed, reparse_failures, site.requests - requests_before))
+        print("re-parsed/second:   {:.1f}".format(reparsed / reparse_elapsed if reparse_elapsed else 0))
+    print()
+    print(timings.report())
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# bench_startup.py
+# Cold start of the service, every sample in a fresh interpreter:
+#   - first response of the health check with the libraries loaded lazily, and with everything imported
+#     up front the way main.py used to
+#   - first job of a scraper process forked from the prewarmed fork server, and of a freshly spawned one
+#
+#   python benchmarks/bench_startup.py [--samples 5]
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+HEALTH_CHECK = """
+import time
+started = time.perf_counter()
+{imports}
+import main
+main.app.test_client().get("/")
+print((time.perf_counter() - started) * 1000)
+"""
+
+EAGER = "import startup\nfor name in startup.LIBRARIES + startup.MODULES:\n    __import__(name)"
+
+FIRST_JOB = """
+import time
+import startup
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+if {forked}:
+    context = startup.fork_server()
+    time.sleep(3)  # the fork server is started with the app, well before the first scrape
+else:
+    context = multiprocessing.get_context("spawn")
+started = time.perf_counter()
+with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+    executor.submit(startup.prewarm).result()
+print((time.perf_counter() - started) * 1000)
+"""
+
+
+def sample(code, samples):
+    times = []
+    for _ in range(samples):
+        output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=os.environ, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(times), max(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=5, help="fresh interpreters started per measurement")
+    samples = parser.parse_args().samples
+
+    rows = [
+        ("health check, lazy imports", sample(HEALTH_CHECK.format(imports=""), samples)),
+        ("health check, eager imports", sample(HEALTH_CHECK.format(imports=EAGER), samples)),
+        ("first job, forked warm", sample(FIRST_JOB.format(forked=True), samples)),
+        ("first job, spawned cold", sample(FIRST_JOB.format(forked=False), samples)),
+    ]
+    print("{:<32}{:>12}{:>12}".format("", "median ms", "max ms"))
+    for name, (median, longest) in rows:
+        print("{:<32}{:>12.1f}{:>12.1f}".format(name, median, longest))
+
+    # What the warm process imported and how long each import took
+    output = subprocess.run([sys.executable, "-c", "import json, startup; print(json.dumps(startup.prewarm()))"],
+                            cwd=ROOT, env=os.environ, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    print()
+    for name, ms in json.loads(output.strip().splitlines()[-1])["imports_ms"]:
+        print("{:<32}{:>12}".format(name, "failed" if ms is None else "{:.1f}".format(ms)))
+
+
+if __name__ == "__main__":
+    main()
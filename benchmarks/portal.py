@@ -0,0 +1,146 @@
+# portal.py
+# Local stand-in for www.swz.kghm.pl serving the pages in benchmarks/fixtures. Those are synthetic: written
+# by hand after the portal's layout as the scraper's XPaths and JS_ASSIGNMENT read it, not captured from the
+# portal, so runs against them show the pipeline's own costs but can't prove the HTTP form replay still
+# matches the live site. The notice list and the item grids are filled from templates so any number of
+# notices and items can be served.
+
+import os
+import time
+import hashlib
+import datetime
+import threading
+from string import Template
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIRST_ID = 458000
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf8") as fh:
+        return fh.read()
+
+
+def page_size_options(selected):
+    return "\n".join('      <option value="{0}"{1}>{0}</option>'.format(size, " selected" if size == selected else "")
+                     for size in (10, 25, 50, 100))
+
+
+class Portal:
+    """What the portal lists: `notices` notices with `items` items each, newest first."""
+
+    def __init__(self, notices=50, items=5, attachment_size=200 * 1024, latency=0.0):
+        self.items = items
+        self.attachment_size = attachment_size
+        # Seconds added to every response, to mimic the real round trip
+        self.latency = latency
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        self.notices = [(str(FIRST_ID + notices - i), now - datetime.timedelta(hours=i)) for i in range(notices)]
+        self.ids = set(id_ for id_, _ in self.notices)
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.templates = dict((name, fixture(name + ".html"))
+                              for name in ("list", "notice", "contact", "offer", "item"))
+
+    def list_page(self, params):
+        size = int(params.get("GD_pagesize", 10))
+        page = int(params.get("GD_page", 1))
+        rows = []
+        for number, (id_, published) in enumerate(self.notices[(page - 1) * size:page * size], (page - 1) * size + 1):
+            deadline = published + datetime.timedelta(days=14 + number % 7)
+            rows.append('    <tr onmouseover="this.className=\'hover\'"><td>{}</td><td>Postępowanie {}</td>'
+                        '<td>KGHM Polska Miedź S.A.</td><td>{:%Y-%m-%d %H:%M}</td><td>{:%Y-%m-%d %H:%M}</td>'
+                        '<td><a href="/rfx/rfx/HomeServlet?MP_module=outErfx&amp;MP_action=supplierStatus&amp;iRfxRound={}">'
+                        '<img src="/pic/mp/details.gif"></a></td></tr>'.format(number, id_, published, deadline, id_))
+        pager = ""
+        if page * size < len(self.notices):
+            pager = ('<a title="Następna strona" href="/servlet/HomeServlet?MP_module=main&amp;MP_action=noticeList'
+                     '&amp;demandType=nonpublic&amp;GD_pagesize={}&amp;GD_page={}">&gt;</a>'.format(size, page + 1))
+        return Template(self.templates["list"]).substitute(
+            options=page_size_options(size), rows="\n".join(rows), pager=pager)
+
+    def offer_page(self, id_, params):
+        size = int(params.get("GD_pagesize", 10))
+        page = int(params.get("GD_page", 1))
+        rows = []
+        for number in range((page - 1) * size, min(page * size, self.items)):
+            rows.append('      <tr class="dataRow" id="{}"><td>{}</td><td>Pozycja {}</td><td>1</td></tr>'.format(
+                int(id_) * 1000 + number, number + 1, number + 1))
+        pager = ""
+        if page * size < self.items:
+            pager = ('<a title="Następna strona" href="/rfx/rfx/HomeServlet?MP_module=outErfx&amp;MP_action=outerPositions'
+                     '&amp;iRfxRound={}&amp;GD_pagesize={}&amp;GD_page={}">&gt;</a>'.format(id_, size, page + 1))
+        return Template(self.templates["offer"]).substitute(
+            id=id_, options=page_size_options(size), rows="\n".join(rows), pager=pager)
+
+    def attachment(self, file_id):
+        block = hashlib.sha256(file_id.encode()).digest() * 32
+        return (block * (self.attachment_size // len(block) + 1))[:self.attachment_size]
+
+    # Returns (content type, body) for a request
+    def respond(self, path, params):
+        with self.lock:
+            self.requests += 1
+        action = params.get("MP_action")
+        id_ = params.get("iRfxRound", "")
+        if path.endswith("FileDownload"):
+            return "application/octet-stream", self.attachment(params.get("fileId", ""))
+        if action == "noticeList":
+            body = self.list_page(params)
+        elif action == "supplierStatus" and id_ not in self.ids:
+            # The portal's answer for ids without a notice
+            body = "<html><body><p>Brak postępowania o podanym identyfikatorze.</p></body></html>"
+        elif action == "supplierStatus":
+            body = self.templates["notice"].replace('value="458987"', 'value="{}"'.format(id_))
+        elif action == "supplierContact":
+            body = self.templates["contact"].replace('value="458987"', 'value="{}"'.format(id_))
+        elif action == "outerPositions":
+            body = self.offer_page(id_, params)
+        elif action == "outerPositionDetails":
+            body = self.templates["item"]
+        else:
+            return None
+        return "text/html; charset=UTF-8", body.encode("utf8")
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self, form):
+        url = urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        params.update(form)
+        if self.server.portal.latency:
+            time.sleep(self.server.portal.latency)
+        response = self.server.portal.respond(url.path, params)
+        if response is None:
+            self.send_error(404)
+            return
+        content_type, body = response
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf8"))
+        self.handle_request(dict((key, values[-1]) for key, values in form.items()))
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serves portal on a free local port in a background thread, returns (server, base url)
+def serve(portal):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.portal = portal
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
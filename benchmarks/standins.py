@@ -0,0 +1,90 @@
+# standins.py
+# Local stand-ins for the GCP services: the tenders schema in SQLite (or a local Postgres),
+# plus re-exports of the fake tasks client and the directory-backed bucket.
+
+import os
+
+from sqlalchemy import Table, Column, String, Text, Integer, Boolean, DateTime, MetaData, JSON, create_engine, event
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from enqueue import LocalTasksClient
+from attachments import LocalBucket
+
+
+# The tables scraper.py reflects, with column types the given dialect understands
+def tenders_metadata(dialect):
+    if dialect == "postgresql":
+        date, array = DateTime, ARRAY(Text)
+    else:
+        # SQLite's DateTime only accepts datetime objects, the scraper passes strings for date_published
+        date, array = Text, JSON
+    metadata = MetaData(schema="tenders")
+    Table('operators', metadata,
+          Column('email', String, primary_key=True),
+          Column('first_name', String),
+          Column('last_name', String),
+          Column('address', String),
+          Column('city', String),
+          Column('postcode', String),
+          Column('phone', String))
+    Table('notices', metadata,
+          Column('id', String, primary_key=True),
+          Column('date_published', date),
+          Column('deadline', date),
+          Column('tender_name', Text),
+          Column('tender_number', String),
+          Column('supplier_status', String),
+          Column('stage_number', String),
+          Column('source_doc', String),
+          Column('items_count', Integer),
+          Column('base_currency', String),
+          Column('operator_email', String),
+          Column('organisational_unit', Text),
+          Column('tender_description', Text),
+          Column('category', Text),
+          Column('is_framework_agreement', Boolean),
+          Column('offer_deadline', date),
+          Column('questions_deadline', date),
+          Column('offers_validity_period', Integer),
+          Column('submitting_offers_type', Text),
+          Column('language_of_publication', String),
+          Column('terms_of_participation', Text),
+          Column('contract_provisions', Text),
+          Column('attachments', array),
+          Column('attachments_urls', array),
+          Column('currencies', array))
+    Table('items', metadata,
+          Column('id', String, primary_key=True),
+          Column('notice_id', String, index=True),
+          Column('name', Text),
+          Column('quantity', String),
+          Column('description', Text),
+          Column('units', String),
+          Column('supply_date', String),
+          Column('bid_bond_amount_percent', Integer))
+    return metadata
+
+
+# SQLite database in directory with the tenders schema attached as its own file
+def sqlite_engine(directory):
+    engine = create_engine("sqlite:///" + os.path.join(directory, "main.db"),
+                           connect_args={"check_same_thread": False, "timeout": 60})
+
+    @event.listens_for(engine, "connect")
+    def attach(dbapi_connection, connection_record):
+        dbapi_connection.execute("ATTACH DATABASE ? AS tenders", (os.path.join(directory, "tenders.db"),))
+
+    tenders_metadata("sqlite").create_all(engine)
+    return engine
+
+
+# Local Postgres given by url, the tenders schema is created when missing
+def postgres_engine(url):
+    engine = create_engine(url, pool_pre_ping=True)
+    with engine.connect() as connection:
+        connection.execute("CREATE SCHEMA IF NOT EXISTS tenders")
+    tenders_metadata("postgresql").create_all(engine)
+    return engine
+
+
+__all__ = ["tenders_metadata", "sqlite_engine", "postgres_engine", "LocalTasksClient", "LocalBucket"]
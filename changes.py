@@ -0,0 +1,113 @@
+# changes.py
+# Change detection for notices that are already saved. A fingerprint of the notice and contact pages
+# (detail fields and attachment list) is kept per notice; a recheck fetches only those two pages and the
+# full scrape runs again only when the fingerprint moved. Updates then touch the changed columns and rows.
+
+import os
+import re
+import json
+import hashlib
+import datetime
+import threading
+
+from sqlalchemy import Table, Column, String, DateTime, MetaData, select, and_, or_
+
+# Open notices are rechecked at most this often
+RECHECK_INTERVAL = int(os.environ.get("RECHECK_INTERVAL", 6 * 3600))
+# Notices rechecked per /recheck call
+RECHECK_BATCH = int(os.environ.get("RECHECK_BATCH", 100))
+# Seconds a /recheck call keeps starting rechecks, the rest are left for the next call. Stays well under
+# gunicorn's 90 s --timeout, the rechecks already started still have to finish.
+RECHECK_BUDGET = int(os.environ.get("RECHECK_BUDGET", 45))
+
+fingerprint_metadata = MetaData(schema="tenders")
+fingerprints_table = Table('notice_fingerprints', fingerprint_metadata,
+                           Column('notice_id', String, primary_key=True),
+                           Column('fingerprint', String(64), nullable=False),
+                           Column('checked_at', DateTime, index=True),
+                           Column('changed_at', DateTime))
+fingerprints_ready = set()
+fingerprints_lock = threading.Lock()
+
+# Session ids the portal may put into links
+SESSION_ID = re.compile(";jsessionid=[^?#]*", re.IGNORECASE)
+
+# Columns a re-scrape never changes
+FIXED_COLUMNS = ("id", "date_published")
+
+
+def ensure_fingerprints(engine):
+    with fingerprints_lock:
+        if engine not in fingerprints_ready:
+            fingerprint_metadata.create_all(engine, checkfirst=True)
+            fingerprints_ready.add(engine)
+
+
+# sha256 of the notice's detail fields (currency included), its name and its (name, url) attachments. The
+# values are already whitespace-normalized by extract.py.
+def fingerprint(fields, tender_name, attachments):
+    attachments = [[name, SESSION_ID.sub("", url)] for name, url in attachments]
+    content = json.dumps([sorted(fields.items()), tender_name, attachments],
+                         ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+
+def read_fingerprint(connection, notice_id):
+    return connection.execute(select([fingerprints_table.c.fingerprint])
+                              .where(fingerprints_table.c.notice_id == notice_id)).scalar()
+
+
+# Stores the fingerprint seen now, changed tells whether it differs from the stored one
+def write_fingerprint(connection, notice_id, value, changed):
+    now = datetime.datetime.utcnow()
+    values = dict(fingerprint=value, checked_at=now)
+    if changed:
+        values["changed_at"] = now
+    result = connection.execute(fingerprints_table.update()
+                                .where(fingerprints_table.c.notice_id == notice_id).values(**values))
+    if result.rowcount == 0:
+        values.setdefault("changed_at", now)
+        connection.execute(fingerprints_table.insert().values(notice_id=notice_id, **values))
+
+
+# Ids of up to limit notices still open for offers and not checked for RECHECK_INTERVAL,
+# never checked ones first
+def due_notices(connection, notices_table, limit=RECHECK_BATCH):
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=RECHECK_INTERVAL)
+    # Deadlines are saved in the portal's local time
+    now = datetime.datetime.now()
+    query = select([notices_table.c.id]) \
+        .select_from(notices_table.outerjoin(fingerprints_table, fingerprints_table.c.notice_id == notices_table.c.id)) \
+        .where(and_(or_(notices_table.c.deadline == None, notices_table.c.deadline > now),
+                    or_(fingerprints_table.c.checked_at == None, fingerprints_table.c.checked_at < stale))) \
+        .order_by(fingerprints_table.c.checked_at.isnot(None), fingerprints_table.c.checked_at) \
+        .limit(limit)
+    return [str(row[0]) for row in connection.execute(query)]
+
+
+# Columns of notice whose value differs from the saved row
+def changed_columns(row, notice):
+    return dict((column, value) for column, value in notice.items()
+                if column not in FIXED_COLUMNS and row[column] != value)
+
+
+# Rows of items to delete (their ids) and to insert, items are compared on the columns a scrape fills
+# but their id (saved rows also have database-maintained ones like search.py's)
+def item_changes(saved, items):
+    columns = set(column for item in items for column in item) - {"id"}
+
+    def key(item):
+        return tuple(sorted((column, str(item.get(column))) for column in columns))
+
+    remaining = {}
+    for item in saved:
+        remaining.setdefault(key(item), []).append(item["id"])
+    inserted = []
+    for item in items:
+        ids = remaining.get(key(item))
+        if ids:
+            ids.pop()
+        else:
+            inserted.append(item)
+    deleted = [id_ for ids in remaining.values() for id_ in ids]
+    return deleted, inserted
@@ -0,0 +1,135 @@
+# chrome.py
+# Headless Chrome set up for the fallback fetcher. Pages are only read through page_source, so images,
+# stylesheets, fonts and media are blocked, extensions and background traffic are off and navigations
+# return once the DOM is ready. A worker keeps one browser for many notices and clears its cookies between
+# them; the bytes each page transferred and the memory of the browser are recorded in metrics.py.
+
+import os
+import logging
+
+import metrics
+
+# Resource types not loaded, comma separated: image, stylesheet, font, media
+BROWSER_BLOCK = [kind for kind in os.environ.get("BROWSER_BLOCK", "image,stylesheet,font,media").split(",") if kind]
+# eager returns from a navigation once the DOM is parsed, normal waits for every subresource
+BROWSER_PAGE_LOAD = os.environ.get("BROWSER_PAGE_LOAD", "eager")
+BROWSER_WINDOW = os.environ.get("BROWSER_WINDOW", "1024,768")
+
+# URL patterns of the blocked resource types. Scripts stay, the portal's links and pagers are javascript.
+BLOCKED_URLS = {
+    "image": ["*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.webp*", "*.svg*", "*.ico*", "*.bmp*"],
+    "stylesheet": ["*.css*"],
+    "font": ["*.woff*", "*.ttf*", "*.otf*", "*.eot*"],
+    "media": ["*.mp4*", "*.webm*", "*.mp3*", "*.ogg*", "*.wav*"],
+}
+# --headless, --disable-gpu and --no-sandbox are required to make it work in a Docker container
+ARGUMENTS = [
+    "--headless",
+    "--disable-gpu",
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-background-timer-throttling",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--no-first-run",
+]
+
+# Upper bounds in bytes of the per page transfer histogram
+BYTE_BUCKETS = (16384, 65536, 262144, 1048576, 4194304, 16777216)
+# Upper bounds in MB of the browser memory histogram
+RSS_BUCKETS = (100, 200, 300, 400, 500, 700, 1000, 1500)
+
+# Bytes the current document and its subresources came over the network with, from the Resource Timing API
+TRANSFERRED = """
+return performance.getEntriesByType("navigation").concat(performance.getEntriesByType("resource"))
+    .reduce(function (total, entry) { return total + (entry.transferSize || 0); }, 0);
+"""
+
+
+def chrome_options():
+    from selenium import webdriver
+
+    options = webdriver.ChromeOptions()
+    for argument in ARGUMENTS:
+        options.add_argument(argument)
+    options.add_argument("--window-size={}".format(BROWSER_WINDOW))
+    if "image" in BROWSER_BLOCK:
+        # Holds even where the DevTools protocol isn't available
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    return options
+
+
+def start_browser():
+    # Selenium is only imported once the HTTP path failed, it isn't needed for most notices
+    from selenium import webdriver
+    import chromedriver_binary  # Adds chromedriver binary to path
+
+    driver = webdriver.Chrome(options=chrome_options(),
+                              desired_capabilities={"pageLoadStrategy": BROWSER_PAGE_LOAD})
+    urls = [url for kind in BROWSER_BLOCK for url in BLOCKED_URLS.get(kind, [])]
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": urls})
+    except Exception as e:
+        logging.warning("Resources not blocked through DevTools - {}".format(str(e)))
+    return driver
+
+
+# Clears every cookie of the browser, so that the next notice starts a fresh portal session
+def clear_cookies(driver):
+    try:
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+    except Exception:
+        # Without DevTools only the cookies of the current domain can be deleted, the portal's
+        driver.delete_all_cookies()
+
+
+# Resident memory in MB of a process and all of its descendants, read from /proc
+def process_tree_rss(pid):
+    children = {}
+    rss = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/status".format(entry)) as fh:
+                status = dict(line.split(":", 1) for line in fh if ":" in line)
+        except (IOError, ValueError):
+            continue
+        children.setdefault(int(status["PPid"].strip()), []).append(int(entry))
+        rss[int(entry)] = int(status.get("VmRSS", "0 kB").split()[0])
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        total += rss.get(current, 0)
+        pending.extend(children.get(current, []))
+    return total / 1024
+
+
+# Memory in MB of chromedriver and the browser processes under it
+def browser_rss(driver):
+    return process_tree_rss(driver.service.process.pid)
+
+
+# Records what the page loaded in driver cost, source is its page_source. Returns the bytes transferred.
+def record_page(driver, source):
+    try:
+        transferred = int(driver.execute_script(TRANSFERRED))
+    except Exception:
+        # Documents without resource timing count with their source
+        transferred = len(source)
+    metrics.count("bytes_downloaded", transferred, kind="browser")
+    metrics.observe("browser_page_bytes", transferred, buckets=BYTE_BUCKETS)
+    try:
+        metrics.observe("browser_rss_mb", browser_rss(driver), buckets=RSS_BUCKETS)
+    except Exception:
+        pass
+    return transferred
@@ -0,0 +1,216 @@
+# database.py
+# Writes a scraped notice with its operator and items in one transaction, or applies the differences
+# of a re-scraped one
+
+import io
+import os
+import logging
+import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from attachments import attachments_table
+from operators import operator_cache
+from changes import read_fingerprint, write_fingerprint, changed_columns, item_changes, fingerprints_table
+
+# Above this many items they are sent with COPY instead of a multi-row insert (Postgresql only)
+ITEMS_COPY_THRESHOLD = int(os.environ.get("ITEMS_COPY_THRESHOLD", 500))
+
+
+# INSERT ... ON CONFLICT DO NOTHING for the dialects that have it
+def insert_ignore(connection, table):
+    if connection.dialect.name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if connection.dialect.name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return table.insert()
+
+
+# INSERT ... ON CONFLICT (keys) DO UPDATE of the other columns, a plain insert elsewhere
+def upsert(connection, table, values, keys):
+    if connection.dialect.name == "postgresql":
+        statement = postgresql.insert(table).values(**values)
+    elif connection.dialect.name == "sqlite":
+        statement = sqlite.insert(table).values(**values)
+    else:
+        return table.insert().values(**values)
+    changes = dict((column, statement.excluded[column]) for column in values if column not in keys)
+    return statement.on_conflict_do_update(index_elements=list(keys), set_=changes)
+
+
+# notice with the time it is written in saved_at, once `python export.py migrate` added that column;
+# incremental exports continue from the last saved_at they exported
+def stamped(notices_table, notice, now=None):
+    if "saved_at" not in notices_table.c:
+        return notice
+    return dict(notice, saved_at=now or datetime.datetime.utcnow())
+
+
+# Writes operator unless the cache knows it with the same details. Returns whether it was written;
+# the caller remembers it once the transaction committed.
+def save_operator(connection, operators_table, operator):
+    if operator_cache.known(operator):
+        return False
+    connection.execute(upsert(connection, operators_table, operator, ["email"]))
+    return True
+
+
+# Streams rows to COPY ... FROM STDIN through the connection's own psycopg2 cursor and transaction
+def copy_rows(connection, table, rows):
+    columns = list(rows[0].keys())
+    buffer = io.StringIO()
+    for row in rows:
+        # Quoted values stay strings (even empty ones), an unquoted empty field is NULL
+        buffer.write(",".join("" if row[column] is None else '"' + str(row[column]).replace('"', '""') + '"'
+                              for column in columns) + "\n")
+    buffer.seek(0)
+
+    statement = "COPY {}.{} ({}) FROM STDIN WITH (FORMAT csv)".format(
+        table.schema, table.name, ", ".join(columns))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    finally:
+        cursor.close()
+
+
+# Saves everything or nothing. Returns False when the notice was already saved, e.g. by an earlier
+# attempt of the same task, in which case its items are left as they are.
+def save_notice(connection, tables, notice, operator, items, attachments=(), fingerprint=None):
+    notices_table, operators_table, items_table = tables
+
+    with connection.begin():
+        operator_written = save_operator(connection, operators_table, operator)
+
+        result = connection.execute(insert_ignore(connection, notices_table).values(**stamped(notices_table, notice)))
+        if result.rowcount == 0:
+            logging.info('Notice #{} was already saved'.format(notice["id"]))
+            saved = False
+        else:
+            if not items:
+                pass
+            elif len(items) >= ITEMS_COPY_THRESHOLD and connection.dialect.name == "postgresql":
+                copy_rows(connection, items_table, items)
+            else:
+                connection.execute(items_table.insert(), items)
+
+            # (notice id, filename) -> content hash of the stored attachments
+            if attachments:
+                connection.execute(insert_ignore(connection, attachments_table), list(attachments))
+
+            if fingerprint is not None:
+                write_fingerprint(connection, notice["id"], fingerprint, changed=True)
+            saved = True
+
+    if operator_written:
+        operator_cache.remember(operator)
+    return saved
+
+
+# Saves many scraped notices at once, records as returned by scraper.build_notice: multi-row inserts
+# in one transaction, with checkpoint(connection) run in it too when given. Notices saved already are
+# left as they are. Returns the ids of the notices saved now.
+def save_notices(connection, tables, records, checkpoint=None):
+    notices_table, operators_table, items_table = tables
+
+    with connection.begin():
+        operators = dict((record["operator"]["email"], record["operator"]) for record in records)
+        written = [operator for operator in operators.values()
+                   if save_operator(connection, operators_table, operator)]
+
+        ids = [record["notice"]["id"] for record in records]
+        existing = set(row[0] for row in connection.execute(
+            select([notices_table.c.id]).where(notices_table.c.id.in_(ids)))) if ids else set()
+        new = [record for record in records if record["notice"]["id"] not in existing]
+        now = datetime.datetime.utcnow()
+        if new:
+            connection.execute(insert_ignore(connection, notices_table),
+                               [stamped(notices_table, record["notice"], now) for record in new])
+
+            items = [item for record in new for item in record["items"]]
+            if not items:
+                pass
+            elif len(items) >= ITEMS_COPY_THRESHOLD and connection.dialect.name == "postgresql":
+                copy_rows(connection, items_table, items)
+            else:
+                connection.execute(items_table.insert(), items)
+
+            attachments = [attachment for record in new for attachment in record["attachments"]]
+            if attachments:
+                connection.execute(insert_ignore(connection, attachments_table), attachments)
+
+            fingerprints = [dict(notice_id=record["notice"]["id"], fingerprint=record["fingerprint"], checked_at=now,
+                                 changed_at=now) for record in new if record["fingerprint"] is not None]
+            if fingerprints:
+                connection.execute(insert_ignore(connection, fingerprints_table), fingerprints)
+
+        if checkpoint is not None:
+            checkpoint(connection)
+
+    for operator in written:
+        operator_cache.remember(operator)
+    return [record["notice"]["id"] for record in new]
+
+
+# Brings a saved notice in line with a new scrape of it: only the columns, items and attachments that
+# differ are written. Returns {"columns": [...], "items_deleted": n, "items_inserted": n,
+# "attachments": [...]}, or None when the notice wasn't saved yet (it is saved as a new one then).
+def update_notice(connection, tables, notice, operator, items, attachments=(), fingerprint=None):
+    notices_table, operators_table, items_table = tables
+    _id = notice["id"]
+
+    with connection.begin():
+        query = select([notices_table]).where(notices_table.c.id == _id)
+        if connection.dialect.name == "postgresql":
+            query = query.with_for_update()
+        row = connection.execute(query).first()
+        if row is None:
+            saved = None
+        else:
+            operator_written = save_operator(connection, operators_table, operator)
+
+            columns = changed_columns(row, notice)
+            if columns:
+                connection.execute(notices_table.update().where(notices_table.c.id == _id).values(**columns))
+
+            saved_items = [dict(item) for item in connection.execute(
+                select([items_table]).where(items_table.c.notice_id == _id))]
+            deleted, inserted = item_changes(saved_items, items)
+            if deleted:
+                connection.execute(items_table.delete().where(items_table.c.id.in_(deleted)))
+            if inserted:
+                connection.execute(items_table.insert(), inserted)
+
+            # Attachments are keyed by filename, a file whose content changed is replaced
+            stored = dict((row[0], row[1]) for row in connection.execute(
+                select([attachments_table.c.filename, attachments_table.c.sha256])
+                .where(attachments_table.c.notice_id == _id)))
+            current = dict((attachment["filename"], attachment) for attachment in attachments)
+            replaced = [name for name in stored if name not in current or current[name]["sha256"] != stored[name]]
+            if replaced:
+                connection.execute(attachments_table.delete().where(
+                    (attachments_table.c.notice_id == _id) & attachments_table.c.filename.in_(replaced)))
+            added = [attachment for name, attachment in current.items() if name not in stored or name in replaced]
+            if added:
+                connection.execute(attachments_table.insert(), added)
+
+            modified = bool(columns or deleted or inserted or replaced or added)
+            if modified and "saved_at" in notices_table.c:
+                # Exported again by the next incremental export, items and attachments included
+                connection.execute(notices_table.update().where(notices_table.c.id == _id)
+                                   .values(saved_at=datetime.datetime.utcnow()))
+
+            if fingerprint is not None:
+                # A notice without a stored fingerprint only counts as changed when a column or row did
+                previous = read_fingerprint(connection, _id)
+                write_fingerprint(connection, _id, fingerprint,
+                                  changed=modified or (previous is not None and previous != fingerprint))
+            saved = dict(columns=sorted(columns), items_deleted=len(deleted), items_inserted=len(inserted),
+                         attachments=sorted(set(replaced) | set(attachment["filename"] for attachment in added)))
+
+    if saved is None:
+        save_notice(connection, tables, notice, operator, items, attachments, fingerprint)
+    elif operator_written:
+        operator_cache.remember(operator)
+    return saved
@@ -0,0 +1,151 @@
+# enqueue.py
+# Creates the Cloud Tasks that call back into /scrape. Tasks are submitted concurrently from a bounded
+# thread pool and retried on transient errors; several notices can be packed into one task.
+
+import os
+import json
+import time
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# create_task calls in flight at once
+ENQUEUE_CONCURRENCY = int(os.environ.get("ENQUEUE_CONCURRENCY", 8))
+# Attempts per task before giving up on it
+ENQUEUE_RETRIES = int(os.environ.get("ENQUEUE_RETRIES", 4))
+# Notices packed into one task, 1 keeps the original GET /scrape/<id>/<timestamp> tasks
+TASK_BATCH_SIZE = int(os.environ.get("TASK_BATCH_SIZE", 1))
+
+transient = None
+
+
+# Errors of client's create_task worth retrying. api_core's are imported on first use, and only for the real
+# client, so the local one runs without the Google libraries.
+def transient_errors(client):
+    global transient
+    if isinstance(client, LocalTasksClient):
+        return LocalTasksClient.transient
+    if transient is None:
+        from google.api_core import exceptions
+        transient = (exceptions.ServiceUnavailable, exceptions.DeadlineExceeded, exceptions.InternalServerError,
+                     exceptions.TooManyRequests, exceptions.ResourceExhausted, exceptions.Aborted)
+    return transient
+
+
+# schedule_time of a task due at the UTC datetime when: a protobuf Timestamp for Cloud Tasks, the datetime
+# itself for the local client
+def schedule_time(client, when):
+    if isinstance(client, LocalTasksClient):
+        return when
+    from google.protobuf import timestamp_pb2
+    timestamp = timestamp_pb2.Timestamp()
+    timestamp.FromDatetime(when)
+    return timestamp
+
+
+class LocalTasksClient:
+    """Stands in for tasks_v2.CloudTasksClient: records tasks instead of sending them."""
+
+    class Response:
+        def __init__(self, name):
+            self.name = name
+
+    # What a local create_task may raise that is worth retrying
+    transient = (ConnectionError, TimeoutError)
+
+    def __init__(self):
+        self.tasks = []
+        self.lock = threading.Lock()
+
+    def queue_path(self, project, location, queue):
+        return "projects/{}/locations/{}/queues/{}".format(project, location, queue)
+
+    def create_task(self, parent, task):
+        with self.lock:
+            self.tasks.append(task)
+            return self.Response("{}/tasks/{}".format(parent, len(self.tasks)))
+
+
+# Splits notices into lists of at most size notices
+def batches(notices, size):
+    size = max(1, size)
+    return [notices[i:i + size] for i in range(0, len(notices), size)]
+
+
+class TaskEnqueuer:
+    """Schedules scrapes of (id, published) notices, returns the notices whose task was created."""
+
+    def __init__(self, client, parent, base_url, concurrency=ENQUEUE_CONCURRENCY, retries=ENQUEUE_RETRIES,
+                 batch_size=TASK_BATCH_SIZE):
+        self.client = client
+        self.parent = parent
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.batch_size = batch_size
+
+    def build_task(self, batch, in_seconds):
+        if len(batch) == 1:
+            id_, published = batch[0]
+            # Construct the request body.
+            task = {
+                'http_request': {  # Specify the type of request.
+                    'http_method': 'GET',
+                    'url': self.base_url + str(id_) + '/' + str(published)  # The full url path that the task will be sent to.
+                }
+            }
+        else:
+            # POST /scrape fans the notices out on the local workers
+            payload = {"notices": [{"id": str(id_), "published": str(published)} for id_, published in batch]}
+            task = {
+                'http_request': {
+                    'http_method': 'POST',
+                    'url': self.base_url.rstrip('/'),
+                    'headers': {'Content-type': 'application/json'},
+                    # The API expects a payload of type bytes.
+                    'body': json.dumps(payload).encode()
+                }
+            }
+
+        if in_seconds is not None:
+            # Convert "seconds from now" into the time the task is due.
+            d = datetime.datetime.utcnow() + datetime.timedelta(seconds=in_seconds)
+
+            # Add the timestamp to the tasks.
+            task['schedule_time'] = schedule_time(self.client, d)
+        return task
+
+    def _create(self, batch, in_seconds):
+        task = self.build_task(batch, in_seconds)
+        retry_on = transient_errors(self.client)
+        # Every task is tried at least once
+        attempts = max(1, self.retries)
+        for attempt in range(1, attempts + 1):
+            try:
+                response = self.client.create_task(self.parent, task)
+            except retry_on as e:
+                if attempt == attempts:
+                    raise
+                logging.warning("Creating task for {} failed, retrying - {}".format([id_ for id_, _ in batch], str(e)))
+                time.sleep(min(2 ** attempt * 0.25, 5))
+            else:
+                logging.info('Created task {} for tenders {} at {}'.format(
+                    response.name, ", ".join("#" + str(id_) for id_, _ in batch), task['http_request']['url']))
+                return batch
+
+    # offsets[i] is the delay in seconds of notices[i]; a batch starts at the offset of its first notice
+    def enqueue(self, notices, offsets):
+        jobs = []
+        for start, batch in zip(range(0, len(notices), max(1, self.batch_size)), batches(notices, self.batch_size)):
+            jobs.append((batch, offsets[start]))
+
+        created = []
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            futures = [(batch, executor.submit(self._create, batch, in_seconds)) for batch, in_seconds in jobs]
+            for batch, future in futures:
+                try:
+                    created.extend(future.result())
+                except Exception as e:
+                    logging.error("Couldn't create task for {} - {}".format([id_ for id_, _ in batch], str(e)))
+        return created
@@ -0,0 +1,351 @@
+# export.py
+# Bulk export of the notices with their operator and items, for analysis outside the service. Rows are read
+# through a server-side cursor (stream_results) in EXPORT_CHUNK row batches and written out as they come,
+# as gzipped JSON lines (one notice per line, items nested) or, with pyarrow installed, as Parquet streamed
+# one row group of EXPORT_ROW_GROUP notices at a time; memory stays flat whatever the size of the tables.
+# Incremental exports continue after the last one of the same name: `python export.py migrate` adds a
+# saved_at column that database.py sets whenever a notice or its items are written, so notices scraped late,
+# backfilled without a publication date or updated by a recheck are all exported by the next one.
+#
+#   python export.py <file> [--format jsonl|parquet] [--since date] [--incremental] [--name default]
+#   python export.py migrate
+
+import os
+import sys
+import json
+import zlib
+import logging
+import argparse
+import datetime
+import threading
+from itertools import groupby
+
+from sqlalchemy import Table, Column, String, DateTime, MetaData, Integer, BigInteger, SmallInteger, Boolean, \
+    Float, Numeric, JSON, Index, inspect, select, tuple_, or_, text
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from runtime import get_engine, get_tables
+
+# Rows fetched from the server-side cursor at a time
+EXPORT_CHUNK = int(os.environ.get("EXPORT_CHUNK", 2000))
+# Notices per Parquet row group
+EXPORT_ROW_GROUP = int(os.environ.get("EXPORT_ROW_GROUP", 5000))
+# Incremental exports leave out notices saved less than this many seconds ago, so a transaction still
+# committing with an earlier saved_at isn't passed by the watermark
+EXPORT_SETTLE = int(os.environ.get("EXPORT_SETTLE", 120))
+FORMATS = ("jsonl", "parquet")
+# Columns maintained by the database, not exported
+SKIPPED_COLUMNS = ("search",)
+
+# Where the incremental exports got to
+state_metadata = MetaData(schema="tenders")
+export_state_table = Table('export_state', state_metadata,
+                           Column('name', String, primary_key=True),
+                           Column('saved_at', DateTime),
+                           Column('notice_id', String),
+                           Column('exported_at', DateTime))
+state_ready = set()
+state_lock = threading.Lock()
+
+
+class ExportNotReady(Exception):
+    pass
+
+
+def ensure_state(engine):
+    with state_lock:
+        if engine not in state_ready:
+            state_metadata.create_all(engine, checkfirst=True)
+            state_ready.add(engine)
+
+
+# Adds tenders.notices.saved_at and its index. Notices saved before keep a NULL one, the first incremental
+# export of every name includes them.
+def migrate(engine):
+    if "saved_at" not in [column["name"] for column in inspect(engine).get_columns("notices", schema="tenders")]:
+        logging.info("Adding saved_at to tenders.notices")
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE tenders.notices ADD COLUMN saved_at TIMESTAMP"))
+    notices_table = Table('notices', MetaData(schema="tenders"), autoload=True, autoload_with=engine)
+    Index("notices_saved_at", notices_table.c.saved_at, notices_table.c.id).create(engine, checkfirst=True)
+    logging.info("Export column and index are in place")
+
+
+# pyarrow and pyarrow.parquet, only Parquet exports need them
+def arrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportNotReady("Parquet exports need pyarrow (pip install pyarrow)")
+    return pyarrow, pyarrow.parquet
+
+
+def require_saved_at(notices_table):
+    if "saved_at" not in notices_table.c:
+        raise ExportNotReady("Incremental exports need tenders.notices.saved_at, run `python export.py migrate`")
+
+
+# Raises ExportNotReady when an export in format can't run here
+def check_ready(engine, format, incremental):
+    if format not in FORMATS:
+        raise ValueError("Unknown export format {}".format(format))
+    if incremental:
+        require_saved_at(get_tables(engine)[0])
+    if format == "parquet":
+        arrow()
+
+
+# (saved_at, notice id) the last export called name ended at, None before the first
+def read_watermark(connection, name):
+    row = connection.execute(select([export_state_table.c.saved_at, export_state_table.c.notice_id])
+                             .where(export_state_table.c.name == name)).first()
+    return None if row is None else (row[0], row[1])
+
+
+def write_watermark(connection, name, saved_at, notice_id):
+    values = dict(saved_at=saved_at, notice_id=notice_id, exported_at=datetime.datetime.utcnow())
+    result = connection.execute(export_state_table.update().where(export_state_table.c.name == name).values(**values))
+    if result.rowcount == 0:
+        connection.execute(export_state_table.insert().values(name=name, **values))
+
+
+def exported_columns(table):
+    return [column for column in table.c if column.name not in SKIPPED_COLUMNS]
+
+
+# Notices matching the conditions as dicts with an "operator" dict and an "items" list, in order (then by id).
+# Reads the joined rows through a server-side cursor.
+def notice_records(connection, tables, conditions, order):
+    notices_table, operators_table, items_table = tables
+    notice_columns = exported_columns(notices_table)
+    operator_columns = exported_columns(operators_table)
+    item_columns = exported_columns(items_table)
+    query = select(notice_columns + [column.label("operator__" + column.name) for column in operator_columns] +
+                   [column.label("item__" + column.name) for column in item_columns]) \
+        .select_from(notices_table
+                     .outerjoin(operators_table, operators_table.c.email == notices_table.c.operator_email)
+                     .outerjoin(items_table, items_table.c.notice_id == notices_table.c.id)) \
+        .order_by(order, notices_table.c.id, items_table.c.id)
+    for condition in conditions:
+        query = query.where(condition)
+
+    result = connection.execution_options(stream_results=True).execute(query)
+    rows = (row for chunk in iter(lambda: result.fetchmany(EXPORT_CHUNK), []) for row in chunk)
+    for _, notice_rows in groupby(rows, key=lambda row: row[notices_table.c.id.name]):
+        notice_rows = list(notice_rows)
+        first = notice_rows[0]
+        record = dict((column.name, first[column.name]) for column in notice_columns)
+        operator = dict((column.name, first["operator__" + column.name]) for column in operator_columns)
+        record["operator"] = operator if operator.get("email") is not None else None
+        record["items"] = [dict((column.name, row["item__" + column.name]) for column in item_columns)
+                           for row in notice_rows if row["item__id"] is not None]
+        yield record
+
+
+# Yields the notice records of an export: all of them by publication date, or with incremental the ones
+# saved since the last incremental export called name, by saved_at; that one moves the watermark once every
+# record was consumed. since (an ISO date) keeps the notices published from then on.
+def exported(engine, since=None, incremental=False, name="default"):
+    notices_table = get_tables(engine)[0]
+    conditions = []
+    order = notices_table.c.date_published
+    after = None
+    if since is not None:
+        conditions.append(notices_table.c.date_published >= since)
+    if incremental:
+        require_saved_at(notices_table)
+        ensure_state(engine)
+        order = notices_table.c.saved_at
+        settled = notices_table.c.saved_at <= datetime.datetime.utcnow() - datetime.timedelta(seconds=EXPORT_SETTLE)
+        with engine.connect() as connection:
+            after = read_watermark(connection, name)
+        if after is None:
+            # Notices saved before the migration have no saved_at, they go out with the first export
+            conditions.append(or_(notices_table.c.saved_at == None, settled))
+        else:
+            # Leaves out the NULL saved_at rows too, the first export had them
+            conditions.append(settled)
+            conditions.append(tuple_(notices_table.c.saved_at, notices_table.c.id) > tuple_(*after))
+
+    count = 0
+    last = None
+    unsaved = None
+    with engine.connect() as connection:
+        for record in notice_records(connection, get_tables(engine), conditions, order):
+            count += 1
+            if incremental and record["saved_at"] is not None:
+                last = (record["saved_at"], record["id"])
+            elif incremental:
+                unsaved = max(unsaved or "", record["id"])
+            yield record
+
+    if incremental and after is None and last is None:
+        # Only notices without saved_at (or none at all) went out, the watermark still records that the first
+        # export is done so the next one doesn't send them again
+        last = (datetime.datetime.min, unsaved or "")
+    if last is not None:
+        with engine.connect() as connection:
+            write_watermark(connection, name, *last)
+    logging.info("Exported {} notices{}".format(count, "" if last is None else ", up to #{} saved at {}".format(
+        last[1], last[0])))
+
+
+def json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+# Gzip stream of records as JSON lines, in chunks of about EXPORT_CHUNK lines
+def jsonl_chunks(records):
+    # wbits 31 writes the gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, default=json_default, ensure_ascii=False))
+        if len(lines) >= EXPORT_CHUNK:
+            chunk = compressor.compress(("\n".join(lines) + "\n").encode("utf-8"))
+            lines = []
+            if chunk:
+                yield chunk
+    if lines:
+        yield compressor.compress(("\n".join(lines) + "\n").encode("utf-8"))
+    yield compressor.flush()
+
+
+def arrow_type(column):
+    import pyarrow as pa
+
+    kind = column.type
+    if isinstance(kind, (ARRAY, JSON)):
+        return pa.list_(pa.string())
+    if isinstance(kind, Boolean):
+        return pa.bool_()
+    if isinstance(kind, (Integer, BigInteger, SmallInteger)):
+        return pa.int64()
+    if isinstance(kind, (Float, Numeric)):
+        return pa.float64()
+    if isinstance(kind, DateTime):
+        return pa.timestamp("us")
+    return pa.string()
+
+
+# Parquet schema of the records, from the column types of the tables
+def arrow_schema(tables):
+    import pyarrow as pa
+
+    notices_table, operators_table, items_table = tables
+    fields = [pa.field(column.name, arrow_type(column)) for column in exported_columns(notices_table)]
+    fields.append(pa.field("operator", pa.struct([pa.field(column.name, arrow_type(column))
+                                                  for column in exported_columns(operators_table)])))
+    fields.append(pa.field("items", pa.list_(pa.struct([pa.field(column.name, arrow_type(column))
+                                                        for column in exported_columns(items_table)]))))
+    return pa.schema(fields)
+
+
+class ChunkSink:
+    """Write-only file for the Parquet writer, handing over what was written since the last take()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Parquet file of records, yielded one row group of EXPORT_ROW_GROUP notices at a time. Parquet files are
+# written front to back with the footer last, so nothing has to be kept or seeked back to.
+def parquet_chunks(records, tables):
+    pa, pq = arrow()
+    schema = arrow_schema(tables)
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    group = []
+    for record in records:
+        group.append(record)
+        if len(group) >= EXPORT_ROW_GROUP:
+            writer.write_table(pa.Table.from_pylist(group, schema=schema))
+            group = []
+            yield sink.take()
+    if group:
+        writer.write_table(pa.Table.from_pylist(group, schema=schema))
+    writer.close()
+    yield sink.take()
+
+
+# The bytes of records exported in format
+def chunks(records, format, tables):
+    if format == "parquet":
+        return parquet_chunks(records, tables)
+    return jsonl_chunks(records)
+
+
+# Exports to the file at path, returns the number of notices written
+def export(engine, path, format="jsonl", since=None, incremental=False, name="default"):
+    check_ready(engine, format, incremental)
+    count = [0]
+
+    def counted(records):
+        for record in records:
+            count[0] += 1
+            yield record
+
+    records = counted(exported(engine, since, incremental, name))
+    with open(path, "wb") as fh:
+        for chunk in chunks(records, format, get_tables(engine)):
+            fh.write(chunk)
+    return count[0]
+
+
+# (format, since, incremental, name) of the query string arguments of /export
+def export_args(args):
+    format = args.get("format", "jsonl")
+    if format not in FORMATS:
+        raise ValueError("format must be one of {}".format(", ".join(FORMATS)))
+    since = args.get("since") or None
+    if since is not None:
+        try:
+            datetime.datetime.fromisoformat(since)
+        except ValueError:
+            raise ValueError("since must be an ISO date, not {}".format(since))
+    return format, since, args.get("incremental") in ("1", "true"), args.get("name") or "default"
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["migrate"]:
+        migrate(get_engine())
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Export the notices with their operators and items")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--since", help="only notices published from this ISO date on")
+    parser.add_argument("--incremental", action="store_true", help="only notices saved since the last export's")
+    parser.add_argument("--name", default="default", help="watermark of incremental exports")
+    args = parser.parse_args()
+
+    try:
+        export(get_engine(), args.path, args.format, args.since, args.incremental, args.name)
+    except Exception as e:
+        logging.fatal(str(e))
+        sys.exit(1)
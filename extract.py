@@ -0,0 +1,122 @@
+# extract.py
+# Reads the labelled fields of portal pages in one walk over the document. Every th/span label cell
+# is visited once and its normalized text kept with its row; fields are then looked up from the
+# declarative specs below instead of running one full-document XPath per field.
+
+import re
+
+from lxml import etree
+
+# Value taken from the label's row: the row's second element, or its first td
+SECOND = "second"
+TD = "td"
+
+# field: (label tag, text the label contains, value)
+NOTICE_FIELDS = {
+    "deadline": ("th", "Data i godzina zakończenia czasu na składanie ofert", SECOND),
+    "tender_number": ("span", "Numer postępowania", SECOND),
+    "supplier_status": ("span", "Status oferenta", SECOND),
+    "stage_number": ("span", "Numer etapu", SECOND),
+    "source_doc": ("span", "Dokument źródłowy", SECOND),
+    "items_count": ("span", "Liczba koszyków/ części w", SECOND),
+    "base_currency": ("th", "Waluta postępowania", SECOND),
+}
+
+CONTACT_FIELDS = {
+    "operator_email": ("th", "Email", SECOND),
+    "organisational_unit": ("th", "Jednostka organizacyjna", SECOND),
+    "tender_description": ("th", "Opis postępowania", SECOND),
+    "category": ("th", "Grupa asortymentowa", SECOND),
+    "is_framework_agreement": ("th", "Czy umowa ramowa?", SECOND),
+    "offer_deadline": ("th", "Data i godzina", SECOND),
+    "questions_deadline": ("th", "Ostateczny termin", SECOND),
+    "offer_validity_period": ("th", "Wymagany termin", SECOND),
+    "submitting_offers_type": ("th", "Możliwość składania ofert", SECOND),
+    "language_of_publication": ("th", "Język publikacji", SECOND),
+    "terms_of_participation": ("th", "Warunki udziału w postępowaniu", SECOND),
+    "contract_provisions": ("th", "Postanowienia umowy/ zlecenia", SECOND),
+}
+
+OPERATOR_FIELDS = {
+    "first_name": ("th", "Imię", TD),
+    "last_name": ("th", "Nazwisko", TD),
+    "address": ("th", "Ulica", TD),
+    "city": ("th", "Miejscowość", TD),
+    "postcode": ("th", "Kod pocztowy", TD),
+    "email": ("th", "Email", TD),
+    "phone": ("th", "Telefon", TD),
+}
+
+ITEM_FIELDS = {
+    "name": ("th", "Nazwa", SECOND),
+    "quantity": ("th", "Ilość", SECOND),
+    "description": ("th", "Opis", SECOND),
+    "units": ("th", "Jednostka miary", SECOND),
+    "supply_date": ("th", "Termin wykonania", SECOND),
+    "bid_bond_amount_percent": ("th", "Wysokość należytego zabezpieczenia wykonania umowy w %", SECOND),
+}
+
+# Fields that aren't a label/value row keep a precompiled XPath
+TENDER_NAME = etree.XPath('normalize-space(string(//*[contains(concat(" ", normalize-space(@class), " "), " main ")]//h2))')
+CURRENCY = etree.XPath(
+    'normalize-space(string(//th[contains(normalize-space(text()), "Dostępne waluty")]/../td//table//tr[2]/td[1]))')
+ATTACHMENT_LINKS = etree.XPath('//table[contains(@class, "mp_gridTable")]//a[contains(@href, "FileDownload")]')
+ITEM_ROWS = etree.XPath('//table[contains(@class, "mp_gridTable")]//tr[contains(@class, "dataRow")]')
+
+# XPath's normalize-space only collapses these four characters (not e.g. &nbsp;)
+SPACES = re.compile("[ \t\r\n]+")
+
+
+def normalize_space(text):
+    return SPACES.sub(" ", text).strip(" ")
+
+
+def text_content(element):
+    return "".join(element.itertext())
+
+
+# First text node among the element's children, like text() inside contains()
+def first_text(element):
+    if element.text is not None:
+        return element.text
+    for child in element:
+        if child.tail is not None:
+            return child.tail
+    return ""
+
+
+class LabelIndex:
+    """Label cells of one document in document order, with their values computed on demand."""
+
+    def __init__(self, tree):
+        self.labels = []
+        for element in tree.iter("th", "span"):
+            self.labels.append((element.tag, normalize_space(first_text(element)), element))
+        self.found = {}
+
+    def value(self, tag, label, kind):
+        key = (tag, label, kind)
+        if key not in self.found:
+            self.found[key] = ""
+            for label_tag, text, element in self.labels:
+                if label_tag != tag or label not in text:
+                    continue
+                row = element.getparent()
+                if row is None:
+                    continue
+                if kind == TD:
+                    cells = [child for child in row if child.tag == "td"]
+                else:
+                    cells = [child for child in row if isinstance(child.tag, str)][1:]
+                if cells:
+                    self.found[key] = normalize_space(text_content(cells[0]))
+                    break
+        return self.found[key]
+
+    def extract(self, fields):
+        return dict((field, self.value(*spec)) for field, spec in fields.items())
+
+
+# Returns {field: normalized text} for the given spec, reusing index if the page was already walked
+def extract(tree, fields, index=None):
+    return (index or LabelIndex(tree)).extract(fields)
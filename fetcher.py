@@ -0,0 +1,308 @@
+# fetcher.py
+# Loads pages from the KGHM portal. Plain HTTP through a pooled requests.Session is tried first;
+# headless Chrome is only started when a page doesn't contain the markers we expect.
+
+import os
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import html
+
+# Per-host request limits shared by the whole process
+from governor import governed, BACKOFF_STATUSES
+import metrics
+# Lean headless Chrome for the fallback
+from chrome import start_browser, clear_cookies, record_page
+
+# Portal root, pointed at a local fixture server by the benchmarks
+PORTAL_URL = os.environ.get("PORTAL_URL", "https://www.swz.kghm.pl").rstrip("/")
+# Link containing all tenders
+LIST_LINK = PORTAL_URL + "/servlet/HomeServlet?MP_module=main&MP_action=noticeList&demandType=nonpublic"
+# Link to a single notice, the notice id is appended
+NOTICE_LINK = PORTAL_URL + "/rfx/rfx/HomeServlet?MP_module=outErfx&MP_action=supplierStatus&iRfxRound="
+# Link to the details of an item (position) of a notice
+ITEM_LINK = PORTAL_URL + "/rfx/servlet/HomeServlet?MP_module=outErfx&MP_action=outerPositionDetails&iRequestPosition={}&iRfxRound={}"
+
+# Links clicked on the notice page
+CONTACT_LINK = '//a[contains(@title, "Pokaż dane kontaktowe")]'
+OFFER_LINK = '//a[contains(normalize-space(text()), "Oferta")]'
+# Pager link to the next page of a list
+NEXT_PAGE_LINK = '//a[contains(@title, "Następna") or normalize-space(text())=">" or normalize-space(text())="»"]'
+
+# Markers proving that a page holds the data we are about to parse
+NOTICE_MARKER = '//span[contains(normalize-space(text()), "Numer postępowania")]'
+CONTACT_MARKER = '//th[contains(normalize-space(text()), "Email")]'
+PAGE_SIZE_MARKER = '//select[contains(@name, "GD_pagesize")]'
+ITEM_MARKER = '//th[contains(normalize-space(text()), "Nazwa")]'
+LIST_MARKER = '//table[contains(@class, "bodybox")]'
+# What a page is, by the marker it was loaded with, for archive.py. Other pages belong to item lists.
+PAGE_KINDS = {NOTICE_MARKER: "notice", CONTACT_MARKER: "contact", ITEM_MARKER: "item"}
+
+# Item pages fetched at the same time, the request rate is set per host in governor.py
+ITEM_CONCURRENCY = int(os.environ.get("ITEM_CONCURRENCY", 4))
+# Seconds the browser waits for a page to be ready and show its marker
+BROWSER_WAIT = float(os.environ.get("BROWSER_WAIT", 15))
+# Times a GET answered with an overload status (429, 5xx) is sent again, each time through the governor
+STATUS_RETRIES = int(os.environ.get("STATUS_RETRIES", 2))
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/93.0.4577.63 Safari/537.36"
+
+# Picks `field.value = 'x'` assignments out of javascript: links
+JS_ASSIGNMENT = re.compile(r"""([A-Za-z_][\w]*)\.value\s*=\s*['"]([^'"]*)['"]""")
+
+
+class MarkerNotFound(Exception):
+    pass
+
+
+def page_size_marker(size):
+    return '//select[contains(@name, "GD_pagesize")]/option[@value="{}"][@selected]'.format(size)
+
+
+# One session per worker, connections to www.swz.kghm.pl are kept alive and reused. The adapter only retries
+# failed connections; 429 and 5xx answers go back to the governor, which backs off and honours Retry-After.
+def create_session(pool_size=10, retries=3):
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(), raise_on_status=False,
+                  respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+# Waits up to timeout seconds for the element at xpath to be on the browser's page
+def wait_for_element(browser, xpath, timeout=5):
+    # Selenium essentials
+    from selenium.webdriver.support.ui import WebDriverWait as wait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.common.by import By
+
+    return wait(browser, timeout).until(EC.presence_of_element_located((By.XPATH, xpath)))
+
+
+# Waits until the page replacing `previous` (an element of the old page, if any) finished loading and
+# shows marker. Returns without raising on timeout, the marker check after it reports the failure.
+def wait_for_page(browser, marker, previous=None, timeout=BROWSER_WAIT):
+    from selenium.webdriver.support.ui import WebDriverWait as wait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.common.by import By
+    from selenium.common.exceptions import TimeoutException
+
+    try:
+        if previous is not None:
+            # Form posts replace the whole document, the clicked element goes stale first
+            wait(browser, min(timeout, 5)).until(EC.staleness_of(previous))
+        # With the eager page load strategy the DOM is all there is to wait for, readyState stays interactive
+        wait(browser, timeout).until(lambda driver: driver.execute_script("return document.readyState") != "loading"
+                                     and driver.find_elements(By.XPATH, marker))
+    except TimeoutException:
+        pass
+
+
+# Parses a page body the way its Content-Type header says
+def parse_body(content_type, body):
+    charset = re.search(r"charset=([\w-]+)", content_type, re.IGNORECASE)
+    # Without an explicit charset let lxml read the <meta> tag instead of guessing latin-1
+    if charset:
+        try:
+            return html.fromstring(body.decode(charset.group(1), errors="replace"))
+        except LookupError:
+            pass
+    return html.fromstring(body)
+
+
+def parse_response(response):
+    return parse_body(response.headers.get("Content-Type", ""), response.content)
+
+
+class HttpFetcher:
+    """Walks the portal with plain HTTP requests, replaying the javascript steps as form posts."""
+
+    def __init__(self, session=None, timeout=30):
+        self.session = session or create_session()
+        self.timeout = timeout
+        self.url = None
+        self.tree = None
+        # archive.Recording of the pages loaded, set by fetch_with_fallback
+        self.recording = None
+
+    def _request(self, method, url, marker, data=None):
+        with metrics.stage("page_load"):
+            # Form posts aren't repeated, the portal may already have acted on them
+            retries = STATUS_RETRIES if method == "GET" else 0
+            for attempt in range(retries + 1):
+                response = governed(url, lambda: self.session.request(method, url, data=data, timeout=self.timeout))
+                if response.status_code not in BACKOFF_STATUSES or attempt == retries:
+                    break
+                logging.warning("{} answered {}, retrying".format(url, response.status_code))
+            response.raise_for_status()
+        metrics.count("pages_fetched", fetcher="http")
+        metrics.count("bytes_downloaded", len(response.content), kind="page")
+        with metrics.stage("parse"):
+            tree = parse_response(response)
+        if not tree.xpath(marker):
+            raise MarkerNotFound("{} not found on {}".format(marker, url))
+        if self.recording is not None:
+            self.recording.add(PAGE_KINDS.get(marker, "item_list"), response.url,
+                               response.headers.get("Content-Type", ""), response.content)
+        return response.url, tree
+
+    def _load(self, method, url, marker, data=None):
+        self.url, self.tree = self._request(method, url, marker, data)
+        return self.tree
+
+    # Loads urls concurrently on the session's cookies and returns parse(tree) for each, in order.
+    # Pages are parsed as they arrive so their trees can be dropped right away.
+    def open_many(self, urls, marker, parse, concurrency=ITEM_CONCURRENCY):
+        @metrics.propagate
+        def load(url):
+            return parse(self._request("GET", url, marker)[1])
+
+        results = [None] * len(urls)
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = dict((executor.submit(load, url), i) for i, url in enumerate(urls))
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+
+    def open(self, url, marker):
+        return self._load("GET", url, marker)
+
+    def _submit(self, form, overrides, marker):
+        values = dict(form.form_values())
+        values.update(overrides)
+        action = urljoin(self.url, form.get("action") or self.url)
+        method = (form.get("method") or "GET").upper()
+        if method == "POST":
+            return self._load("POST", action, marker, data=values)
+        response_url = requests.Request("GET", action, params=values).prepare().url
+        return self._load("GET", response_url, marker)
+
+    def click(self, link, marker):
+        anchors = self.tree.xpath(link)
+        if not anchors:
+            raise MarkerNotFound("{} not found on {}".format(link, self.url))
+        anchor = anchors[0]
+        href = (anchor.get("href") or "").strip()
+        if href and not href.startswith("javascript:") and href != "#":
+            return self.open(urljoin(self.url, href), marker)
+
+        # The link only sets hidden fields and submits the enclosing form
+        script = href + ";" + (anchor.get("onclick") or "")
+        forms = anchor.xpath("ancestor::form[1]") or self.tree.forms
+        if not forms:
+            raise MarkerNotFound("No form behind {} on {}".format(link, self.url))
+        return self._submit(forms[0], dict(JS_ASSIGNMENT.findall(script)), marker)
+
+    def select_page_size(self, size):
+        select = self.tree.xpath(PAGE_SIZE_MARKER)
+        if not select:
+            raise MarkerNotFound("{} not found on {}".format(PAGE_SIZE_MARKER, self.url))
+        forms = select[0].xpath("ancestor::form[1]")
+        if not forms:
+            raise MarkerNotFound("No form behind {} on {}".format(PAGE_SIZE_MARKER, self.url))
+        return self._submit(forms[0], {select[0].get("name"): str(size)}, page_size_marker(size))
+
+    def close(self):
+        pass
+
+
+class BrowserFetcher:
+    """Same steps as HttpFetcher, driven through headless Chrome."""
+
+    def __init__(self, browser=None):
+        if browser is None:
+            with metrics.stage("browser_start"):
+                browser = start_browser()
+        self.browser = browser
+        self.url = None
+        self.tree = None
+        self.pages = 0
+        self.recording = None
+
+    def _read(self, marker):
+        self.pages += 1
+        self.url = self.browser.current_url
+        source = self.browser.page_source
+        metrics.count("pages_fetched", fetcher="browser")
+        record_page(self.browser, source)
+        with metrics.stage("parse"):
+            self.tree = html.fromstring(source)
+        if not self.tree.xpath(marker):
+            raise MarkerNotFound("{} not found on {}".format(marker, self.url))
+        if self.recording is not None:
+            self.recording.add(PAGE_KINDS.get(marker, "item_list"), self.url, "text/html; charset=utf-8",
+                               source.encode("utf-8"))
+        return self.tree
+
+    def open(self, url, marker):
+        with metrics.stage("page_load"):
+            governed(url, lambda: self.browser.get(url))
+            wait_for_page(self.browser, marker)
+        return self._read(marker)
+
+    def open_many(self, urls, marker, parse, concurrency=None):
+        return [parse(self.open(url, marker)) for url in urls]
+
+    def click(self, link, marker):
+        elem = wait_for_element(self.browser, link)
+        with metrics.stage("page_load"):
+            governed(self.browser.current_url, lambda: self.browser.execute_script("arguments[0].click();", elem))
+            wait_for_page(self.browser, marker, previous=elem)
+        return self._read(marker)
+
+    def select_page_size(self, size):
+        elem = wait_for_element(self.browser, PAGE_SIZE_MARKER)
+        elem.click()
+        option = wait_for_element(self.browser, PAGE_SIZE_MARKER + '/option[@value="{}"]'.format(size))
+        with metrics.stage("page_load"):
+            governed(self.browser.current_url, option.click)
+            wait_for_page(self.browser, page_size_marker(size), previous=elem)
+        return self._read(PAGE_SIZE_MARKER)
+
+    # Called between notices, the browser is kept but the portal session isn't
+    def reset(self):
+        clear_cookies(self.browser)
+        self.url = None
+        self.tree = None
+
+    def close(self):
+        self.browser.quit()
+
+
+# Runs steps(fetcher) over HTTP and repeats them in Chrome only if an expected marker was missing.
+# browser is an optional callable returning a BrowserFetcher owned by the caller, otherwise
+# a browser is started for this call and quit afterwards. recording (archive.Recording) gets the pages
+# of the attempt that succeeded. fetcher is the HttpFetcher to make the HTTP attempt with, a new one by default.
+def fetch_with_fallback(steps, session=None, browser=None, recording=None, fetcher=None):
+    if fetcher is None:
+        fetcher = HttpFetcher(session)
+    fetcher.recording = recording
+    try:
+        return steps(fetcher)
+    except (MarkerNotFound, requests.RequestException) as e:
+        logging.warning("HTTP fetch failed, falling back to the browser - {}".format(str(e)))
+    if recording is not None:
+        recording.clear()
+
+    if browser is not None:
+        fetcher = browser()
+        fetcher.recording = recording
+        try:
+            return steps(fetcher)
+        finally:
+            fetcher.recording = None
+
+    fetcher = BrowserFetcher()
+    fetcher.recording = recording
+    try:
+        return steps(fetcher)
+    finally:
+        fetcher.close()
@@ -0,0 +1,126 @@
+# governor.py
+# Shared politeness limits for every request this process makes to a host: a token bucket for the
+# request rate, a cap on requests in flight, and a backoff that slows the host down when it answers
+# slowly or with errors and speeds it back up once it recovers.
+
+import os
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+
+# Requests per second started to one host (<= 0 is unlimited) and how many may start back to back
+PORTAL_RATE = float(os.environ.get("PORTAL_RATE", 4))
+PORTAL_BURST = int(os.environ.get("PORTAL_BURST", 4))
+# Requests in flight to one host at once
+PORTAL_CONCURRENCY = int(os.environ.get("PORTAL_CONCURRENCY", 6))
+# Responses slower than this many seconds count as the host struggling
+SLOW_RESPONSE = float(os.environ.get("SLOW_RESPONSE", 5))
+# The rate is divided by at most this much while backing off
+MAX_BACKOFF = float(os.environ.get("MAX_BACKOFF", 16))
+# Statuses that mean the host is overloaded
+BACKOFF_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HostGovernor:
+    """Token bucket and in-flight cap for one host, with multiplicative backoff."""
+
+    def __init__(self, host, rate=PORTAL_RATE, burst=PORTAL_BURST, concurrency=PORTAL_CONCURRENCY):
+        self.host = host
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.refilled = time.monotonic()
+        # 1 is the configured rate, doubled on trouble and eased back on success
+        self.backoff = 1.0
+        # No request starts before this (monotonic), set by Retry-After
+        self.paused_until = 0
+        self.slots = threading.BoundedSemaphore(max(1, concurrency))
+        self.lock = threading.Lock()
+
+    # Blocks until a token is free, without holding the lock while sleeping
+    def _take_token(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    rate = self.rate / self.backoff
+                    self.tokens = min(self.burst, self.tokens + (now - self.refilled) * rate)
+                    self.refilled = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / rate
+            time.sleep(delay)
+
+    def _slow_down(self, reason, retry_after=None):
+        with self.lock:
+            self.backoff = min(MAX_BACKOFF, self.backoff * 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            backoff = self.backoff
+        logging.warning("{} {}, backing off to 1/{:.0f} of the request rate".format(self.host, reason, backoff))
+
+    def _speed_up(self):
+        with self.lock:
+            self.backoff = max(1.0, self.backoff * 0.9)
+
+    # Runs request() under the host's limits. request returns a requests.Response (or anything else for
+    # requests without a status, like browser navigations); its status and duration adjust the backoff.
+    def call(self, request):
+        self._take_token()
+        with self.slots:
+            started = time.monotonic()
+            try:
+                response = request()
+            except Exception as e:
+                self._slow_down("failed ({})".format(type(e).__name__))
+                raise
+        elapsed = time.monotonic() - started
+
+        status = getattr(response, "status_code", None)
+        if status in BACKOFF_STATUSES:
+            self._slow_down("answered {}".format(status), retry_after(response))
+        elif elapsed > SLOW_RESPONSE:
+            self._slow_down("took {:.1f} s".format(elapsed))
+        else:
+            self._speed_up()
+        return response
+
+
+# Seconds of a numeric Retry-After header, None without one
+def retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+governors = {}
+governors_lock = threading.Lock()
+
+
+# The governor of url's host, shared by every thread of the process
+def get_governor(url):
+    host = urlparse(url).netloc
+    with governors_lock:
+        if host not in governors:
+            governors[host] = HostGovernor(host)
+        return governors[host]
+
+
+# Limits this process to 1/parts of url's host limits, when parts processes share them (backfill.py)
+def share(url, parts):
+    host = urlparse(url).netloc
+    with governors_lock:
+        governors[host] = HostGovernor(host, rate=PORTAL_RATE / parts, burst=max(1, PORTAL_BURST // parts),
+                                       concurrency=max(1, PORTAL_CONCURRENCY // parts))
+        return governors[host]
+
+
+def governed(url, request):
+    return get_governor(url).call(request)
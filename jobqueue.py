@@ -0,0 +1,235 @@
+# jobqueue.py
+# Local alternative to Cloud Tasks (QUEUE_BACKEND=local): scrape jobs are journaled in an SQLite file
+# and run by the service's own worker pool, without an HTTP round trip per job. Jobs are deduplicated by
+# notice id, leased with a visibility timeout, retried with backoff and survive restarts.
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+# cloudtasks (default) or local
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "cloudtasks")
+LOCAL_QUEUE_PATH = os.environ.get("LOCAL_QUEUE_PATH", "jobs.db")
+# Seconds a leased job is hidden from other runners, it is run again if not finished by then
+VISIBILITY_TIMEOUT = int(os.environ.get("VISIBILITY_TIMEOUT", 600))
+# Attempts before a job is given up
+MAX_ATTEMPTS = int(os.environ.get("QUEUE_MAX_ATTEMPTS", 5))
+# Seconds the runner sleeps when nothing is due
+POLL_INTERVAL = 1.0
+# Longest pause of the runner after errors in a row
+MAX_RUNNER_BACKOFF = 60
+
+QUEUED, LEASED, DONE, FAILED = "queued", "leased", "done", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    notice_id TEXT PRIMARY KEY,
+    published TEXT NOT NULL,
+    priority REAL NOT NULL,
+    available_at REAL NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    leased_until REAL,
+    last_error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, priority, available_at);
+"""
+
+
+# Seconds before attempt number `attempts` + 1
+def retry_delay(attempts):
+    return min(2 ** attempts * 5, 600)
+
+
+class LocalQueue:
+    """Priority queue of (notice id, published) jobs journaled in SQLite."""
+
+    def __init__(self, path=LOCAL_QUEUE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        # The write-ahead log keeps the journal crash safe without a sync per job
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.added = threading.Condition(self.lock)
+
+    # Same contract as enqueue.TaskEnqueuer: notices are (id, published) ordered most urgent first,
+    # offsets[i] their planned delay. The offset orders the jobs, a job is run as soon as a worker is free.
+    # Notices already queued, running or done are left alone, given up ones are queued again. Returns the
+    # notices queued by this call.
+    def enqueue(self, notices, offsets):
+        now = time.time()
+        queued = []
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for (id_, published), offset in zip(notices, offsets):
+                    cursor = self.connection.execute(
+                        "INSERT INTO jobs (notice_id, published, priority, available_at, state, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (notice_id) DO UPDATE SET state = excluded.state, "
+                        "attempts = 0, priority = excluded.priority, available_at = excluded.available_at, "
+                        "updated_at = excluded.updated_at WHERE jobs.state = 'failed'",
+                        (str(id_), str(published), now + offset, now, QUEUED, now))
+                    # 0 when the job existed and wasn't given up
+                    if cursor.rowcount:
+                        queued.append((str(id_), str(published)))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.added.notify_all()
+        logging.info("Queued {} of {} notices locally".format(len(queued), len(notices)))
+        return queued
+
+    # Takes the most urgent due job, or a leased one whose lease ran out. Returns (id, published) or None.
+    def lease(self):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT notice_id, published FROM jobs "
+                    "WHERE (state = ? AND available_at <= ?) OR (state = ? AND leased_until < ?) "
+                    "ORDER BY priority LIMIT 1", (QUEUED, now, LEASED, now)).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET state = ?, leased_until = ?, attempts = attempts + 1, updated_at = ? "
+                        "WHERE notice_id = ?", (LEASED, now + VISIBILITY_TIMEOUT, now, row[0]))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return row
+
+    def complete(self, notice_id):
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET state = ?, leased_until = NULL, last_error = NULL, "
+                                    "updated_at = ? WHERE notice_id = ?", (DONE, time.time(), notice_id))
+
+    # Puts the job back with a growing delay, or gives it up after MAX_ATTEMPTS
+    def fail(self, notice_id, error):
+        now = time.time()
+        with self.lock:
+            attempts = self.connection.execute("SELECT attempts FROM jobs WHERE notice_id = ?",
+                                               (notice_id,)).fetchone()[0]
+            if attempts >= MAX_ATTEMPTS:
+                logging.error("Giving up on #{} after {} attempts - {}".format(notice_id, attempts, error))
+                self.connection.execute("UPDATE jobs SET state = ?, leased_until = NULL, last_error = ?, "
+                                        "updated_at = ? WHERE notice_id = ?", (FAILED, error, now, notice_id))
+            else:
+                self.connection.execute("UPDATE jobs SET state = ?, leased_until = NULL, last_error = ?, "
+                                        "available_at = ?, updated_at = ? WHERE notice_id = ?",
+                                        (QUEUED, error, now + retry_delay(attempts), now, notice_id))
+
+    # Waits up to timeout seconds for new jobs
+    def wait(self, timeout):
+        with self.lock:
+            self.added.wait(timeout)
+
+    # Jobs that could be leased right now
+    def due(self):
+        now = time.time()
+        with self.lock:
+            return self.connection.execute(
+                "SELECT count(*) FROM jobs WHERE (state = ? AND available_at <= ?) OR (state = ? AND leased_until < ?)",
+                (QUEUED, now, LEASED, now)).fetchone()[0]
+
+    # Jobs per state
+    def stats(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT state, count(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class QueueRunner:
+    """Feeds leased jobs to a workers.ScraperPool and records how they ended."""
+
+    def __init__(self, queue, pool):
+        self.queue = queue
+        self.pool = pool
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="queue-runner", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def finished(self, notice_id, future):
+        try:
+            future.result()
+        except Exception as e:
+            self.release(notice_id, str(e))
+            return
+        try:
+            self.queue.complete(notice_id)
+        except Exception as e:
+            logging.error("Couldn't mark #{} done, it runs again after its lease - {}".format(notice_id, str(e)))
+
+    # Gives a leased job that couldn't be started back to the queue, it is retried with the usual delay
+    def release(self, notice_id, error):
+        try:
+            self.queue.fail(notice_id, error)
+        except Exception as e:
+            logging.error("Couldn't put #{} back, it runs again after its lease - {}".format(notice_id, str(e)))
+
+    # Errors of the queue or the pool (a locked database, broken scraper processes) are logged and waited out,
+    # the runner only ends with stop()
+    def run(self):
+        errors = 0
+        while not self.stopped.is_set():
+            job = None
+            try:
+                job = self.queue.lease()
+                if job is None:
+                    self.queue.wait(POLL_INTERVAL)
+                    continue
+                notice_id, published = job
+                # Blocks while every worker is busy and the waiting line is full
+                future = self.pool.submit(notice_id, published, block=True)
+            except Exception as e:
+                errors += 1
+                logging.error("Queue runner failed {} times in a row - {}".format(errors, str(e)))
+                if job is not None:
+                    self.release(job[0], str(e))
+                self.stopped.wait(min(MAX_RUNNER_BACKOFF, POLL_INTERVAL * 2 ** errors))
+                continue
+            errors = 0
+            future.add_done_callback(lambda future, notice_id=notice_id: self.finished(notice_id, future))
+
+
+queue = None
+runner = None
+queue_lock = threading.Lock()
+
+
+# The process's local queue, opened on first use
+def get_queue():
+    global queue
+    with queue_lock:
+        if queue is None:
+            queue = LocalQueue()
+        return queue
+
+
+# Starts running the local queue on pool() once per process
+def start_runner(pool):
+    global runner
+    local_queue = get_queue()
+    with queue_lock:
+        if runner is None:
+            runner = QueueRunner(local_queue, pool())
+            runner.start()
+            logging.info("Running queued jobs from {}".format(local_queue.path))
+        return runner
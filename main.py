@@ -1,25 +1,165 @@
-# main.py
-
-from flask import Flask
-import os
-import subprocess
-
-app = Flask(__name__)
-
-# GCP Cloud Run requires that the app listens at "/" while it is working, to respond to health checks
-@app.route("/")
-def main():
-    return "Works"
-
-# Scans the website for new notices to schedule them for later scraping
-@app.route("/scan")
-def scan():
-    exec(open("scanner.py").read())
-    return "Finished scheduling scrapes successfully."
-
-# Scrapes the given notice id
-@app.route("/scrape/<id>/<timestamp>")
-def scrape(id, timestamp):
-    command = "python3 scraper.py {} {}".format(id, timestamp)
-    subprocess.call([command], shell=True)
-    return "Finished scraping #{} published on {}".format(id, timestamp)
+# main.py
+
+from flask import Flask, request, jsonify
+import os
+import logging
+import threading
+
+# Scanner and scraper modules are imported by the routes using them, the health check doesn't wait for them
+import startup
+import profiling
+
+app = Flask(__name__)
+
+# Loads the libraries in the background once the app is up, and the scraper fork server when it is used
+startup.prewarm_in_background()
+if os.environ.get("SCRAPER_PROCESSES", "0") == "1":
+    startup.fork_server()
+
+
+# With the local job queue the service runs the scrapes itself, starting with the jobs left by the last run
+def start_queue_runner():
+    import jobqueue
+    from workers import get_pool
+    jobqueue.start_runner(get_pool)
+
+
+if os.environ.get("QUEUE_BACKEND") == "local":
+    threading.Thread(target=start_queue_runner, name="queue-start", daemon=True).start()
+
+
+@app.before_request
+def request_seen():
+    startup.request_seen()
+
+
+# Where the profile of a run asked for with ?profile=1 (or PROFILE) can be read
+def profile_note(name):
+    return "" if name is None else " Profile at /debug/profiles/{}.txt".format(name)
+
+# GCP Cloud Run requires that the app listens at "/" while it is working, to respond to health checks
+@app.route("/")
+def main():
+    return "Works"
+
+# Scans the website for new notices to schedule them for later scraping
+@app.route("/scan")
+def scan():
+    import scanner
+    from scraper import setup_logging
+    setup_logging()
+    profile = profiling.artifact_name("scan", requested=profiling.requested(request.args))
+    with profiling.profiled(profile):
+        scanner.scan()
+    return "Finished scheduling scrapes successfully." + profile_note(profile)
+
+# Fetches the open notices again and re-scrapes the ones that changed since they were saved, on the warm
+# scraper workers and their browsers
+@app.route("/recheck")
+def recheck():
+    import scraper
+    from workers import get_pool
+    scraper.setup_logging()
+    pool = get_pool()
+    checked, changed, failed = scraper.recheck(submit=lambda _id: pool.submit_recheck(_id, block=True))
+    return "Rechecked {} notices, {} changed, {} failed.".format(checked, changed, failed)
+
+# Scrapes the given notice id on one of the warm scraper workers
+@app.route("/scrape/<id>/<timestamp>")
+def scrape(id, timestamp):
+    from workers import get_pool, PoolFull
+    profile = profiling.artifact_name("scrape", id, requested=profiling.requested(request.args))
+    try:
+        get_pool().submit(id, timestamp, profile=profile).result()
+    except PoolFull as e:
+        # Cloud Tasks retries the task later
+        return "Busy, #{} not started - {}".format(id, str(e)), 429
+    except Exception as e:
+        logging.error("Scraping #{} failed - {}".format(id, str(e)))
+        return "Failed scraping #{} published on {}.{}".format(id, timestamp, profile_note(profile)), 500
+    return "Finished scraping #{} published on {}.{}".format(id, timestamp, profile_note(profile))
+
+# Scrapes a batch of notices packed into one task, {"notices": [{"id": ..., "published": ...}, ...]}
+@app.route("/scrape", methods=["POST"])
+def scrape_batch():
+    from workers import get_pool
+    notices = request.get_json(force=True)["notices"]
+    pool = get_pool()
+    profile = profiling.requested(request.args)
+    futures = [(notice["id"], pool.submit(notice["id"], notice["published"], block=True,
+                                          profile=profiling.artifact_name("scrape", notice["id"], requested=profile)))
+               for notice in notices]
+
+    failed = []
+    for id, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            logging.error("Scraping #{} failed - {}".format(id, str(e)))
+            failed.append(id)
+    if failed:
+        # Cloud Tasks retries the whole batch
+        return "Failed scraping {} of {} notices: {}".format(len(failed), len(notices), ", ".join(failed)), 500
+    return "Finished scraping {} notices".format(len(notices))
+
+# Notices whose name, category, description or items match ?q=, newest first, filtered by category,
+# currency and deadline_from/deadline_to; ?after= takes the `next` cursor of the previous page
+@app.route("/search")
+def search_notices():
+    import search
+    from runtime import get_engine
+    try:
+        return jsonify(search.search_page(get_engine(), request.args))
+    except ValueError as e:
+        return "Bad search - {}".format(str(e)), 400
+    except search.SearchNotReady as e:
+        return str(e), 503
+
+# Notices with their operator and items as gzipped JSON lines (?format=parquet for Parquet), published from
+# ?since= on or, with ?incremental=1, saved since the last incremental export called ?name=
+@app.route("/export")
+def export_notices():
+    import export
+    from flask import Response
+    from runtime import get_engine
+    engine = get_engine()
+    try:
+        format, since, incremental, name = export.export_args(request.args)
+        export.check_ready(engine, format, incremental)
+    except ValueError as e:
+        return "Bad export - {}".format(str(e)), 400
+    except export.ExportNotReady as e:
+        return str(e), 503
+    # Both formats are streamed as they are written, Parquet one row group at a time
+    filename, mimetype = ("notices.parquet", "application/vnd.apache.parquet") if format == "parquet" else \
+        ("notices.jsonl.gz", "application/gzip")
+    records = export.exported(engine, since, incremental, name)
+    return Response(export.chunks(records, format, export.get_tables(engine)), mimetype=mimetype,
+                    headers={"Content-Disposition": "attachment; filename={}".format(filename)})
+
+# Stage timings and counters of this instance in the Prometheus text format
+@app.route("/metrics")
+def prometheus_metrics():
+    import metrics
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# Profiling artifacts kept by this instance
+@app.route("/debug/profiles")
+def profiles():
+    return jsonify(profiling.list_artifacts())
+
+# One profiling artifact, <name>.txt is the readable report and <name>.prof the pstats dump
+@app.route("/debug/profiles/<name>")
+def profile(name):
+    content = profiling.read_artifact(name)
+    if content is None:
+        return "No profile {}".format(name), 404
+    if name.endswith(".txt"):
+        return content, 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return content, 200, {"Content-Type": "application/octet-stream",
+                          "Content-Disposition": "attachment; filename={}".format(name)}
+
+# Milliseconds to the first request and to warm, and how long each import took
+@app.route("/startup")
+def startup_report():
+    return jsonify(startup.report())
@@ -0,0 +1,224 @@
+# metrics.py
+# Stage timers and counters for scans and scrapes. Totals are served in the Prometheus text format by
+# /metrics; every scan or scrape also logs one JSON summary of its own stages and counts when it ends.
+# Scraper processes (SCRAPER_PROCESSES=1) send what they recorded back with each result, see take().
+
+import json
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the stage duration histogram
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+ITEM_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+HELP = {
+    "tenders_stage_seconds": "Time spent per stage of a scan or scrape",
+    "tenders_pages_fetched_total": "Portal pages loaded",
+    "tenders_bytes_downloaded_total": "Bytes downloaded from the portal",
+    "tenders_db_statements_total": "SQL statements executed",
+    "tenders_failures_total": "Failed runs by stage and error type",
+    "tenders_runs_total": "Finished scans and scrapes",
+    "tenders_items_per_notice": "Items saved per scraped notice",
+    "tenders_attachments_total": "Attachments of scraped notices by what happened to them",
+    "tenders_notices_total": "Notices seen by scans, by outcome",
+    "tenders_browser_page_bytes": "Bytes a page loaded in the browser transferred with its subresources",
+    "tenders_browser_rss_mb": "Memory of the browser and chromedriver after each page",
+    "tenders_operator_cache_total": "Operator cache lookups by outcome, a hit skips the operator write",
+}
+
+lock = threading.Lock()
+# (name, labels) -> value, labels being a sorted tuple of (label, value)
+counters = {}
+# (name, labels) -> (bucket bounds, [bucket counts..., count, sum])
+histograms = {}
+local = threading.local()
+
+
+class Run:
+    """What one scan or scrape spent and counted, logged as a single record when it ends."""
+
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        self.fields = fields
+        self.started = time.time()
+        self.stages = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def add_count(self, name, value):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def summary(self, error=None):
+        with self.lock:
+            record = dict(run=self.kind, ok=error is None, duration=round(time.time() - self.started, 3),
+                          stages=dict((stage, round(seconds, 3)) for stage, seconds in self.stages.items()),
+                          counts=dict(self.counts))
+        record.update(self.fields)
+        if error is not None:
+            record["error"] = error_type(error)
+        return record
+
+
+def current():
+    return getattr(local, "run", None)
+
+
+# Wraps function so that it counts into the caller's run in whichever thread it is run (thread pools)
+def propagate(function):
+    run = current()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = current()
+        local.run = run
+        try:
+            return function(*args, **kwargs)
+        finally:
+            local.run = previous
+    return wrapper
+
+
+def labelled(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def count(name, value=1, **labels):
+    key = labelled("tenders_" + name + "_total", labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+    run = current()
+    if run is not None:
+        run.add_count(name if not labels else name + ":" + ",".join(label for _, label in key[1]), value)
+
+
+def observe(name, value, buckets=BUCKETS, **labels):
+    key = labelled("tenders_" + name, labels)
+    with lock:
+        buckets, histogram = histograms.setdefault(key, (buckets, [0] * (len(buckets) + 2)))
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+
+# Counters and histograms recorded since the last call, taken out of this process's totals. Scraper
+# processes hand them to the parent with every result (see workers.py), which merges them into its own.
+def take():
+    with lock:
+        delta = (dict(counters), dict((key, (buckets, list(values))) for key, (buckets, values) in histograms.items()))
+        counters.clear()
+        histograms.clear()
+    return delta
+
+
+def merge(delta):
+    counter_delta, histogram_delta = delta
+    with lock:
+        for key, value in counter_delta.items():
+            counters[key] = counters.get(key, 0) + value
+        for key, (buckets, values) in histogram_delta.items():
+            histogram = histograms.setdefault(key, (buckets, [0] * len(values)))[1]
+            for i, value in enumerate(values):
+                histogram[i] += value
+
+
+# Times the block as stage, into the histogram and the current run
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        observe("stage_seconds", seconds, stage=name)
+        run = current()
+        if run is not None:
+            run.add_stage(name, seconds)
+
+
+# The class of the error behind error, ScrapeError usually wraps it
+def error_type(error):
+    cause = error.__cause__ or error.__context__
+    return type(cause if cause is not None else error).__name__
+
+
+# Decorator making each call of function a run of kind; fields(*args, **kwargs) adds to its summary.
+# Calls made inside another run count into that one.
+def recorded(kind, fields=None):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if current() is not None:
+                return function(*args, **kwargs)
+            run = local.run = Run(kind, **(fields(*args, **kwargs) if fields else {}))
+            error = None
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                error = e
+                count("failures", stage=kind, type=error_type(e))
+                raise
+            finally:
+                local.run = None
+                count("runs", run=kind, ok="true" if error is None else "false")
+                observe("stage_seconds", time.time() - run.started, stage=kind)
+                logging.info("Run summary {}".format(json.dumps(run.summary(error), default=str)))
+        return wrapper
+    return decorate
+
+
+# Counts the statements executed through engine (once per engine)
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    if getattr(engine, "_tenders_metrics", False):
+        return
+    engine._tenders_metrics = True
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(connection, cursor, statement, parameters, context, executemany):
+        count("db_statements", kind=statement.lstrip().split(" ", 1)[0].upper())
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value.replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in labels) + "}"
+
+
+# Everything counted so far in the Prometheus text exposition format
+def render():
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, (buckets, list(values))) for key, (buckets, values) in histograms.items())
+
+    lines = []
+    described = set()
+    for (name, labels), value in counter_items:
+        if name not in described:
+            lines.append("# HELP {} {}".format(name, HELP.get(name, name)))
+            lines.append("# TYPE {} counter".format(name))
+            described.add(name)
+        lines.append("{}{} {}".format(name, format_labels(labels), value))
+    for (name, labels), (buckets, values) in histogram_items:
+        if name not in described:
+            lines.append("# HELP {} {}".format(name, HELP.get(name, name)))
+            lines.append("# TYPE {} histogram".format(name))
+            described.add(name)
+        for bound, bucket in zip(buckets, values):
+            lines.append("{}_bucket{} {}".format(name, format_labels(labels, [("le", str(bound))]), bucket))
+        lines.append("{}_bucket{} {}".format(name, format_labels(labels, [("le", "+Inf")]), values[-2]))
+        lines.append("{}_count{} {}".format(name, format_labels(labels), values[-2]))
+        lines.append("{}_sum{} {}".format(name, format_labels(labels), values[-1]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,70 @@
+# operators.py
+# Operators already in tenders.operators, so that a scrape only writes one when it is new or its contact
+# details changed. A few operators publish most notices, the cache is small and nearly always hit.
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+import metrics
+
+# Operators remembered per process
+OPERATOR_CACHE_SIZE = int(os.environ.get("OPERATOR_CACHE_SIZE", 1024))
+
+
+class OperatorCache:
+    """Bounded LRU of email -> contact details as saved in the database."""
+
+    def __init__(self, size=OPERATOR_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.warmed = set()
+        self.lock = threading.Lock()
+
+    # True when operator is saved with exactly these details, the database can be skipped then.
+    # Lookups are counted in /metrics as tenders_operator_cache_total{outcome="hit"|"miss"}.
+    def known(self, operator):
+        with self.lock:
+            saved = self.entries.get(operator["email"])
+            hit = saved is not None and all(saved.get(column) == value for column, value in operator.items())
+            if hit:
+                self.entries.move_to_end(operator["email"])
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.count("operator_cache", outcome="hit" if hit else "miss")
+        return hit
+
+    # Called once operator was committed
+    def remember(self, operator):
+        with self.lock:
+            self.entries[operator["email"]] = dict(operator)
+            self.entries.move_to_end(operator["email"])
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    # Loads up to size operators from operators_table, once per engine
+    def warm(self, engine, operators_table):
+        with self.lock:
+            if engine in self.warmed:
+                return
+            self.warmed.add(engine)
+        with engine.connect() as connection:
+            rows = [dict(row) for row in connection.execute(select([operators_table]).limit(self.size))]
+        for row in rows:
+            self.remember(row)
+        logging.info("Operator cache warmed with {} operators".format(len(rows)))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self.entries), hits=self.hits, misses=self.misses,
+                        hit_rate=round(self.hits / lookups, 3) if lookups else None)
+
+
+operator_cache = OperatorCache()
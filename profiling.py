@@ -0,0 +1,168 @@
+# profiling.py
+# Opt-in cProfile and tracemalloc recording of single scans and scrapes, to find out why one of them is slow
+# or heavy. A run is profiled when PROFILE names its kind or its request asks for it with ?profile=1; other
+# runs only check a name for None. Each profiled run leaves <name>.prof (pstats, for snakeviz or
+# pstats.Stats) and <name>.txt (slowest functions and top allocations) in PROFILE_DIR, copied to the bucket
+# under profiles/ with PROFILE_UPLOAD=1, and served by /debug/profiles.
+# cProfile only sees the thread of the run: time spent in the item page and attachment pools shows up as
+# waiting on their futures. tracemalloc sees every thread.
+
+import os
+import re
+import time
+import uuid
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Kinds of runs always profiled, comma separated: scan, scrape or all
+PROFILE = set(filter(None, os.environ.get("PROFILE", "").split(",")))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# 1 copies the artifacts to the bucket too, a Cloud Run instance's disk goes away with it
+PROFILE_UPLOAD = os.environ.get("PROFILE_UPLOAD", "0") == "1"
+# Functions and allocation sites listed in a report
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", 40))
+
+ARTIFACT = re.compile(r"^[\w-]+\.(prof|txt)$")
+
+# Profiled runs in progress, tracemalloc traces while there are any
+tracing = 0
+started_tracing = False
+tracing_lock = threading.Lock()
+
+
+# True for ?profile=1
+def requested(args):
+    return args.get("profile", "").lower() in ("1", "true", "yes")
+
+
+# Name of the artifacts of a run of kind about label, None when the run isn't profiled
+def artifact_name(kind, label=None, requested=False):
+    if not (requested or kind in PROFILE or "all" in PROFILE):
+        return None
+    parts = [kind] + ([re.sub(r"[^\w-]", "_", str(label))] if label else [])
+    return "-".join(parts + [time.strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex[:6]])
+
+
+def start_tracing():
+    global tracing, started_tracing
+    with tracing_lock:
+        # Left alone when something else (PYTHONTRACEMALLOC) already traces
+        if tracing == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        tracing += 1
+
+
+def stop_tracing():
+    global tracing, started_tracing
+    with tracing_lock:
+        tracing -= 1
+        if tracing == 0 and started_tracing:
+            tracemalloc.stop()
+            started_tracing = False
+
+
+# Allocations traced now, without the profilers' own (also those of concurrent profiled runs)
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "*/cProfile.py"),
+        tracemalloc.Filter(False, "*/pstats.py"),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ))
+
+
+# Profiles the block into the artifacts called name, does nothing when name is None
+@contextmanager
+def profiled(name):
+    if name is None:
+        yield
+        return
+
+    import cProfile
+    profile = cProfile.Profile()
+    start_tracing()
+    before = take_snapshot()
+    try:
+        profile.enable()
+    except ValueError as e:
+        # Since Python 3.12 only one profiler can run at a time, the allocations are still recorded
+        logging.warning("Not profiling {} - {}".format(name, str(e)))
+        profile = None
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+        seconds = time.perf_counter() - started
+        after = take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        stop_tracing()
+        try:
+            save(name, profile, before, after, seconds, peak)
+        except Exception as e:
+            logging.warning("Profile {} not saved - {}".format(name, str(e)))
+
+
+def save(name, profile, before, after, seconds, peak):
+    import io
+    import pstats
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    paths = []
+    report = io.StringIO()
+    report.write("{} took {:.3f} s, traced memory of the process peaked at {:.1f} MB\n\n".format(
+        name, seconds, peak / 2 ** 20))
+    if profile is not None:
+        path = os.path.join(PROFILE_DIR, name + ".prof")
+        profile.dump_stats(path)
+        paths.append(path)
+        report.write("Slowest functions, cumulative:\n")
+        pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    report.write("Memory allocated during the run by line:\n")
+    for statistic in after.compare_to(before, "lineno")[:PROFILE_TOP]:
+        report.write("{}\n".format(statistic))
+
+    path = os.path.join(PROFILE_DIR, name + ".txt")
+    with open(path, "w") as fh:
+        fh.write(report.getvalue())
+    paths.append(path)
+
+    if PROFILE_UPLOAD:
+        from attachments import get_bucket
+        bucket = get_bucket()
+        for path in paths:
+            with open(path, "rb") as fh:
+                bucket.blob("profiles/" + os.path.basename(path)).upload_from_file(fh)
+    logging.info("Profile of {} saved ({:.3f} s)".format(name, seconds))
+
+
+# Artifacts of this instance, newest first
+def list_artifacts():
+    try:
+        names = [name for name in os.listdir(PROFILE_DIR) if ARTIFACT.match(name)]
+    except FileNotFoundError:
+        return []
+    paths = [os.path.join(PROFILE_DIR, name) for name in names]
+    return [dict(name=os.path.basename(path), size=os.path.getsize(path))
+            for path in sorted(paths, key=os.path.getmtime, reverse=True)]
+
+
+# Contents of artifact name from the disk or else the bucket, None when there is no such artifact
+def read_artifact(name):
+    if not ARTIFACT.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    if os.path.exists(path):
+        with open(path, "rb") as fh:
+            return fh.read()
+    if PROFILE_UPLOAD:
+        from attachments import get_bucket
+        blob = get_bucket().blob("profiles/" + name)
+        if blob.exists():
+            return blob.download_as_bytes()
+    return None
@@ -0,0 +1,141 @@
+# runtime.py
+# Process-wide setup shared by scanner.py, scraper.py and the service: the Secret Manager values,
+# the PEM files of the Cloud SQL SSL connection, one pooled engine and the reflected tables.
+# Everything is built on first use and kept for the life of the process.
+
+import os
+import time
+import base64
+import logging
+import threading
+
+from sqlalchemy import Table, MetaData, create_engine
+
+# Counts the statements of the engine
+import metrics
+
+project = 'tenders-284621'
+
+# Seconds a secret is used before it is read again, rotated credentials are picked up after that
+SECRET_TTL = int(os.environ.get("SECRET_TTL", 3600))
+# Connections kept open by the engine, and how many more it may open under load
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+# Seconds after which a pooled connection is replaced
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+
+secrets_client = None
+# name -> (value, time it was read)
+secrets = {}
+secrets_lock = threading.Lock()
+
+engine = None
+engine_config = None
+engine_lock = threading.Lock()
+
+# Reflected notices/operators/items tables per engine
+tables = {}
+tables_lock = threading.Lock()
+
+
+# Latest version of secret name, read from Secret Manager at most once per SECRET_TTL
+def secret(name):
+    global secrets_client
+    with secrets_lock:
+        cached = secrets.get(name)
+        if cached is not None and time.time() - cached[1] < SECRET_TTL:
+            return cached[0]
+        if secrets_client is None:
+            # Import the Secret Manager client library.
+            from google.cloud import secretmanager
+            # Create the Secret Manager client.
+            secrets_client = secretmanager.SecretManagerServiceClient()
+        # Access the secret version.
+        value = secrets_client.access_secret_version(
+            request={"name": "projects/"+project+"/secrets/"+name+"/versions/1"}).payload.data.decode("utf-8")
+        secrets[name] = (value, time.time())
+        return value
+
+
+# PEM file content with the base64 body wrapped at 64 characters
+def format_pem(pem_content):
+    lines = [pem_content[:pem_content.find('-----', 1)+5]]
+    value = pem_content[pem_content.find('-----', 1)+5:pem_content.rfind('-----END')]
+    for i in range(0, len(value), 64):
+        lines.append(value[i:i+64])
+    return '\n'.join(lines) + '\n' + pem_content[pem_content.rfind('-----END'):]
+
+
+# client-cert, client-key, server-ca. Writes pem_type.pem only when its content changed,
+# returns whether it did
+def create_pem(pem_type, pem_content):
+    content = format_pem(pem_content).encode('utf8')
+    path = pem_type + ".pem"
+    try:
+        with open(path, "rb") as fh:
+            if fh.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    # Written next to the old file and renamed, a connection opening meanwhile never reads half a key
+    with open(path + ".tmp", "wb") as fh:
+        fh.write(content)
+    os.chmod(path + ".tmp", 0o600)
+    os.replace(path + ".tmp", path)
+    return True
+
+
+# Database URI and SSL arguments built from the (cached) secrets
+def database_config():
+    changed = False
+    for pem_type in ('client-cert', 'client-key', 'server-ca'):
+        changed |= create_pem(pem_type, base64.b64decode(secret("db-" + pem_type)).decode("utf-8"))
+
+    # Postgresql connection strings
+    DATABASE_HOST = os.environ["DATABASE_HOST"]
+    DATABASE_CREDENTIALS = secret("credentials")
+    return "postgresql://" + DATABASE_CREDENTIALS + "@" + DATABASE_HOST, changed
+
+
+# The engine for the tenders database, shared by every caller in the process. A new one replaces it
+# when a secret it was built from changed.
+def get_engine():
+    global engine, engine_config
+    with engine_lock:
+        uri, changed = database_config()
+        if engine is not None and not changed and uri == engine_config:
+            return engine
+
+        if engine is not None:
+            logging.info("Database secrets changed, opening a new engine")
+            old = engine
+            with tables_lock:
+                tables.pop(old, None)
+            old.dispose()
+
+        # Google Cloud SSL Configuration
+        ssl_args = {'sslrootcert':'server-ca.pem',
+                    'sslcert':'client-cert.pem',
+                    'sslkey':'client-key.pem'}
+        engine = create_engine(uri, connect_args=ssl_args, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                               pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE)
+        metrics.instrument_engine(engine)
+        engine_config = uri
+        return engine
+
+
+# Kept for callers that open "a connection": returns the shared engine
+def connect():
+    return get_engine()
+
+
+# Retrieve notices/operators/items table, reflected once per engine
+def get_tables(engine):
+    with tables_lock:
+        if engine not in tables:
+            metadata = MetaData(schema="tenders")
+            tables[engine] = (Table('notices', metadata, autoload=True, autoload_with=engine),
+                              Table('operators', metadata, autoload=True, autoload_with=engine),
+                              Table('items', metadata, autoload=True, autoload_with=engine))
+        return tables[engine]
@@ -1,231 +1,245 @@
-import sys
-import time
-import datetime
-import os
-
-# Google Tasks API
-from google.cloud import tasks_v2
-from google.protobuf import timestamp_pb2
-import json
-import base64
-
-# Import the Secret Manager client library.
-from google.cloud import secretmanager
-
-# Selenium essentials
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait as wait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-
-# Imports the Cloud Logging client library
-import google.cloud.logging
-# Imports Python standard library logging
-import logging
-
-import chromedriver_binary  # Adds chromedriver binary to path
-from lxml import html
-from sqlalchemy import Table, Column, Integer, String, MetaData, Text, Boolean, DateTime, ForeignKey, BigInteger, \
-    create_engine, insert  # Python SQL toolkit essentials
-
-# Instantiates a client for logging
-client = google.cloud.logging.Client()
-
-# Retrieves a Cloud Logging handler based on the environment
-# you're running in and integrates the handler with the
-# Python logging module. By default this captures all logs
-# at INFO level and higher
-client.get_default_handler()
-client.setup_logging()
-
-# Create a client for tasks API.
-client = tasks_v2.CloudTasksClient()
-
-# Tasks API Configuration
-project = 'tenders-284621'
-queue = 'scraping-queue'
-location = 'europe-west1'
-BASEURL = os.environ["BASEURL"]
-payload = None
-task_name = None
-
-
-# client-cert, client-key, server-ca
-def create_pem(pem_type, pem_content):
-    with open(pem_type+".pem", "w+", encoding='utf8', newline='\n') as fh:
-        fh.write(pem_content[:pem_content.find('-----', 1)+5]+'\n')
-        
-        value = pem_content[pem_content.find('-----', 1)+5:pem_content.rfind('-----END')]
-        for i in range(0, len(value) // 64):
-            fh.write(value[64*i:64*(i+1)]+'\n')
-        if (len(value) % 64 != 0):
-            fh.write(value[64*(len(value)//64)::]+'\n')     
-        
-        fh.write(pem_content[pem_content.rfind('-----END'):])
-
-        os.chmod(pem_type+".pem", 0o600)
-        fh.close()
-
-
-# Create the Secret Manager client.
-secrets_client = secretmanager.SecretManagerServiceClient()
-
-# Access the secret version.
-client_cert = secrets_client.access_secret_version(request={"name": "projects/"+project+"/secrets/db-client-cert/versions/1"}).payload.data.decode("utf-8")
-client_key = secrets_client.access_secret_version(request={"name": "projects/"+project+"/secrets/db-client-key/versions/1"}).payload.data.decode("utf-8")
-server_ca = secrets_client.access_secret_version(request={"name": "projects/"+project+"/secrets/db-server-ca/versions/1"}).payload.data.decode("utf-8")
-
-
-create_pem('client-cert', base64.b64decode(client_cert).decode("utf-8"))
-create_pem('client-key', base64.b64decode(client_key).decode("utf-8"))
-create_pem('server-ca', base64.b64decode(server_ca).decode("utf-8"))
-
-
-
-# Google Cloud SSL Configuration
-ssl_args = {'sslrootcert':'server-ca.pem',
-            'sslcert':'client-cert.pem',
-            'sslkey':'client-key.pem'}
-
-# Construct the fully qualified queue name.
-parent = client.queue_path(project, location, queue)
-
-# Link containing all tenders
-MAINLINK = "https://www.swz.kghm.pl/servlet/HomeServlet?MP_module=main&MP_action=noticeList&demandType=nonpublic"
-# Postgresql connection strings
-DATABASE_HOST = os.environ["DATABASE_HOST"]
-DATABASE_CREDENTIALS = secrets_client.access_secret_version(request={"name": "projects/"+project+"/secrets/credentials/versions/1"}).payload.data.decode("utf-8")
-
-time_in_between = 15
-
-# Set log file and log level (INFO/DEBUG)
-logging.info("=================================================================================")
-logging.info("Scraping all tenders started")
-
-# The following options are required to make headless Chrome work in a Docker container
-chrome_options = webdriver.ChromeOptions()
-chrome_options.add_argument("--headless")
-chrome_options.add_argument("--disable-gpu")
-chrome_options.add_argument("window-size=1024,768")
-chrome_options.add_argument("--no-sandbox")
-
-# Initialize a new browser
-try:
-    browser = webdriver.Chrome(
-        options=chrome_options)
-except Exception as e:
-    logging.fatal("Browser didn't start - {}".format(str(e)))
-    sys.exit(1)
-
-logging.info("Browser started")
-
-# Connect to database
-DATABASE_URI = "postgresql://" + DATABASE_CREDENTIALS + "@" + DATABASE_HOST
-try:
-    engine = create_engine(DATABASE_URI, connect_args=ssl_args)
-    connection = engine.connect()
-except Exception as e:
-    logging.fatal("Can't connect to Postgresql - {}".format(str(e)))
-    browser.quit()
-    sys.exit(1)
-
-# Retrieve notices table
-metadata = MetaData(schema="tenders")
-notices_table = Table('notices', metadata, autoload=True, autoload_with=engine)
-
-# Access link and scrape notices general information
-browser.get(MAINLINK)
-time.sleep(2)
-
-logging.info("Site opened")
-elem = wait(browser, 5).until(EC.presence_of_element_located((By.XPATH,
-                                                              '//select[contains(@name, "GD_pagesize")]')))
-elem.click()
-elem = wait(browser, 5).until(EC.presence_of_element_located((By.XPATH,
-                                                              '//select[contains(@name, "GD_pagesize")]/option[@value="100"]')))
-elem.click()
-time.sleep(2)
-tree = html.fromstring(browser.page_source)
-count_check = tree.xpath(
-    'string(count(//table[contains(@class, "bodybox")]//tr[@onmouseover]//img[@src="/pic/mp/details.gif"]/../@href))')
-
-logging.info('Number of tenders: {}'.format(count_check))
-# Will contain all new notices
-notices = []
-in_seconds = time_in_between
-for attr in tree.xpath('//table[contains(@class, "bodybox")]//tr[@onmouseover]'):
-    url = attr.xpath('string(.//img[@src="/pic/mp/details.gif"]/../@href)')
-    if url:
-        id_ = url.split("iRfxRound=")[-1]
-
-        date_published_string = attr.xpath(
-            'normalize-space(string(.//td[4]))')
-
-        query = notices_table.select().where(notices_table.c.id == id_)
-        result = connection.execute(query)
-
-        length = 0
-        for row in result:
-            length += 1
-
-        date_published = date_published_string[:16]
-        date_published = time.mktime(datetime.datetime.strptime(date_published, "%Y-%m-%d %H:%M").timetuple())
-
-        # Notice never scraped
-        if (length == 0):            
-            # Construct the request body.
-            url = BASEURL +str(id_)+'/'+str(date_published)[:-2] 
-            task = {
-                'http_request': {  # Specify the type of request.
-                    'http_method': 'GET',
-                    'url': url  # The full url path that the task will be sent to.
-                }
-            }
-
-            # Create task to run in cloud
-            if payload is not None:
-                if isinstance(payload, dict):
-                    # Convert dict to JSON string
-                    payload = json.dumps(payload)
-                    # specify http content-type to application/json
-                    task['http_request']['headers'] = {'Content-type': 'application/json'}
-
-                # The API expects a payload of type bytes.
-                converted_payload = payload.encode()
-
-                # Add the payload to the request.
-                task['http_request']['body'] = converted_payload
-
-            if in_seconds is not None:
-                # Convert "seconds from now" into an rfc3339 datetime string.
-                d = datetime.datetime.utcnow() + datetime.timedelta(seconds=in_seconds)
-
-                # Create Timestamp protobuf.
-                timestamp = timestamp_pb2.Timestamp()
-                timestamp.FromDatetime(d)
-
-                # Add the timestamp to the tasks.
-                task['schedule_time'] = timestamp
-
-            if task_name is not None:
-                # Add the name to tasks.
-                task['name'] = task_name
-
-            # Use the client to build and send the task.
-            response = client.create_task(parent, task)
-            logging.info('Created task {} for tender #{} at {}'.format(response.name, id_, url))
-
-            # Increment in_seconds to seperate workload
-            in_seconds += time_in_between
-
-            # py scrape_id.py notice date_published
-            notices.append({
-                "tender_id": id_,
-                "date_published": str(date_published)[:-2]
-            })
-
-browser.quit()
-for notice in notices:
-    logging.info(notice)
-logging.info("Script completed with {} new notices.".format(len(notices)))
-logging.info("=================================================================================")
+import re
+import sys
+import time
+import datetime
+import os
+import threading
+
+# Imports Python standard library logging
+import logging
+
+from sqlalchemy import Table, Column, String, DateTime, MetaData, select  # Python SQL toolkit essentials
+
+# Concurrent task creation
+from enqueue import TaskEnqueuer
+# Stage timers, counters and the per-run summary
+import metrics
+# Opt-in profiling of single runs
+import profiling
+# Local job queue used instead of Cloud Tasks with QUEUE_BACKEND=local
+from jobqueue import QUEUE_BACKEND, get_queue
+# Urgency ordering and measured gaps between tasks
+from scheduler import Scheduler
+# HTTP fetching with a headless Chrome fallback
+from fetcher import fetch_with_fallback, LIST_LINK, PAGE_SIZE_MARKER, NEXT_PAGE_LINK, LIST_MARKER
+# Logging setup shared with the scraper
+from scraper import setup_logging
+# Shared engine and reflected tables
+from runtime import connect, get_tables
+
+# Tasks API Configuration
+project = 'tenders-284621'
+queue = 'scraping-queue'
+location = 'europe-west1'
+
+DATE = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}")
+
+# Safety net for a cold start walking the whole list
+MAX_PAGES = int(os.environ.get("SCANNER_MAX_PAGES", 50))
+
+# Remember notices known to be in the database between scans of the same process
+SEEN_CACHE = os.environ.get("SCANNER_SEEN_CACHE", "1") == "1"
+
+
+class SeenNotices:
+    """Ids of notices already saved in tenders.notices. Only ids missing here are looked up."""
+
+    def __init__(self):
+        self.ids = set()
+        self.lock = threading.Lock()
+
+    def __contains__(self, id_):
+        return id_ in self.ids
+
+    def add(self, ids):
+        with self.lock:
+            self.ids.update(ids)
+
+
+seen = SeenNotices() if SEEN_CACHE else None
+scheduler = Scheduler()
+engine = None
+client = None
+
+# Newest notice seen by a scan whose notices were all scheduled, the list is ordered newest first
+state_metadata = MetaData(schema="tenders")
+scanner_state_table = Table('scanner_state', state_metadata,
+                            Column('name', String, primary_key=True),
+                            Column('date_published', DateTime),
+                            Column('notice_id', String))
+state_ready = False
+
+
+def read_high_water_mark(connection):
+    row = connection.execute(select([scanner_state_table.c.date_published, scanner_state_table.c.notice_id])
+                             .where(scanner_state_table.c.name == 'notice_list')).first()
+    if row is None or row[0] is None:
+        return None
+    return time.mktime(row[0].timetuple()), row[1]
+
+
+def write_high_water_mark(connection, date_published, notice_id):
+    values = {"date_published": datetime.datetime.fromtimestamp(date_published), "notice_id": notice_id}
+    result = connection.execute(scanner_state_table.update()
+                                .where(scanner_state_table.c.name == 'notice_list').values(**values))
+    if result.rowcount == 0:
+        connection.execute(scanner_state_table.insert().values(name='notice_list', **values))
+
+
+# Returns the subset of ids that are already saved, in one query returning ids only
+def known_ids(connection, notices_table, ids, seen=None):
+    if seen is not None:
+        known = set(id_ for id_ in ids if id_ in seen)
+        unresolved = [id_ for id_ in ids if id_ not in known]
+    else:
+        known = set()
+        unresolved = list(ids)
+
+    if unresolved:
+        query = select([notices_table.c.id]).where(notices_table.c.id.in_(unresolved))
+        found = set(str(row[0]) for row in connection.execute(query))
+        if seen is not None:
+            seen.add(found)
+        known |= found
+    return known
+
+
+# Reads (id, unix timestamp of publication, deadline timestamp or None) for the notices on a list page,
+# stops at the first notice older than `older_than`. Returns the notices and whether the page reached that point.
+def list_notices(tree, older_than=None):
+    listed = []
+    for attr in tree.xpath('//table[contains(@class, "bodybox")]//tr[@onmouseover]'):
+        url = attr.xpath('string(.//img[@src="/pic/mp/details.gif"]/../@href)')
+        if url:
+            id_ = url.split("iRfxRound=")[-1]
+
+            date_published_string = attr.xpath(
+                'normalize-space(string(.//td[4]))')
+
+            date_published = date_published_string[:16]
+            date_published = time.mktime(datetime.datetime.strptime(date_published, "%Y-%m-%d %H:%M").timetuple())
+            if older_than is not None and date_published < older_than:
+                return listed, True
+            listed.append((id_, date_published, row_deadline(attr, date_published)))
+    return listed, False
+
+
+# The closest date after publication in the other cells of a list row, the list shows the offer deadline there
+def row_deadline(row, date_published):
+    dates = []
+    for cell in row.xpath('./td[position() != 4]'):
+        for match in DATE.findall(cell.text_content()):
+            date = time.mktime(datetime.datetime.strptime(match, "%Y-%m-%d %H:%M").timetuple())
+            if date > date_published:
+                dates.append(date)
+    return min(dates) if dates else None
+
+
+# Access link and walk the list pages until the high water mark or the last page
+def walk_list(fetcher, high_water_mark=None):
+    fetcher.open(LIST_LINK, PAGE_SIZE_MARKER)
+    logging.info("Site opened")
+    tree = fetcher.select_page_size(100)
+
+    listed = []
+    for page in range(1, MAX_PAGES + 1):
+        count_check = tree.xpath(
+            'string(count(//table[contains(@class, "bodybox")]//tr[@onmouseover]//img[@src="/pic/mp/details.gif"]/../@href))')
+        logging.info('Number of tenders on page {}: {}'.format(page, count_check))
+
+        # The first page is always read whole so notices that failed to scrape are scheduled again
+        notices, reached = list_notices(tree, high_water_mark if page > 1 else None)
+        listed.extend(notices)
+        if high_water_mark is not None and (reached or any(date < high_water_mark for _, date, _ in notices)):
+            break
+        if not tree.xpath(NEXT_PAGE_LINK):
+            break
+        tree = fetcher.click(NEXT_PAGE_LINK, LIST_MARKER)
+    return listed
+
+
+# Scans the notice list and schedules a scrape task for every notice that isn't saved yet.
+# tasks_client replaces the Cloud Tasks client, e.g. with enqueue.LocalTasksClient
+@metrics.recorded("scan")
+def scan(tasks_client=None):
+    global client, state_ready
+
+    # Set log file and log level (INFO/DEBUG)
+    logging.info("=================================================================================")
+    logging.info("Scraping all tenders started")
+
+    if tasks_client is None and QUEUE_BACKEND == "local":
+        # Jobs run by this service's workers, see jobqueue.py
+        enqueuer = get_queue()
+    else:
+        BASEURL = os.environ["BASEURL"]
+
+        # Create a client for tasks API.
+        if tasks_client is None:
+            if client is None:
+                # Google Tasks API, imported with the first real client
+                from google.cloud import tasks_v2
+                client = tasks_v2.CloudTasksClient()
+            tasks_client = client
+
+        # Construct the fully qualified queue name.
+        parent = tasks_client.queue_path(project, location, queue)
+        enqueuer = TaskEnqueuer(tasks_client, parent, BASEURL)
+
+    # Connect to database, the engine is shared by the whole process unless one was set on the module
+    db = engine if engine is not None else connect()
+    notices_table = get_tables(db)[0]
+
+    if not state_ready:
+        state_metadata.create_all(db, checkfirst=True)
+        state_ready = True
+    with db.connect() as connection:
+        mark = read_high_water_mark(connection)
+    high_water_mark = mark[0] if mark else None
+    logging.info("High water mark: {}".format(mark))
+
+    with metrics.stage("list_pages"):
+        listed = fetch_with_fallback(lambda fetcher: walk_list(fetcher, high_water_mark))
+    with metrics.stage("dedupe"), db.connect() as connection:
+        known = known_ids(connection, notices_table, [id_ for id_, _, _ in listed], seen)
+
+    def enqueue(ordered, offsets, gap):
+        logging.info("Scheduling {} notices {:.1f} seconds apart".format(len(ordered), gap))
+        with metrics.stage("enqueue"):
+            return enqueuer.enqueue([(id_, str(date_published)[:-2]) for id_, date_published, _ in ordered], offsets)
+
+    # Will contain all new notices, most urgent first; the scheduler counts only the tasks created
+    # into the queue depth
+    new_notices, _, created = scheduler.schedule(db, [notice for notice in listed if notice[0] not in known], enqueue)
+    notices = [{"tender_id": id_, "date_published": published} for id_, published in created]
+    metrics.count("notices", len(listed) - len(new_notices), outcome="known")
+    metrics.count("notices", len(notices), outcome="scheduled")
+    metrics.count("notices", len(new_notices) - len(notices), outcome="not_scheduled")
+
+    # Move the mark to the newest listed notice, but not past the oldest notice left unscheduled
+    if listed:
+        scheduled = set(notice["tender_id"] for notice in notices)
+        newest_date, newest_id = max((date, id_) for id_, date, _ in listed)
+        failed = [date for id_, date, _ in listed if id_ not in known and id_ not in scheduled]
+        if failed and min(failed) - 1 < newest_date:
+            newest_date, newest_id = min(failed) - 1, None
+        if high_water_mark is None or newest_date > high_water_mark:
+            with db.connect() as connection:
+                write_high_water_mark(connection, newest_date, newest_id)
+
+    for notice in notices:
+        logging.info(notice)
+    logging.info("Script completed with {} new notices, {} not scheduled.".format(
+        len(notices), len(new_notices) - len(notices)))
+    logging.info("=================================================================================")
+    return notices
+
+
+if __name__ == "__main__":
+    setup_logging()
+    try:
+        with profiling.profiled(profiling.artifact_name("scan")):
+            scan()
+    except Exception as e:
+        logging.fatal(str(e))
+        sys.exit(1)
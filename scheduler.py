@@ -0,0 +1,131 @@
+# scheduler.py
+# Decides in which order and how far apart new notices are scraped. Notices closing soonest go first,
+# and the gap between tasks follows how long recent scrapes really took instead of a constant. When the
+# last task scheduled is due is kept in the database, so a scan on a fresh instance queues behind the
+# tasks of earlier scans instead of on top of them.
+
+import os
+import time
+import datetime
+import threading
+import statistics
+
+from sqlalchemy import Table, Column, Integer, String, Float, Boolean, DateTime, MetaData, select
+
+from database import upsert
+
+# Used until enough scrapes were measured
+DEFAULT_GAP = float(os.environ.get("SCHEDULER_DEFAULT_GAP", 15))
+MIN_GAP = float(os.environ.get("SCHEDULER_MIN_GAP", 1))
+MAX_GAP = float(os.environ.get("SCHEDULER_MAX_GAP", 120))
+# Scrapes the service runs at once (all instances), the gap is a scrape's duration divided by it
+SCRAPE_CONCURRENCY = int(os.environ.get("SCRAPE_CONCURRENCY", os.environ.get("SCRAPER_WORKERS", 2)))
+# Recent scrapes the gap is measured on
+SAMPLE_SIZE = 20
+MIN_SAMPLES = 3
+# Runs kept in tenders.scrape_runs, older ones are deleted as new ones come in
+RUNS_KEPT = int(os.environ.get("SCHEDULER_RUNS_KEPT", 10 * SAMPLE_SIZE))
+
+# One row per finished scrape
+runs_metadata = MetaData(schema="tenders")
+scrape_runs_table = Table('scrape_runs', runs_metadata,
+                          Column('id', Integer, primary_key=True, autoincrement=True),
+                          Column('notice_id', String),
+                          Column('finished_at', DateTime, index=True),
+                          Column('duration', Float),
+                          Column('succeeded', Boolean))
+# When the last task scheduled so far is due, as a unix timestamp
+schedule_state_table = Table('schedule_state', runs_metadata,
+                             Column('name', String, primary_key=True),
+                             Column('busy_until', Float, nullable=False))
+runs_ready = set()
+runs_lock = threading.Lock()
+
+
+def ensure_runs_table(engine):
+    with runs_lock:
+        if engine not in runs_ready:
+            runs_metadata.create_all(engine, checkfirst=True)
+            runs_ready.add(engine)
+
+
+# Records a finished scrape and forgets the ones beyond the newest RUNS_KEPT
+def record_scrape(engine, notice_id, duration, succeeded):
+    ensure_runs_table(engine)
+    with engine.connect() as connection, connection.begin():
+        connection.execute(scrape_runs_table.insert().values(
+            notice_id=str(notice_id), finished_at=datetime.datetime.utcnow(), duration=duration,
+            succeeded=succeeded))
+        cutoff = connection.execute(select([scrape_runs_table.c.finished_at])
+                                    .order_by(scrape_runs_table.c.finished_at.desc())
+                                    .offset(RUNS_KEPT).limit(1)).scalar()
+        if cutoff is not None:
+            connection.execute(scrape_runs_table.delete().where(scrape_runs_table.c.finished_at <= cutoff))
+
+
+def recent_durations(connection, limit=SAMPLE_SIZE):
+    query = select([scrape_runs_table.c.duration]).where(scrape_runs_table.c.succeeded == True) \
+        .order_by(scrape_runs_table.c.finished_at.desc()).limit(limit)
+    return [row[0] for row in connection.execute(query)]
+
+
+# Seconds between two tasks so that SCRAPE_CONCURRENCY scrapes of the usual length keep running
+def gap_for(durations, concurrency=SCRAPE_CONCURRENCY):
+    if len(durations) < MIN_SAMPLES:
+        return DEFAULT_GAP
+    return min(MAX_GAP, max(MIN_GAP, statistics.median(durations) / max(1, concurrency)))
+
+
+# Closest deadline first, notices without one after them in publication order (newest first)
+def urgency(notice):
+    id_, published, deadline = notice
+    return (0, deadline, -published) if deadline is not None else (1, 0, -published)
+
+
+# Unix time the last task scheduled so far is due at, 0 before the first one. Locks the row on Postgres
+# until the transaction ends, so scans running at once queue one after the other.
+def read_busy_until(connection, name="scrapes"):
+    query = select([schedule_state_table.c.busy_until]).where(schedule_state_table.c.name == name)
+    if connection.dialect.name == "postgresql":
+        query = query.with_for_update()
+    return connection.execute(query).scalar() or 0
+
+
+def write_busy_until(connection, busy_until, name="scrapes"):
+    connection.execute(upsert(connection, schedule_state_table, dict(name=name, busy_until=busy_until), ["name"]))
+
+
+class Scheduler:
+    """Orders notices and spaces them after the tasks earlier scans left queued."""
+
+    def __init__(self, concurrency=SCRAPE_CONCURRENCY):
+        self.concurrency = concurrency
+
+    # notices are (id, published timestamp, deadline timestamp or None), busy_until the unix time the
+    # tasks already queued are due until. Returns them ordered by urgency with the delay in seconds from now
+    # of each one, and the gap.
+    def plan(self, notices, durations, busy_until=0, now=None):
+        gap = gap_for(durations, self.concurrency)
+        ordered = sorted(notices, key=urgency)
+        now = time.time() if now is None else now
+        # Queue depth: time the tasks of earlier scans still need
+        start = max(0, busy_until - now) + gap
+        offsets = [start + gap * i for i in range(len(ordered))]
+        return ordered, offsets, gap
+
+    # Plans notices and hands them to enqueue(ordered, offsets, gap), which returns the (id, ...) of the tasks
+    # it created. busy_until only moves past those, and stays locked meanwhile so scans running at once still
+    # queue one after the other. Returns (ordered, gap, created).
+    def schedule(self, engine, notices, enqueue):
+        ensure_runs_table(engine)
+        with engine.connect() as connection:
+            durations = recent_durations(connection)
+            with connection.begin():
+                now = time.time()
+                ordered, offsets, gap = self.plan(notices, durations, read_busy_until(connection), now)
+                created = enqueue(ordered, offsets, gap)
+                ids = set(str(notice[0]) for notice in created)
+                due = [offset for notice, offset in zip(ordered, offsets) if str(notice[0]) in ids]
+                if due:
+                    write_busy_until(connection, now + max(due))
+        return ordered, gap, created
@@ -1,471 +1,554 @@
-import sys
-import os
-import datetime
-import requests
-import shutil
-import time
-import uuid
-import base64
-
-
-# Selenium essentials
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait as wait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-
-# Imports the Cloud Logging client library
-import google.cloud.logging
-# Imports Python standard library logging
-import logging
-
-import chromedriver_binary  # Adds chromedriver binary to path
-from lxml import html
-from urllib.parse import urljoin
-from sqlalchemy import Table, Column, Integer, String, MetaData, Text, Boolean, DateTime, ForeignKey, BigInteger, \
-    create_engine, insert  # Python SQL toolkit essentials
-
-# Google cloud storage library
-from google.cloud import storage
-
-# Import the Secret Manager client library.
-from google.cloud import secretmanager
-
-project = 'tenders-284621'
-
-# Instantiates a client for logging
-client = google.cloud.logging.Client()
-
-# Retrieves a Cloud Logging handler based on the environment
-# you're running in and integrates the handler with the
-# Python logging module. By default this captures all logs
-# at INFO level and higher
-client.get_default_handler()
-client.setup_logging()
-
-# client-cert, client-key, server-ca
-def create_pem(pem_type, pem_content):
-    with open(pem_type+".pem", "w+", encoding='utf8', newline='\n') as fh:
-        fh.write(pem_content[:pem_content.find('-----', 1)+5]+'\n')
-        
-        value = pem_content[pem_content.find('-----', 1)+5:pem_content.rfind('-----END')]
-        for i in range(0, len(value) // 64):
-            fh.write(value[64*i:64*(i+1)]+'\n')
-        if (len(value) % 64 != 0):
-            fh.write(value[64*(len(value)//64)::]+'\n')     
-        
-        fh.write(pem_content[pem_content.rfind('-----END'):])
-
-        os.chmod(pem_type+".pem", 0o600)
-        fh.close()
-
-# Uploads file to Google storage
-def upload_blob(source_file_name, destination_blob_name):
-    """Uploads a file to the bucket."""
-    bucket_name = "tenders-attachments"
-
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-
-    blob.upload_from_filename(source_file_name)
-
-# Changes every unknown UTF-8 character
-def convert_characters(input):
-    utf8_letters = ['ą','ę','ć','ź','ż','ó','ł','ń','ś','Ą','Ę','Ć','Ź','Ż','Ó','Ł','Ń','Ś']
-    ascii_letters = ['a','e','c','z','z','o','l','n','s','A','E','C','Z','Z','O','L','N','S']
-    trans_dict = dict(zip(utf8_letters,ascii_letters))
-    out = []
-    for l in input:
-        out.append(trans_dict[l] if l in trans_dict else l)
-    return ''.join(out)
-
-# Link containing all tenders
-MAINLINK = "https://www.swz.kghm.pl/rfx/rfx/HomeServlet?MP_module=outErfx&MP_action=supplierStatus&iRfxRound="
-
-# Create the Secret Manager client.
-secrets_client = secretmanager.SecretManagerServiceClient()
-
-# Access the secret version.
-client_cert = secrets_client.access_secret_version(request={"name": "projects/"+project+"/secrets/db-client-cert/versions/1"}).payload.data.decode("utf-8")
-client_key = secrets_client.access_secret_version(request={"name": "projects/"+project+"/secrets/db-client-key/versions/1"}).payload.data.decode("utf-8")
-server_ca = secrets_client.access_secret_version(request={"name": "projects/"+project+"/secrets/db-server-ca/versions/1"}).payload.data.decode("utf-8")
-
-create_pem('client-cert', base64.b64decode(client_cert).decode("utf-8"))
-create_pem('client-key', base64.b64decode(client_key).decode("utf-8"))
-create_pem('server-ca', base64.b64decode(server_ca).decode("utf-8"))
-
-
-# Google Cloud SSL Configuration
-ssl_args = {'sslrootcert':'server-ca.pem',
-            'sslcert':'client-cert.pem',
-            'sslkey':'client-key.pem'}
-
-# Get ID from system arguments
-_id = sys.argv[1]
-date_published = sys.argv[2]
-
-# Convert date from timestamp to the correct format
-date_published = time.strftime(
-    "%Y-%m-%d %H:%M", time.localtime(int(date_published)))
-
-# Logging start
-logging.info(
-    "=================================================================================")
-logging.info("Tender scraping started")
-
-
-# The following options are required to make headless Chrome work in a Docker container
-chrome_options = webdriver.ChromeOptions()
-chrome_options.add_argument("--headless")
-chrome_options.add_argument("--disable-gpu")
-chrome_options.add_argument("window-size=1024,768")
-chrome_options.add_argument("--no-sandbox")
-
-# Initialize a new browser
-try:
-    browser = webdriver.Chrome(
-        options=chrome_options)
-except Exception as e:
-    logging.fatal("Browser didn't start - {}".format(str(e)))
-    sys.exit(1)
-
-logging.info("Browser started")
-
-#DELETE LATER
-f = open("server-ca.pem", "r")
-logging.info(f.read())
-
-
-# Postgresql connection strings
-DATABASE_HOST = os.environ["DATABASE_HOST"]
-DATABASE_CREDENTIALS = secrets_client.access_secret_version(request={"name": "projects/"+project+"/secrets/credentials/versions/1"}).payload.data.decode("utf-8")
-
-# Connect to database
-DATABASE_URI = "postgresql://" + DATABASE_CREDENTIALS + "@" + DATABASE_HOST
-try:
-    engine = create_engine(DATABASE_URI, connect_args=ssl_args)
-    connection = engine.connect()
-except Exception as e:
-    logging.fatal("Can't connect to Postgresql - {}".format(str(e)))
-    browser.quit()
-    sys.exit(1)
-
-# Retrieve notices/operators table
-metadata = MetaData(schema="tenders")
-notices_table = Table('notices', metadata, autoload=True, autoload_with=engine)
-operators_table = Table('operators', metadata, autoload=True, autoload_with=engine)
-items_table = Table('items', metadata, autoload=True, autoload_with=engine)
-
-browser.get(MAINLINK+_id)
-time.sleep(4)
-
-logging.info('Went to notice page for #{}'.format(_id))
-
-tree = html.fromstring(browser.page_source)
-root_url = browser.current_url
-
-logging.info("Extracting data from notice")
-
-
-deadline = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Data i godzina zakończenia czasu na składanie ofert")]/../*[2]))')
-
-div = browser.find_element_by_class_name('main')
-h = div.find_element_by_tag_name('h2')
-tender_name = h.text
-
-tender_number = tree.xpath(
-    'normalize-space(string(//span[contains(normalize-space(text()), "Numer postępowania")]/../*[2]))')
-supplier_status = tree.xpath(
-    'normalize-space(string(//span[contains(normalize-space(text()), "Status oferenta")]/../*[2]))')
-stage_number = tree.xpath(
-    'normalize-space(string(//span[contains(normalize-space(text()), "Numer etapu")]/../*[2]))')
-source_doc = tree.xpath(
-    'normalize-space(string(//span[contains(normalize-space(text()), "Dokument źródłowy")]/../*[2]))')
-items_count = tree.xpath(
-    'normalize-space(string(//span[contains(normalize-space(text()), "Liczba koszyków/ części w")]/../*[2]))')
-base_currency = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Waluta postępowania")]/../*[2]))')
-
-elem = wait(browser, 5).until(EC.presence_of_element_located((By.XPATH,
-                                                            '//a[contains(@title, "Pokaż dane kontaktowe")]')))
-browser.execute_script("arguments[0].click();", elem)
-time.sleep(2)
-
-tree = html.fromstring(browser.page_source)
-
-operator_email = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Email")]/../*[2]))')
-organisational_unit = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Jednostka organizacyjna")]/../*[2]))')
-tender_description = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Opis postępowania")]/../*[2]))')
-category = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Grupa asortymentowa")]/../*[2]))')
-is_framework_agreement = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Czy umowa ramowa?")]/../*[2]))')
-offer_deadline = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Data i godzina")]/../*[2]))')
-questions_deadline = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Ostateczny termin")]/../*[2]))')
-offer_validity_period = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Wymagany termin")]/../*[2]))')
-submitting_offers_type = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Możliwość składania ofert")]/../*[2]))')
-language_of_publication = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Język publikacji")]/../*[2]))')
-terms_of_participation = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Warunki udziału w postępowaniu")]/../*[2]))')
-contract_provosions = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Postanowienia umowy/ zlecenia")]/../*[2]))')
-
-logging.info("Started working on attachments for notice #{}".format(_id))
-
-attachments_name_list = []
-for attachment in tree.xpath('//table[contains(@class, "mp_gridTable")]//a[contains(@href, "FileDownload")]'):
-    at_name = attachment.xpath('normalize-space(string())')
-    at_name = convert_characters(at_name)
-
-    at_link = attachment.xpath('string(@href)')
-    at_link = urljoin(root_url, at_link)
-
-    date_type_path = datetime.datetime.strptime(
-        date_published, "%Y-%m-%d %H:%M")
-    date_path = "{}-{}".format(date_type_path.year, date_type_path.month)
-
-    full_path = os.path.join("temp", date_path, _id)
-
-    if not os.path.exists(full_path):
-        os.makedirs(full_path)
-
-    full_path = os.path.join(full_path, at_name)
-
-    # Download to temp folder for later upload to google storage bucket
-    try:
-        response = requests.get(at_link, stream=True)
-        with open(full_path, 'wb') as out_file:
-            shutil.copyfileobj(response.raw, out_file)
-        del response
-    except Exception as e:
-        logging.warning('Failed to download attachment "{}" locally on temp for Notice #{}'.format(at_name, _id))
-        pass
-    else:
-        logging.info('Saved attachment "{}" locally on temp for Notice #{}'.format(at_name, _id))
-        attachments_name_list.append(at_name)
-        pass
-
-logging.info("Finished downloading attachments locally. Starting upload.")
-
-# Upload files to storage yyyy-mm/id format
-attachments_urls_list = []
-for attachment_name in attachments_name_list:
-    full_path = os.path.join("temp", date_path, _id)
-    if not os.path.exists(full_path):
-        os.makedirs(full_path)
-    full_path = os.path.join(full_path, attachment_name)
-    attachment_url = date_path+"/"+_id+"/"+attachment_name
-    try:
-        upload_blob(full_path, attachment_url)
-    except Exception as e:
-        logging.warning('File "{}" failed to upload.'.format(full_path))
-        pass
-    else:
-        logging.info('File "{}" uploaded to "{}".'.format(full_path, attachment_url))
-        attachments_urls_list.append(attachment_url)
-        pass
-
-logging.info("Finished working on attachments for notice #{}".format(_id))
-
-
-currencies_name_list = []
-currency_ = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Dostępne waluty")]/../td//table//tr[2]/td[1]))')
-currencies_name_list.append(currency_)
-
-logging.info("Extracting operator for Notice #{}".format(_id))
-
-first_name = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Imię")]/../td))')
-last_name = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Nazwisko")]/../td))')
-address = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Ulica")]/../td))')
-city = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Miejscowość")]/../td))')
-post_code = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Kod pocztowy")]/../td))')
-email = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Email")]/../td))')
-phone = tree.xpath(
-    'normalize-space(string(//th[contains(normalize-space(text()), "Telefon")]/../td))')
-
-# Converting data to fit column types
-is_framework_agreement = False if "nie" in is_framework_agreement else True
-
-try:
-    year = deadline.split('(')[0].strip().split(' ')[0].split('-')[0]
-    month = deadline.split('(')[0].strip().split(' ')[0].split('-')[1]
-    day = deadline.split('(')[0].strip().split(' ')[0].split('-')[2]
-    hour = deadline.split('(')[0].strip().split(' ')[1].split(':')[0]
-    minute = deadline.split('(')[0].strip().split(' ')[1].split(':')[1]
-    deadline = datetime.datetime(int(year), int(
-        month), int(day), int(hour), int(minute))
-except:
-    deadline = None
-
-try:
-    year = offer_deadline.split(' ')[0].split('-')[0]
-    month = offer_deadline.split(' ')[0].split('-')[1]
-    day = offer_deadline.split(' ')[0].split('-')[2]
-    hour = offer_deadline.split(' ')[1].split(':')[0]
-    minute = offer_deadline.split(' ')[1].split(':')[1]
-    offer_deadline = datetime.datetime(
-        int(year), int(month), int(day), int(hour), int(minute))
-except:
-    offer_deadline = None
-
-try:
-    year = questions_deadline.split(' ')[0].split('-')[0]
-    month = questions_deadline.split(' ')[0].split('-')[1]
-    day = questions_deadline.split(' ')[0].split('-')[2]
-    hour = questions_deadline.split(' ')[1].split(':')[0]
-    minute = questions_deadline.split(' ')[1].split(':')[1]
-    questions_deadline = datetime.datetime(
-        int(year), int(month), int(day), int(hour), int(minute))
-except:
-    questions_deadline = None
-
-query = insert(operators_table).values(
-    first_name=first_name,
-    last_name=last_name,
-    address=address,
-    city=city,
-    postcode=post_code,
-    email=email,
-    phone=phone
-)
-
-try:
-    result_proxy = connection.execute(query)
-except:
-    pass
-
-logging.info('Operator saved/already been saved: {}'.format(email))
-
-
-query = insert(notices_table).values(
-    id=_id,
-    date_published=date_published,
-    deadline=deadline,
-    tender_name=tender_name,
-    tender_number=tender_number,
-
-    supplier_status=supplier_status,
-    stage_number=stage_number,
-    source_doc=source_doc,
-    items_count=int(items_count),
-    base_currency=base_currency,
-    operator_email=operator_email,
-    organisational_unit=organisational_unit,
-    tender_description=tender_description,
-    category=category,
-    is_framework_agreement=is_framework_agreement,
-
-    offer_deadline=offer_deadline,
-    questions_deadline=questions_deadline,
-    offers_validity_period=int(offer_validity_period),
-    submitting_offers_type=submitting_offers_type,
-    language_of_publication=language_of_publication,
-    terms_of_participation=terms_of_participation,
-    contract_provisions=contract_provosions,
-    attachments=attachments_name_list,
-    attachments_urls=attachments_urls_list,
-    currencies=currencies_name_list
-)
-
-try:
-    result_proxy = connection.execute(query)
-except Exception as e:
-    logging.error("An error occured - {}".format(e))
-    browser.quit()
-    sys.exit(1)
-    pass
-
-# Extracting items
-elem = wait(browser, 5).until(EC.presence_of_element_located((By.XPATH,
-                                                                '//a[contains(normalize-space(text()), "Oferta")]')))
-browser.execute_script("arguments[0].click();", elem)
-time.sleep(4)
-elem = wait(browser, 5).until(EC.presence_of_element_located((By.XPATH,
-                                                                '//select[contains(@name, "GD_pagesize")]')))
-elem.click()
-elem = wait(browser, 5).until(EC.presence_of_element_located((By.XPATH,
-                                                                '//select[contains(@name, "GD_pagesize")]/option[@value="100"]')))
-elem.click()
-time.sleep(4)
-logging.info('Went to Oferta for notice #{}'.format(_id))
-tree = html.fromstring(browser.page_source)
-item_id_list = []
-
-for item in tree.xpath('//table[contains(@class, "mp_gridTable")]//tr[contains(@class, "dataRow")]'):
-    item_id_list.append(
-        item.xpath('string(@id)')
-    )
-
-for item_id in item_id_list:
-    item_link = 'https://www.swz.kghm.pl/rfx/servlet/HomeServlet?MP_module=outErfx&MP_action=outerPositionDetails&iRequestPosition=656276&iRfxRound=458987'
-    item_link = item_link.replace(
-        "iRequestPosition=656276&", "iRequestPosition=" + str(item_id).strip() + "&")
-    item_link = item_link.replace(
-        "iRfxRound=458987", "iRfxRound=" + _id)
-    browser.get(item_link)
-    time.sleep(4)
-
-    logging.info(
-        'Extracting oferta #{} for notice #{}'.format(item_id, _id))
-
-    tree = html.fromstring(browser.page_source)
-    name = tree.xpath(
-        'normalize-space(string(//th[contains(normalize-space(text()), "Nazwa")]/../*[2]))')
-    quantity = tree.xpath(
-        'normalize-space(string(//th[contains(normalize-space(text()), "Ilość")]/../*[2]))')
-    details = tree.xpath(
-        'normalize-space(string(//th[contains(normalize-space(text()), "Opis")]/../*[2]))')
-    units = tree.xpath(
-        'normalize-space(string(//th[contains(normalize-space(text()), "Jednostka miary")]/../*[2]))')
-    supply_date = tree.xpath(
-        'normalize-space(string(//th[contains(normalize-space(text()), "Termin wykonania")]/../*[2]))')
-    bid_bond_amount_percent = tree.xpath(
-        'normalize-space(string(//th[contains(normalize-space(text()), "Wysokość należytego zabezpieczenia wykonania umowy w %")]/../*[2]))')
-    
-    # Bid bond amount percent
-    if bid_bond_amount_percent == '':
-        bid_bond_amount_percent = 0
-    else:
-        bid_bond_amount_percent = int(float(bid_bond_amount_percent.replace(',','.')))
-
-    query = insert(items_table).values(
-        id=str(uuid.uuid1()),
-        notice_id=_id,
-        name=name,
-        quantity=quantity,
-        description=details,
-        units=units,
-        supply_date=supply_date,
-        bid_bond_amount_percent=bid_bond_amount_percent
-    )
-    
-    try:
-        result_proxy = connection.execute(query)
-    except Exception as e:
-        logging.error("An error occured - {}".format(e))
-        browser.quit()
-        sys.exit(1)
-        pass
-
-    logging.info(
-        'Oferta  #{} for notice #{} saved.'.format(item_id, _id))
-
-logging.info('Notice #{} successfully saved.'.format(_id))
-browser.quit()
+import sys
+import os
+import datetime
+import time
+import uuid
+
+# Imports Python standard library logging
+import logging
+
+from urllib.parse import urljoin, urlparse, parse_qs
+from concurrent.futures import ProcessPoolExecutor, Future
+
+import requests
+
+# Single-pass field extraction
+from extract import extract, LabelIndex, NOTICE_FIELDS, CONTACT_FIELDS, OPERATOR_FIELDS, ITEM_FIELDS, \
+    TENDER_NAME, CURRENCY, ATTACHMENT_LINKS, ITEM_ROWS
+# Transactional writes of a notice
+from database import save_notice, update_notice
+# HTTP fetching with a headless Chrome fallback
+from fetcher import fetch_with_fallback, create_session, parse_body, HttpFetcher, MarkerNotFound, NOTICE_LINK, \
+    ITEM_LINK, CONTACT_LINK, OFFER_LINK, NEXT_PAGE_LINK, NOTICE_MARKER, CONTACT_MARKER, PAGE_SIZE_MARKER, ITEM_MARKER
+
+# Attachments streamed to the storage bucket
+from attachments import get_bucket, store_attachments, ensure_index, known_sources, object_name, source_url
+
+# Secrets, the shared engine and the reflected tables
+from runtime import connect, get_tables
+# Stage timers, counters and the per-run summary
+import metrics
+# Opt-in profiling of single runs
+import profiling
+# Raw pages of every scrape, for re-parsing
+import archive
+# Fingerprints of saved notices
+from changes import fingerprint, ensure_fingerprints, read_fingerprint, write_fingerprint, due_notices, RECHECK_BATCH, \
+    RECHECK_BUDGET
+
+# Item list pages followed per notice
+MAX_ITEM_PAGES = int(os.environ.get("MAX_ITEM_PAGES", 50))
+ITEMS_MARKER = '//table[contains(@class, "mp_gridTable")]'
+
+logging_ready = False
+
+
+class ScrapeError(Exception):
+    pass
+
+
+class ParseError(Exception):
+    """A page loaded fine but its content couldn't be read. item_ids lists the notice's items when known."""
+
+    def __init__(self, message, item_ids=None):
+        super().__init__(message)
+        self.item_ids = item_ids
+
+
+def setup_logging():
+    global logging_ready
+    if logging_ready:
+        return
+
+    # Imports the Cloud Logging client library, only when logging is set up
+    import google.cloud.logging
+
+    # Instantiates a client for logging
+    client = google.cloud.logging.Client()
+
+    # Retrieves a Cloud Logging handler based on the environment
+    # you're running in and integrates the handler with the
+    # Python logging module. By default this captures all logs
+    # at INFO level and higher
+    client.get_default_handler()
+    client.setup_logging()
+    logging_ready = True
+
+# Changes every unknown UTF-8 character
+def convert_characters(input):
+    utf8_letters = ['ą','ę','ć','ź','ż','ó','ł','ń','ś','Ą','Ę','Ć','Ź','Ż','Ó','Ł','Ń','Ś']
+    ascii_letters = ['a','e','c','z','z','o','l','n','s','A','E','C','Z','Z','O','L','N','S']
+    trans_dict = dict(zip(utf8_letters,ascii_letters))
+    out = []
+    for l in input:
+        out.append(trans_dict[l] if l in trans_dict else l)
+    return ''.join(out)
+
+
+# Reads the fields of an item details page
+def parse_item(tree):
+    with metrics.stage("extract"):
+        item = extract(tree, ITEM_FIELDS)
+
+    # Bid bond amount percent
+    if item["bid_bond_amount_percent"] == '':
+        item["bid_bond_amount_percent"] = 0
+    else:
+        try:
+            item["bid_bond_amount_percent"] = int(float(item["bid_bond_amount_percent"].replace(',','.')))
+        except ValueError:
+            raise ParseError('Bad bid bond amount percent "{}"'.format(item["bid_bond_amount_percent"]))
+
+    return item
+
+
+# Visits the notice and its contact panel, all a recheck needs. With opened the fetcher is on the notice page
+# already.
+def fetch_summary(fetcher, _id, opened=False):
+    pages = {}
+    pages["notice"] = fetcher.tree if opened else fetcher.open(NOTICE_LINK+_id, NOTICE_MARKER)
+    pages["root_url"] = fetcher.url
+    logging.info('Went to notice page for #{}'.format(_id))
+
+    pages["contact"] = fetcher.click(CONTACT_LINK, CONTACT_MARKER)
+    return pages
+
+
+# Visits the notice, its contact panel, every page of the "Oferta" tab and every item page
+def fetch_notice(fetcher, _id, opened=False):
+    pages = fetch_summary(fetcher, _id, opened)
+
+    fetcher.click(OFFER_LINK, PAGE_SIZE_MARKER)
+    tree = fetcher.select_page_size(100)
+    logging.info('Went to Oferta for notice #{}'.format(_id))
+
+    item_ids = []
+    for page in range(1, MAX_ITEM_PAGES + 1):
+        for item in ITEM_ROWS(tree):
+            item_id = item.xpath('string(@id)').strip()
+            if item_id not in item_ids:
+                item_ids.append(item_id)
+        if not tree.xpath(NEXT_PAGE_LINK):
+            break
+        tree = fetcher.click(NEXT_PAGE_LINK, ITEMS_MARKER)
+
+    logging.info('Fetching {} oferta pages for notice #{}'.format(len(item_ids), _id))
+    # The other item pages still finish loading when one can't be parsed, so all of them get archived
+    try:
+        items = fetcher.open_many([ITEM_LINK.format(item_id, _id) for item_id in item_ids], ITEM_MARKER, parse_item)
+    except ParseError as e:
+        raise ParseError("Item page of notice #{} - {}".format(_id, str(e)), item_ids)
+    pages["items"] = list(zip(item_ids, items))
+    return pages
+
+
+# Detail fields, tender name, contact page index and (name, url) attachments of the summary pages
+def read_summary(pages):
+    tree = pages["notice"]
+    fields = extract(tree, NOTICE_FIELDS)
+    tender_name = TENDER_NAME(tree)
+
+    index = LabelIndex(pages["contact"])
+    fields.update(index.extract(CONTACT_FIELDS))
+    fields["currency"] = CURRENCY(pages["contact"])
+
+    attachments = []
+    for attachment in ATTACHMENT_LINKS(pages["contact"]):
+        at_name = attachment.xpath('normalize-space(string())')
+        at_name = convert_characters(at_name)
+
+        at_link = attachment.xpath('string(@href)')
+        at_link = urljoin(pages["root_url"], at_link)
+
+        attachments.append((at_name, at_link))
+    return fields, tender_name, index, attachments
+
+
+# Fetches notice _id, stores its attachments and returns what is saved for it: dict(notice=..., operator=...,
+# items=[...], attachments=[...] index rows, fingerprint=...). published is a unix timestamp or None.
+# The raw pages are archived first when archiving is on (see archive.py), also when one of them can't be parsed.
+# With probe the notice page is loaded over plain HTTP first and None is returned when the portal has no
+# such notice; the scrape then continues from that page.
+def build_notice(_id, published, engine, session, browser=None, probe=False):
+    recording = archive.start_recording()
+    probed = None
+    if probe:
+        probed = HttpFetcher(session)
+        probed.recording = recording
+        try:
+            probed.open(NOTICE_LINK + _id, NOTICE_MARKER)
+        except MarkerNotFound:
+            return None
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise ScrapeError("Couldn't load notice #{} - {}".format(_id, str(e)))
+        except requests.RequestException as e:
+            raise ScrapeError("Couldn't load notice #{} - {}".format(_id, str(e)))
+
+    try:
+        pages = fetch_with_fallback(lambda fetcher: fetch_notice(fetcher, _id, opened=fetcher is probed), session,
+                                    browser, recording, fetcher=probed)
+    except ParseError as e:
+        # Kept for a re-parse once the parser handles the page
+        archive.save(_id, published, e.item_ids or [], recording)
+        raise ScrapeError("Couldn't parse notice #{} - {}".format(_id, str(e)))
+    except Exception as e:
+        raise ScrapeError("Couldn't load notice #{} - {}".format(_id, str(e)))
+    archive.save(_id, published, [item_id for item_id, _ in pages["items"]], recording)
+
+    return assemble_notice(_id, published, pages, engine,
+                           lambda attachments, known: store_attachments(get_bucket(), session, attachments, known))
+
+
+# What is saved for notice _id given its fetched pages. store(attachments, known) stores the
+# (name, url) attachments not among known ({source url: (sha256, size)}) and returns (name, source url, sha256,
+# size) of all.
+def assemble_notice(_id, published, pages, engine, store):
+    # Convert date from timestamp to the correct format
+    date_published = None if published is None else time.strftime(
+        "%Y-%m-%d %H:%M", time.localtime(int(published)))
+
+    logging.info("Extracting data from notice")
+
+    with metrics.stage("extract"):
+        fields, tender_name, index, attachments = read_summary(pages)
+    notice_fingerprint = fingerprint(fields, tender_name, attachments)
+
+    logging.info("Started working on attachments for notice #{}".format(_id))
+
+    # Stream to google storage bucket, stored once per content hash
+    ensure_index(engine)
+    with engine.connect() as connection:
+        known = known_sources(connection, [at_link for _, at_link in attachments])
+
+    with metrics.stage("attachments"):
+        stored = store(attachments, known)
+    attachments_name_list = [name for name, _, _, _ in stored]
+    attachments_urls_list = [object_name(sha256) for _, _, sha256, _ in stored]
+    attachments_index = [dict(notice_id=_id, filename=name, sha256=sha256, size=size, source_url=url)
+                         for name, url, sha256, size in stored]
+
+    logging.info("Finished working on attachments for notice #{}".format(_id))
+
+
+    currencies_name_list = [fields["currency"]]
+
+    logging.info("Extracting operator for Notice #{}".format(_id))
+
+    with metrics.stage("extract"):
+        operator = index.extract(OPERATOR_FIELDS)
+
+    # Converting data to fit column types
+    is_framework_agreement = False if "nie" in fields["is_framework_agreement"] else True
+
+    try:
+        deadline = fields["deadline"]
+        year = deadline.split('(')[0].strip().split(' ')[0].split('-')[0]
+        month = deadline.split('(')[0].strip().split(' ')[0].split('-')[1]
+        day = deadline.split('(')[0].strip().split(' ')[0].split('-')[2]
+        hour = deadline.split('(')[0].strip().split(' ')[1].split(':')[0]
+        minute = deadline.split('(')[0].strip().split(' ')[1].split(':')[1]
+        deadline = datetime.datetime(int(year), int(
+            month), int(day), int(hour), int(minute))
+    except:
+        deadline = None
+
+    try:
+        offer_deadline = fields["offer_deadline"]
+        year = offer_deadline.split(' ')[0].split('-')[0]
+        month = offer_deadline.split(' ')[0].split('-')[1]
+        day = offer_deadline.split(' ')[0].split('-')[2]
+        hour = offer_deadline.split(' ')[1].split(':')[0]
+        minute = offer_deadline.split(' ')[1].split(':')[1]
+        offer_deadline = datetime.datetime(
+            int(year), int(month), int(day), int(hour), int(minute))
+    except:
+        offer_deadline = None
+
+    try:
+        questions_deadline = fields["questions_deadline"]
+        year = questions_deadline.split(' ')[0].split('-')[0]
+        month = questions_deadline.split(' ')[0].split('-')[1]
+        day = questions_deadline.split(' ')[0].split('-')[2]
+        hour = questions_deadline.split(' ')[1].split(':')[0]
+        minute = questions_deadline.split(' ')[1].split(':')[1]
+        questions_deadline = datetime.datetime(
+            int(year), int(month), int(day), int(hour), int(minute))
+    except:
+        questions_deadline = None
+
+    notice = dict(
+        id=_id,
+        date_published=date_published,
+        deadline=deadline,
+        tender_name=tender_name,
+        tender_number=fields["tender_number"],
+
+        supplier_status=fields["supplier_status"],
+        stage_number=fields["stage_number"],
+        source_doc=fields["source_doc"],
+        items_count=int(fields["items_count"]),
+        base_currency=fields["base_currency"],
+        operator_email=fields["operator_email"],
+        organisational_unit=fields["organisational_unit"],
+        tender_description=fields["tender_description"],
+        category=fields["category"],
+        is_framework_agreement=is_framework_agreement,
+
+        offer_deadline=offer_deadline,
+        questions_deadline=questions_deadline,
+        offers_validity_period=int(fields["offer_validity_period"]),
+        submitting_offers_type=fields["submitting_offers_type"],
+        language_of_publication=fields["language_of_publication"],
+        terms_of_participation=fields["terms_of_participation"],
+        contract_provisions=fields["contract_provisions"],
+        attachments=attachments_name_list,
+        attachments_urls=attachments_urls_list,
+        currencies=currencies_name_list
+    )
+
+    items = [dict(id=str(uuid.uuid1()), notice_id=_id, **item) for item_id, item in pages["items"]]
+
+    return dict(notice=notice, operator=operator, items=items, attachments=attachments_index,
+                fingerprint=notice_fingerprint)
+
+
+# Scrapes notice _id published at the unix timestamp `published` and saves it with its operator and items.
+# engine, session and browser are reused when given (see workers.py), otherwise created for this call.
+# With update=True the notice is already saved (published may be None) and only its differences are written.
+@metrics.recorded("scrape", lambda _id, *args, **kwargs: dict(notice_id=str(_id)))
+def scrape_notice(_id, published, engine=None, session=None, browser=None, update=False):
+    _id = str(_id)
+
+    # Logging start
+    logging.info(
+        "=================================================================================")
+    logging.info("Tender scraping started")
+
+    # Connect to database
+    if engine is None:
+        try:
+            engine = connect()
+        except Exception as e:
+            raise ScrapeError("Can't connect to Postgresql - {}".format(str(e)))
+
+    notices_table, operators_table, items_table = get_tables(engine)
+
+    # The portal session is also used to download the attachments
+    if session is None:
+        session = create_session()
+
+    record = build_notice(_id, published, engine, session, browser)
+    notice, operator, items = record["notice"], record["operator"], record["items"]
+    attachments_index, notice_fingerprint = record["attachments"], record["fingerprint"]
+
+    # Operator, notice and items are saved in one transaction
+    ensure_fingerprints(engine)
+    try:
+        with metrics.stage("db_write"), engine.connect() as connection:
+            if update:
+                changed = update_notice(connection, (notices_table, operators_table, items_table), notice, operator,
+                                        items, attachments_index, notice_fingerprint)
+            else:
+                saved = save_notice(connection, (notices_table, operators_table, items_table), notice, operator,
+                                    items, attachments_index, notice_fingerprint)
+    except Exception as e:
+        raise ScrapeError("Notice #{} wasn't saved - {}".format(_id, e))
+
+    metrics.observe("items_per_notice", len(items), buckets=metrics.ITEM_BUCKETS)
+    if update:
+        logging.info('Notice #{} updated: {}'.format(_id, changed))
+        return changed
+    if saved:
+        logging.info('Notice #{} successfully saved with {} oferta, operator {}.'.format(_id, len(items), operator["email"]))
+
+
+# Fetches only the notice and contact pages of a saved notice and scrapes it again if their fingerprint
+# changed. Returns True when the notice had changed.
+@metrics.recorded("recheck", lambda _id, *args, **kwargs: dict(notice_id=str(_id)))
+def recheck_notice(_id, engine=None, session=None, browser=None):
+    _id = str(_id)
+    if engine is None:
+        engine = connect()
+    if session is None:
+        session = create_session()
+    ensure_fingerprints(engine)
+
+    try:
+        pages = fetch_with_fallback(lambda fetcher: fetch_summary(fetcher, _id), session, browser)
+    except Exception as e:
+        raise ScrapeError("Couldn't load notice #{} - {}".format(_id, str(e)))
+    with metrics.stage("extract"):
+        fields, tender_name, index, attachments = read_summary(pages)
+    current = fingerprint(fields, tender_name, attachments)
+
+    with engine.connect() as connection:
+        stored = read_fingerprint(connection, _id)
+        if stored == current:
+            write_fingerprint(connection, _id, current, changed=False)
+            logging.info("Notice #{} unchanged".format(_id))
+            return False
+
+    if stored is None:
+        # Saved before fingerprints existed, so nothing tells what changed since: the full scrape compares
+        # every saved column and row and stores the fingerprint for the next rechecks
+        logging.info("Notice #{} has no fingerprint yet, scraping it again".format(_id))
+        changed = scrape_notice(_id, None, engine=engine, session=session, browser=browser, update=True)
+        return changed is None or any(changed.values())
+
+    logging.info("Notice #{} changed since it was saved, scraping it again".format(_id))
+    scrape_notice(_id, None, engine=engine, session=session, browser=browser, update=True)
+    return True
+
+
+# Rechecks the open notices that are due, returns (checked, changed, failed) counts. submit(_id) runs
+# recheck_notice elsewhere and returns its future (see workers.ScraperPool.submit_recheck), otherwise the
+# notices are rechecked here one after another. No recheck is started after budget seconds, the notices
+# left stay due for the next call.
+def recheck(limit=RECHECK_BATCH, engine=None, submit=None, budget=RECHECK_BUDGET):
+    if engine is None:
+        engine = connect()
+    notices_table = get_tables(engine)[0]
+    ensure_fingerprints(engine)
+    with engine.connect() as connection:
+        due = due_notices(connection, notices_table, limit)
+
+    logging.info("Rechecking {} notices".format(len(due)))
+    session = None
+    if submit is None:
+        session = create_session()
+        submit = lambda _id: recheck_now(_id, engine, session)
+
+    deadline = time.monotonic() + budget
+    futures = []
+    try:
+        for _id in due:
+            if time.monotonic() > deadline:
+                logging.info("Recheck time is up, {} notices left for the next one".format(len(due) - len(futures)))
+                break
+            futures.append((_id, submit(_id)))
+
+        changed = failed = 0
+        for _id, future in futures:
+            try:
+                changed += future.result()
+            except Exception as e:
+                failed += 1
+                logging.error("Recheck of #{} failed - {}".format(_id, str(e)))
+    finally:
+        if session is not None:
+            session.close()
+    logging.info("Rechecked {} notices, {} changed, {} failed".format(len(futures), changed, failed))
+    return len(futures), changed, failed
+
+
+# recheck_notice run on this thread, as a finished future
+def recheck_now(_id, engine, session):
+    future = Future()
+    try:
+        future.set_result(recheck_notice(_id, engine=engine, session=session))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+# The pages dict of fetch_notice, rebuilt from the header and pages of an archived record
+def archived_pages(header, pages):
+    trees = {}
+    items = {}
+    for page, body in pages:
+        if page["kind"] == "item":
+            item_id = parse_qs(urlparse(page["url"]).query).get("iRequestPosition", [None])[0]
+            items[item_id] = parse_item(parse_body(page["content_type"], body))
+        elif page["kind"] in ("notice", "contact"):
+            trees[page["kind"]] = (page["url"], parse_body(page["content_type"], body))
+    missing = [item_id for item_id in header["items"] if item_id not in items]
+    if "notice" not in trees or "contact" not in trees or missing:
+        raise ScrapeError("Archived pages of #{} incomplete".format(header["notice_id"]))
+    return dict(notice=trees["notice"][1], root_url=trees["notice"][0], contact=trees["contact"][1],
+                items=[(item_id, items[item_id]) for item_id in header["items"]])
+
+
+# Attachments of a re-parsed notice, they must have been stored when it was scraped. A scrape that failed
+# to parse the pages stored none, those notices are scraped again instead.
+def stored_attachments(attachments, known):
+    missing = [name for name, url in attachments if source_url(url) not in known]
+    if missing:
+        raise ScrapeError("Attachments never stored, scrape the notice again: {}".format(", ".join(missing)))
+    return [(name, source_url(url)) + tuple(known[source_url(url)]) for name, url in attachments]
+
+
+# Rebuilds the rows of an archived notice (an entry of archive.latest) without the portal and writes what
+# differs from the saved ones. Returns the differences, None when the notice was saved as a new one.
+@metrics.recorded("reparse", lambda entry, *args, **kwargs: dict(notice_id=entry["notice_id"]))
+def reparse_notice(entry, engine=None):
+    if engine is None:
+        engine = connect()
+    header, pages = archive.read(entry)
+    with metrics.stage("parse"):
+        pages = archived_pages(header, pages)
+    record = assemble_notice(header["notice_id"], header["published"], pages, engine, stored_attachments)
+
+    ensure_fingerprints(engine)
+    with metrics.stage("db_write"), engine.connect() as connection:
+        return update_notice(connection, get_tables(engine), record["notice"], record["operator"], record["items"],
+                             record["attachments"], record["fingerprint"])
+
+
+# "changed", "unchanged" or "failed" for the re-parse of entry
+def reparse_entry(entry, engine=None):
+    try:
+        changes = reparse_notice(entry, engine)
+    except Exception as e:
+        logging.error("Re-parsing #{} failed - {}".format(entry["notice_id"], str(e)))
+        return "failed"
+    if changes is None or any(changes.values()):
+        logging.info("Notice #{} re-parsed: {}".format(entry["notice_id"], changes))
+        return "changed"
+    return "unchanged"
+
+
+# Re-parses the newest archived pages of every notice (fetched since the unix time `since`) on `processes`
+# processes forked from the fork server, all cores by default. 0 runs them in this process, on engine.
+# Returns (reparsed, changed, failed) counts.
+def reparse(since=None, processes=None, engine=None):
+    import startup
+
+    if processes is None:
+        processes = os.cpu_count()
+    if processes and engine is not None:
+        raise ValueError("Re-parsing processes open their own engine, none can be passed")
+    entries = archive.latest(since=since)
+    logging.info("Re-parsing {} archived notices".format(len(entries)))
+
+    started = time.time()
+    if processes:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=startup.fork_server(),
+                                 initializer=setup_logging) as executor:
+            results = list(executor.map(reparse_entry, entries, chunksize=16))
+    else:
+        results = [reparse_entry(entry, engine) for entry in entries]
+
+    changed, failed = results.count("changed"), results.count("failed")
+    elapsed = time.time() - started
+    logging.info("Re-parsed {} notices in {:.1f} s ({:.0f}/s), {} changed, {} failed".format(
+        len(results), elapsed, len(results) / elapsed if elapsed else 0, changed, failed))
+    return len(results), changed, failed
+
+
+if __name__ == "__main__":
+    setup_logging()
+
+    # Get ID and publication timestamp from system arguments, "recheck", or "reparse [since unix time]"
+    try:
+        if sys.argv[1] == "recheck":
+            recheck()
+        elif sys.argv[1] == "reparse":
+            reparse(since=float(sys.argv[2]) if len(sys.argv) > 2 else None)
+        else:
+            with profiling.profiled(profiling.artifact_name("scrape", sys.argv[1])):
+                scrape_notice(sys.argv[1], sys.argv[2])
+    except Exception as e:
+        logging.fatal(str(e))
+        sys.exit(1)
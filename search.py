@@ -0,0 +1,197 @@
+# search.py
+# Full-text search over notices and their items. Postgres keeps a weighted tsvector of every notice (name,
+# category, description) and item (name, description) in a generated column, so each row the scraper
+# writes or updates is searchable as soon as it is committed, and GIN indexes answer the queries.
+# `python search.py migrate` adds the columns and indexes once; it rewrites both tables.
+
+import os
+import re
+import sys
+import json
+import time
+import base64
+import datetime
+import logging
+import threading
+
+from sqlalchemy import text, bindparam
+
+import metrics
+
+# Text search configuration. simple doesn't stem (Postgres ships no Polish one), words match as prefixes.
+SEARCH_CONFIG = os.environ.get("SEARCH_CONFIG", "simple")
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", 20))
+MAX_PAGE_SIZE = 100
+# Matching items listed with each notice
+MATCHED_ITEMS = 5
+
+
+class SearchNotReady(Exception):
+    pass
+
+
+# setweight(to_tsvector(...)) of column, NULLs searched as empty text
+def vector(column, weight, config=SEARCH_CONFIG):
+    if not re.match(r"^\w+$", config):
+        raise ValueError("Bad text search configuration {}".format(config))
+    return "setweight(to_tsvector('{}'::regconfig, coalesce({}, '')), '{}')".format(config, column, weight)
+
+
+def migration():
+    return [
+        "ALTER TABLE tenders.notices ADD COLUMN IF NOT EXISTS search tsvector GENERATED ALWAYS AS "
+        "({} || {} || {}) STORED".format(vector("tender_name", "A"), vector("category", "B"),
+                                          vector("tender_description", "C")),
+        "ALTER TABLE tenders.items ADD COLUMN IF NOT EXISTS search tsvector GENERATED ALWAYS AS "
+        "({} || {}) STORED".format(vector("name", "A"), vector("description", "C")),
+        "CREATE INDEX IF NOT EXISTS notices_search ON tenders.notices USING gin (search)",
+        "CREATE INDEX IF NOT EXISTS items_search ON tenders.items USING gin (search)",
+        # Pages of results are read newest first, backfilled notices without a publication date last
+        "DROP INDEX IF EXISTS tenders.notices_published_id",
+        "CREATE INDEX IF NOT EXISTS notices_published_nulls_last ON tenders.notices "
+        "(date_published DESC NULLS LAST, id DESC)",
+    ]
+
+
+def migrate(engine):
+    with engine.begin() as connection:
+        for statement in migration():
+            logging.info("Running {}".format(statement))
+            connection.execute(text(statement))
+    logging.info("Search columns and indexes are in place")
+
+
+ready = set()
+ready_lock = threading.Lock()
+
+
+# Raises SearchNotReady until the migration ran on engine's database
+def ensure_ready(connection):
+    with ready_lock:
+        if connection.engine in ready:
+            return
+    if connection.dialect.name != "postgresql":
+        raise SearchNotReady("Search needs Postgres, not {}".format(connection.dialect.name))
+    columns = connection.execute(text(
+        "SELECT count(*) FROM information_schema.columns WHERE table_schema = 'tenders' "
+        "AND table_name IN ('notices', 'items') AND column_name = 'search'")).scalar()
+    if columns < 2:
+        raise SearchNotReady("Search columns missing, run `python search.py migrate`")
+    with ready_lock:
+        ready.add(connection.engine)
+
+
+# to_tsquery text matching every word of q as a prefix, None without any words
+def prefix_query(q):
+    words = re.findall(r"\w+", (q or "").lower())
+    return " & ".join(word + ":*" for word in words) or None
+
+
+# Opaque position after the last result of a page
+def encode_cursor(date_published, _id):
+    value = json.dumps([date_published.isoformat() if hasattr(date_published, "isoformat") else date_published, _id])
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        date_published, _id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError):
+        raise ValueError("Bad cursor {}".format(cursor))
+    return date_published, _id
+
+
+def iso(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+# Notices matching q in their own text or an item's, filtered, newest first and the ones without a publication
+# date (backfilled) last. after is the cursor of the previous page. Returns (notices, cursor of the next page or None).
+def find(connection, q=None, category=None, currency=None, deadline_from=None, deadline_to=None, after=None,
+         limit=SEARCH_PAGE_SIZE):
+    ensure_ready(connection)
+    parameters = dict(config=SEARCH_CONFIG, limit=limit)
+    conditions = []
+    matches = ""
+    query = prefix_query(q)
+    if query is not None:
+        # A union of both index scans, an OR across the two tables would read every notice
+        parameters["query"] = query
+        matches = ("JOIN (SELECT id FROM tenders.notices WHERE search @@ to_tsquery(CAST(:config AS regconfig), :query) "
+                   "UNION SELECT notice_id FROM tenders.items WHERE search @@ to_tsquery(CAST(:config AS regconfig), "
+                   ":query)) m ON m.id = n.id ")
+    for condition, name, value in (("n.category = :category", "category", category),
+                                   ("n.base_currency = :currency", "currency", currency),
+                                   ("n.deadline >= :deadline_from", "deadline_from", deadline_from),
+                                   ("n.deadline <= :deadline_to", "deadline_to", deadline_to)):
+        if value is not None:
+            conditions.append(condition)
+            parameters[name] = value
+    if after is not None:
+        parameters["after_published"], parameters["after_id"] = decode_cursor(after)
+        if parameters["after_published"] is None:
+            # Already among the notices without a publication date (backfilled ones), which come last
+            conditions.append("n.date_published IS NULL AND n.id < :after_id")
+        else:
+            conditions.append("((n.date_published, n.id) < (CAST(:after_published AS timestamp), :after_id) "
+                              "OR n.date_published IS NULL)")
+
+    statement = ("SELECT n.id, n.tender_name, n.category, n.deadline, n.base_currency, n.date_published "
+                 "FROM tenders.notices n " + matches + "WHERE " + (" AND ".join(conditions) or "TRUE") +
+                 " ORDER BY n.date_published DESC NULLS LAST, n.id DESC LIMIT :limit")
+    rows = connection.execute(text(statement), parameters).fetchall()
+    notices = [dict(id=row.id, tender_name=row.tender_name, category=row.category, deadline=iso(row.deadline),
+                    base_currency=row.base_currency, date_published=iso(row.date_published), items=[])
+               for row in rows]
+
+    if query is not None and notices:
+        items = text("SELECT notice_id, id, name FROM (SELECT notice_id, id, name, row_number() OVER "
+                     "(PARTITION BY notice_id ORDER BY ts_rank(search, to_tsquery(CAST(:config AS regconfig), :query)) "
+                     "DESC, id) AS position FROM tenders.items WHERE notice_id IN :ids "
+                     "AND search @@ to_tsquery(CAST(:config AS regconfig), :query)) matched "
+                     "WHERE position <= :matched").bindparams(bindparam("ids", expanding=True))
+        by_id = dict((notice["id"], notice) for notice in notices)
+        for row in connection.execute(items, dict(config=SEARCH_CONFIG, query=query, ids=list(by_id),
+                                                  matched=MATCHED_ITEMS)):
+            by_id[row.notice_id]["items"].append(dict(id=row.id, name=row.name))
+
+    cursor = encode_cursor(rows[-1].date_published, rows[-1].id) if len(rows) == limit else None
+    return notices, cursor
+
+
+def parse_date(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("{} must be an ISO date, not {}".format(name, value))
+
+
+# A page of results for the query string arguments of /search:
+# q, category, currency, deadline_from, deadline_to (ISO dates), limit and after (cursor of the last page)
+def search_page(engine, args):
+    try:
+        limit = min(MAX_PAGE_SIZE, max(1, int(args.get("limit", SEARCH_PAGE_SIZE))))
+    except ValueError:
+        raise ValueError("limit must be a number")
+    started = time.perf_counter()
+    with metrics.stage("search"):
+        with engine.connect() as connection:
+            notices, cursor = find(connection, q=args.get("q"), category=args.get("category") or None,
+                                   currency=args.get("currency") or None,
+                                   deadline_from=parse_date(args, "deadline_from"),
+                                   deadline_to=parse_date(args, "deadline_to"), after=args.get("after") or None,
+                                   limit=limit)
+    return dict(results=notices, next=cursor, took_ms=round((time.perf_counter() - started) * 1000, 1))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from runtime import get_engine
+
+    if sys.argv[1:] == ["migrate"]:
+        migrate(get_engine())
+    else:
+        print(json.dumps(search_page(get_engine(), dict(q=" ".join(sys.argv[1:]))), indent=2, ensure_ascii=False))
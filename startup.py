@@ -0,0 +1,103 @@
+# startup.py
+# Cold start helpers. The web process answers its first request before the heavy libraries are loaded;
+# they are imported afterwards in a background thread, timing every import, and scraper processes are
+# forked from a fork server that already imported them.
+
+import os
+import sys
+import time
+import logging
+import threading
+import importlib
+import multiprocessing
+
+STARTED = time.time()
+
+# The service's own modules, cheap since the libraries below are imported where they are used
+MODULES = ["metrics", "profiling", "extract", "governor", "chrome", "fetcher", "changes", "operators", "database",
+           "attachments", "archive", "runtime", "scheduler", "enqueue", "jobqueue", "scanner", "scraper", "workers"]
+# Libraries on the path of every scan and scrape. Selenium is left out, the browser is only a fallback.
+LIBRARIES = ["sqlalchemy", "requests", "lxml.html", "google.cloud.logging", "google.cloud.secretmanager",
+             "google.cloud.storage", "google.cloud.tasks_v2", "google.api_core.exceptions",
+             "google.protobuf.timestamp_pb2"]
+# Imported in the background after startup, 0 turns it off
+PREWARM = os.environ.get("PREWARM", "1") == "1"
+
+# module name -> seconds its first import took, None when it couldn't be imported
+imports = {}
+imports_lock = threading.Lock()
+first_request = None
+warm = None
+context = None
+context_lock = threading.Lock()
+
+
+# Imports module name and records how long it took, if it wasn't imported yet
+def timed_import(name):
+    if name in sys.modules:
+        return
+    started = time.perf_counter()
+    try:
+        importlib.import_module(name)
+    except ImportError as e:
+        logging.warning("Couldn't import {} - {}".format(name, str(e)))
+        seconds = None
+    else:
+        seconds = time.perf_counter() - started
+    with imports_lock:
+        imports[name] = seconds
+
+
+# Imports the libraries and modules a scan or scrape needs, returns the import report
+def prewarm(names=None):
+    global warm
+    started = time.perf_counter()
+    for name in names or LIBRARIES + MODULES:
+        timed_import(name)
+    if names is None:
+        warm = time.time() - STARTED
+        logging.info("Prewarmed in {:.0f} ms, {:.0f} ms after start".format(
+            (time.perf_counter() - started) * 1000, warm * 1000))
+    return report()
+
+
+def prewarm_in_background():
+    if PREWARM:
+        threading.Thread(target=prewarm, name="prewarm", daemon=True).start()
+
+
+# Called on every request, remembers when the first one was answered
+def request_seen():
+    global first_request
+    if first_request is None:
+        first_request = time.time() - STARTED
+
+
+# Milliseconds from startup to the first request and to warm, and the imports slowest first
+def report():
+    with imports_lock:
+        timed = sorted(imports.items(), key=lambda item: -(item[1] or 0))
+    return {
+        "first_request_ms": None if first_request is None else round(first_request * 1000, 1),
+        "warm_ms": None if warm is None else round(warm * 1000, 1),
+        "imports_ms": [(name, None if seconds is None else round(seconds * 1000, 1)) for name, seconds in timed],
+    }
+
+
+# Multiprocessing context whose processes are forked from a server that imported MODULES and LIBRARIES.
+# The server is started in the background on first call, forking from it skips every import.
+def fork_server():
+    global context
+    with context_lock:
+        if context is None:
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(LIBRARIES + MODULES)
+            from multiprocessing import forkserver
+            forkserver.ensure_running()
+        return context
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for name, ms in prewarm()["imports_ms"]:
+        print("{:<32}{:>10}".format(name, "failed" if ms is None else "{:.1f} ms".format(ms)))
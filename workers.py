@@ -0,0 +1,256 @@
+# workers.py
+# Warm scraper workers living inside the gunicorn process, or with SCRAPER_PROCESSES=1 in processes forked
+# from the prewarmed fork server in startup.py. Each worker keeps its HTTP session and, when the HTTP path
+# needed it, a headless Chrome between notices; all workers of a process share one DB engine.
+
+import os
+import time
+import threading
+import logging
+import multiprocessing.util
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import scraper
+import startup
+import metrics
+import profiling
+from runtime import get_engine, get_tables
+from operators import operator_cache
+from scheduler import record_scrape
+from fetcher import create_session, BrowserFetcher
+from chrome import browser_rss
+
+# Notices scraped at the same time
+SCRAPER_WORKERS = int(os.environ.get("SCRAPER_WORKERS", 2))
+# Notices allowed to wait for a free worker, requests beyond that are turned away
+SCRAPER_QUEUE = int(os.environ.get("SCRAPER_QUEUE", 4))
+# A worker's browser is restarted after this many pages or above this memory (browser + chromedriver)
+BROWSER_MAX_PAGES = int(os.environ.get("BROWSER_MAX_PAGES", 200))
+BROWSER_MAX_RSS_MB = int(os.environ.get("BROWSER_MAX_RSS_MB", 700))
+# 1 runs the workers as processes forked from the prewarmed fork server instead of threads
+SCRAPER_PROCESSES = os.environ.get("SCRAPER_PROCESSES", "0") == "1"
+
+
+class PoolFull(Exception):
+    pass
+
+
+class Worker:
+    """State kept by one scraper thread between notices."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.session = create_session()
+        self.browser = None
+        self.scraped = 0
+
+    def fallback_browser(self):
+        if self.browser is None:
+            self.browser = BrowserFetcher()
+            logging.info("Browser started for {}".format(threading.current_thread().name))
+        return self.browser
+
+    # profile names the profiling artifacts of this scrape, see profiling.py
+    def scrape(self, _id, published, profile=None):
+        started = time.time()
+        succeeded = False
+        # Without an engine of its own the worker asks for the shared one, which follows rotated secrets
+        engine = self.engine if self.engine is not None else get_engine()
+        self.warm(engine)
+        try:
+            with profiling.profiled(profile or profiling.artifact_name("scrape", _id)):
+                result = scraper.scrape_notice(_id, published, engine=engine, session=self.session,
+                                               browser=self.fallback_browser)
+            succeeded = True
+            return result
+        finally:
+            self.scraped += 1
+            self.recycle_browser()
+            self.reset_browser()
+            # The scanner spaces its tasks by these durations
+            try:
+                record_scrape(engine, _id, time.time() - started, succeeded)
+            except Exception as e:
+                logging.warning("Scrape duration of #{} not recorded - {}".format(_id, str(e)))
+
+    # Fetches the notice and contact pages of saved notice _id and scrapes it again when they changed
+    def recheck(self, _id):
+        engine = self.engine if self.engine is not None else get_engine()
+        self.warm(engine)
+        try:
+            return scraper.recheck_notice(_id, engine=engine, session=self.session, browser=self.fallback_browser)
+        finally:
+            self.recycle_browser()
+            self.reset_browser()
+
+    # Known operators are loaded once per engine, before the worker's first notice
+    @staticmethod
+    def warm(engine):
+        try:
+            operator_cache.warm(engine, get_tables(engine)[1])
+        except Exception as e:
+            logging.warning("Operator cache not warmed - {}".format(str(e)))
+
+    def recycle_browser(self, force=False):
+        if self.browser is None:
+            return
+        try:
+            rss = browser_rss(self.browser.browser)
+        except Exception:
+            rss = 0
+        if force or self.browser.pages >= BROWSER_MAX_PAGES or rss >= BROWSER_MAX_RSS_MB:
+            logging.info("Recycling browser after {} pages using {:.0f} MB".format(self.browser.pages, rss))
+            try:
+                self.browser.close()
+            except Exception as e:
+                logging.warning("Browser didn't quit cleanly - {}".format(str(e)))
+            self.browser = None
+
+    # The next notice gets the same browser without the last one's cookies
+    def reset_browser(self):
+        if self.browser is None:
+            return
+        try:
+            self.browser.reset()
+        except Exception as e:
+            logging.warning("Browser reset failed, recycling it - {}".format(str(e)))
+            self.recycle_browser(force=True)
+
+    def close(self):
+        self.recycle_browser(force=True)
+        self.session.close()
+
+
+# The worker of a scraper process, see ScraperPool(processes=True)
+process_worker = None
+
+
+def init_process():
+    global process_worker
+    # The Cloud Logging client holds gRPC channels that can't cross a fork, each process makes its own
+    scraper.setup_logging()
+    process_worker = Worker(None)
+    multiprocessing.util.Finalize(process_worker, process_worker.close, exitpriority=10)
+    # Whatever the fork server counted before the fork isn't this process's to report
+    metrics.take()
+
+
+# Runs the worker's task ("scrape" or "recheck") with args. Returns (error or None, result, metrics recorded
+# meanwhile) so the parent's /metrics gets them either way.
+def run_in_process(task, *args):
+    try:
+        result = getattr(process_worker, task)(*args)
+    except Exception as e:
+        return e, None, metrics.take()
+    return None, result, metrics.take()
+
+
+# Future of run_in_process's result, merging its metrics into this process's
+def unwrapped(future):
+    result = Future()
+
+    def done(future):
+        try:
+            error, value, delta = future.result()
+        except Exception as e:
+            result.set_exception(e)
+            return
+        metrics.merge(delta)
+        if error is not None:
+            result.set_exception(error)
+        else:
+            result.set_result(value)
+
+    future.add_done_callback(done)
+    return result
+
+
+class ScraperPool:
+    """Runs scrape_notice on a fixed number of warm workers with a bounded waiting line."""
+
+    def __init__(self, workers=SCRAPER_WORKERS, queue=SCRAPER_QUEUE, engine=None, processes=SCRAPER_PROCESSES):
+        if processes and engine is not None:
+            raise ValueError("Scraper processes open their own engine, none can be passed")
+        # None uses the process-wide engine from runtime.py
+        self.engine = engine
+        self.workers = workers
+        self.queue = queue
+        self.processes = processes
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._executor = self._start_executor()
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def _worker(self):
+        worker = getattr(self._local, "worker", None)
+        if worker is None:
+            worker = self._local.worker = Worker(self.engine)
+            with self._lock:
+                self._all.append(worker)
+        return worker
+
+    def _start_executor(self):
+        if self.processes:
+            return ProcessPoolExecutor(max_workers=self.workers, mp_context=startup.fork_server(),
+                                       initializer=init_process)
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scraper")
+
+    def _run(self, task, *args):
+        return getattr(self._worker(), task)(*args)
+
+    # Returns a future, raises PoolFull when every worker is busy and the waiting line is full.
+    # With block=True waits for a free place in the line instead. profile names profiling artifacts.
+    def submit(self, _id, published, block=False, profile=None):
+        return self._submit("scrape", (_id, published, profile), block)
+
+    # Rechecks saved notice _id (scraper.recheck_notice) on a warm worker, same waiting line as submit
+    def submit_recheck(self, _id, block=False):
+        return self._submit("recheck", (_id,), block)
+
+    def _submit(self, task, args, block):
+        if not self._slots.acquire(blocking=block):
+            raise PoolFull("{} notices already running or waiting".format(self.workers + self.queue))
+        try:
+            if self.processes:
+                try:
+                    future = self._executor.submit(run_in_process, task, *args)
+                except BrokenProcessPool:
+                    # A scraper process died (e.g. killed for memory), start new ones from the fork server
+                    logging.warning("Scraper processes broken, restarting them")
+                    with self._lock:
+                        self._executor = self._start_executor()
+                    future = self._executor.submit(run_in_process, task, *args)
+                future = unwrapped(future)
+            else:
+                future = self._executor.submit(self._run, task, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for worker in self._all:
+                worker.close()
+            self._all = []
+        logging.info("Operator cache: {}".format(operator_cache.stats()))
+        if self.engine is not None:
+            self.engine.dispose()
+
+
+pool = None
+pool_lock = threading.Lock()
+
+
+# The pool is created on the first scrape so health checks don't wait for secrets or the database
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            scraper.setup_logging()
+            pool = ScraperPool()
+        return pool